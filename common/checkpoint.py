@@ -0,0 +1,418 @@
+"""
+Checkpoint saving and loading helpers for the runners and model wrappers.
+
+A sharded checkpoint is a directory holding one safetensors file of model weights
+and one torch file of optimizer state per rank, plus a `manifest.json` that is
+published last. A directory without a manifest is an unfinished checkpoint.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+from torch.nn.modules.module import _IncompatibleKeys
+
+MANIFEST_NAME = "manifest.json"
+CHECKPOINT_FORMAT = "sharded"
+
+# callbacks (target, source) run by load_state_dict_mmap before each copy
+_load_observers = []
+
+
+def is_sharded_checkpoint(path):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, MANIFEST_NAME))
+
+
+def _atomic_write(path, write_fn):
+    tmp_path = "{}.tmp.{}".format(path, os.getpid())
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _atomic_write_json(path, obj):
+    def _write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(obj, f)
+
+    _atomic_write(path, _write)
+
+
+def _shard_names(rank, world_size):
+    suffix = "{:05d}-of-{:05d}".format(rank, world_size)
+    return "model-{}.safetensors".format(suffix), "optimizer-{}.pth".format(suffix)
+
+
+def _is_positional_tensor_list(group, key):
+    """
+    True for param-group entries holding one tensor per parameter, such as the
+    pre-trained anchors ('pre') kept by the FTP and AdamH optimizers.
+    """
+    value = group[key]
+    return (
+        key != "params"
+        and isinstance(value, (list, tuple))
+        and len(value) == len(group["params"])
+        and len(value) > 0
+        and all(torch.is_tensor(v) for v in value)
+    )
+
+
+class CheckpointWriter:
+    """
+    Snapshot model and optimizer state into reusable (pinned) CPU buffers and
+    write this rank's shard from a background thread, so training only waits
+    for the device-to-host copy.
+
+    Model tensors are split across ranks by position in the state dict and
+    optimizer state by parameter index, so each rank copies and writes about
+    1/world_size of the checkpoint. Rank 0 publishes the manifest once every
+    rank has reported its shard.
+    """
+
+    def __init__(self, rank=0, world_size=1, pin_memory=None, timeout=3600):
+        self.rank = rank
+        self.world_size = world_size
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.timeout = timeout
+
+        self._buffers = {}
+        self._thread = None
+        self._error = None
+        self._num_saves = 0
+
+    def wait(self):
+        """
+        Block until the previous save is on disk, re-raising any error it hit.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("background checkpoint write failed") from error
+
+    def save(self, save_dir, model_state, optimizer_state=None, meta=None, sharded=True):
+        """
+        Snapshot this rank's shard and write it to `save_dir` asynchronously.
+
+        With `sharded=False` the calling rank writes the whole checkpoint on its
+        own (used for the best checkpoint, which only the main process saves).
+        """
+        # the buffers are reused, so the previous write has to finish first
+        self.wait()
+
+        rank, world_size = (self.rank, self.world_size) if sharded else (0, 1)
+        save_id = "{}-{}".format((meta or {}).get("epoch"), self._num_saves)
+        if sharded:
+            self._num_saves += 1
+
+        os.makedirs(save_dir, exist_ok=True)
+        if rank == 0:
+            # hide the previous checkpoint in this directory while it is rewritten
+            manifest_path = os.path.join(save_dir, MANIFEST_NAME)
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+
+        model_shard = self._snapshot_model(model_state, rank, world_size)
+        optimizer_shard = self._snapshot_optimizer(optimizer_state, rank, world_size)
+        if self.pin_memory:
+            torch.cuda.synchronize()
+
+        self._thread = threading.Thread(
+            target=self._write,
+            args=(save_dir, save_id, rank, world_size, model_shard, optimizer_shard, meta),
+            name="checkpoint-writer",
+        )
+        self._thread.start()
+
+    def _snapshot(self, key, tensor):
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = torch.empty(
+                tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=self.pin_memory
+            )
+            self._buffers[key] = buffer
+        buffer.copy_(tensor.detach(), non_blocking=self.pin_memory)
+        return buffer
+
+    def _snapshot_model(self, model_state, rank, world_size):
+        keys = list(model_state.keys())[rank::world_size]
+        return {k: self._snapshot("model/{}".format(k), model_state[k]) for k in keys}
+
+    def _snapshot_optimizer(self, optimizer_state, rank, world_size):
+        if optimizer_state is None:
+            return None
+
+        state = {}
+        for idx, param_state in optimizer_state["state"].items():
+            if idx % world_size != rank:
+                continue
+            state[idx] = {
+                k: self._snapshot("optim/{}/{}".format(idx, k), v) if torch.is_tensor(v) else v
+                for k, v in param_state.items()
+            }
+
+        param_groups, group_tensors = [], {}
+        for g, group in enumerate(optimizer_state["param_groups"]):
+            group = dict(group)
+            for key in list(group.keys()):
+                if not _is_positional_tensor_list(group, key):
+                    continue
+                group_tensors["{}/{}".format(g, key)] = {
+                    pos: self._snapshot("group/{}/{}/{}".format(g, key, pos), t)
+                    for pos, (idx, t) in enumerate(zip(group["params"], group[key]))
+                    if idx % world_size == rank
+                }
+                group[key] = None
+            param_groups.append(group)
+
+        return {
+            "state": state,
+            "param_groups": param_groups if rank == 0 else None,
+            "group_tensors": group_tensors,
+        }
+
+    def _write(self, save_dir, save_id, rank, world_size, model_shard, optimizer_shard, meta):
+        try:
+            model_name, optimizer_name = _shard_names(rank, world_size)
+            _atomic_write(
+                os.path.join(save_dir, model_name),
+                lambda path: save_file(model_shard, path, metadata={"format": "pt"}),
+            )
+            if optimizer_shard is not None:
+                _atomic_write(
+                    os.path.join(save_dir, optimizer_name),
+                    lambda path: torch.save(optimizer_shard, path),
+                )
+            else:
+                optimizer_name = None
+
+            _atomic_write_json(
+                os.path.join(save_dir, "rank-{:05d}.json".format(rank)),
+                {"save_id": save_id, "model": model_name, "optimizer": optimizer_name},
+            )
+            if rank == 0:
+                self._publish_manifest(save_dir, save_id, world_size, meta)
+        except BaseException as e:
+            logging.exception("Failed to write checkpoint shard to {}.".format(save_dir))
+            self._error = e
+
+    def _publish_manifest(self, save_dir, save_id, world_size, meta):
+        shards = []
+        deadline = time.time() + self.timeout
+        for r in range(world_size):
+            marker_path = os.path.join(save_dir, "rank-{:05d}.json".format(r))
+            while True:
+                if os.path.isfile(marker_path):
+                    with open(marker_path) as f:
+                        marker = json.load(f)
+                    if marker["save_id"] == save_id:
+                        break
+                if time.time() > deadline:
+                    raise TimeoutError(
+                        "rank {} did not finish its shard of {}".format(r, save_dir)
+                    )
+                time.sleep(1)
+            shards.append(marker)
+
+        manifest = {
+            "format": CHECKPOINT_FORMAT,
+            "save_id": save_id,
+            "world_size": world_size,
+            "model_shards": [s["model"] for s in shards],
+            "optimizer_shards": [s["optimizer"] for s in shards if s["optimizer"]],
+        }
+        manifest.update(meta or {})
+        _atomic_write_json(os.path.join(save_dir, MANIFEST_NAME), manifest)
+        logging.info("Checkpoint {} is complete.".format(save_dir))
+
+
+def load_sharded_checkpoint(path, map_location="cpu", load_optimizer=True):
+    """
+    Read a sharded checkpoint back into the single-file layout
+    ({"model", "optimizer", "config", "scaler", "epoch"}).
+    """
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+
+    device = str(map_location) if map_location is not None else "cpu"
+    model_state = {}
+    for name in manifest["model_shards"]:
+        model_state.update(load_file(os.path.join(path, name), device=device))
+
+    optimizer_state = None
+    if load_optimizer and manifest["optimizer_shards"]:
+        state, param_groups, group_tensors = {}, None, {}
+        for name in manifest["optimizer_shards"]:
+            shard = torch.load(os.path.join(path, name), map_location=map_location)
+            state.update(shard["state"])
+            if shard["param_groups"] is not None:
+                param_groups = shard["param_groups"]
+            for key, tensors in shard["group_tensors"].items():
+                group_tensors.setdefault(key, {}).update(tensors)
+
+        for key, tensors in group_tensors.items():
+            g, name = key.split("/", 1)
+            param_groups[int(g)][name] = [tensors[pos] for pos in range(len(tensors))]
+        optimizer_state = {"state": state, "param_groups": param_groups}
+
+    return {
+        "model": model_state,
+        "optimizer": optimizer_state,
+        "config": manifest.get("config"),
+        "scaler": manifest.get("scaler"),
+        "epoch": manifest.get("epoch"),
+    }
+
+
+def load_checkpoint(path, map_location="cpu"):
+    """
+    Load either a single-file torch checkpoint or a sharded checkpoint directory.
+    """
+    if is_sharded_checkpoint(path):
+        return load_sharded_checkpoint(path, map_location=map_location)
+    if os.path.isdir(path):
+        raise RuntimeError("{} has no manifest, the checkpoint is unfinished.".format(path))
+    return torch.load(path, map_location=map_location)
+
+
+def compile_prefix_rules(rules):
+    """
+    Turn an ordered {old_prefix: new_prefix} mapping into a function that rewrites
+    a key with the first matching rule, using a single regex match per key.
+    """
+    if not rules:
+        return lambda key: key
+
+    pattern = re.compile("^(?:{})".format("|".join(re.escape(p) for p in rules)))
+    rules = dict(rules)
+
+    def rename(key):
+        match = pattern.match(key)
+        if match is None:
+            return key
+        return rules[match.group(0)] + key[match.end():]
+
+    return rename
+
+
+def _iter_safetensors(path):
+    with safe_open(path, framework="pt", device="cpu") as f:
+        for key in f.keys():
+            yield key, f.get_tensor(key)
+
+
+def iter_checkpoint_tensors(path, weights_only=False):
+    """
+    Yield (key, tensor) pairs of the model weights in a checkpoint without
+    reading the whole file into memory.
+
+    Sharded checkpoints and .safetensors files are read one tensor at a time;
+    torch files are memory-mapped, so ranks on one node share the page cache.
+    """
+    if is_sharded_checkpoint(path):
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        for name in manifest["model_shards"]:
+            yield from _iter_safetensors(os.path.join(path, name))
+        return
+    if os.path.isdir(path):
+        raise RuntimeError("{} has no manifest, the checkpoint is unfinished.".format(path))
+
+    if path.endswith(".safetensors"):
+        yield from _iter_safetensors(path)
+        return
+
+    try:
+        checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=weights_only)
+    except RuntimeError:
+        # files in the legacy (non-zip) serialization format cannot be mapped
+        logging.warning("Cannot memory-map {}, loading it into memory.".format(path))
+        checkpoint = torch.load(path, map_location="cpu", weights_only=weights_only)
+
+    if "model" in checkpoint.keys():
+        checkpoint = checkpoint["model"]
+    yield from checkpoint.items()
+
+
+def load_state_dict_mmap(module, path, prefix_rules=None, weights_only=False):
+    """
+    Copy the weights of a checkpoint straight into the parameters and buffers of
+    `module`, renaming keys with `prefix_rules` (see `compile_prefix_rules`).
+
+    Only one checkpoint tensor is materialized at a time and nothing is copied
+    besides the final write into the target tensor. Returns the missing and
+    unexpected keys like `nn.Module.load_state_dict(strict=False)`.
+    """
+    rename = compile_prefix_rules(prefix_rules)
+    target = module.state_dict()
+    loaded, unexpected = set(), []
+
+    with torch.no_grad():
+        for key, tensor in iter_checkpoint_tensors(path, weights_only=weights_only):
+            key = rename(key)
+            if key not in target:
+                unexpected.append(key)
+                continue
+            if target[key].shape != tensor.shape:
+                raise RuntimeError(
+                    "size mismatch for {}: copying a param with shape {} from checkpoint, "
+                    "the shape in current model is {}.".format(key, tensor.shape, target[key].shape)
+                )
+            for observer in _load_observers:
+                observer(target[key], tensor)
+            target[key].copy_(tensor)
+            loaded.add(key)
+
+    missing = [key for key in target.keys() if key not in loaded]
+    return _IncompatibleKeys(missing, unexpected)
+
+
+class WiSEInterpolator:
+    """
+    WiSE-FT interpolation, alpha * zero-shot + (1 - alpha) * fine-tuned, written
+    into the live model in place.
+
+    Inside `track()`, every tensor that `load_state_dict_mmap` overwrites keeps
+    its zero-shot value on CPU and a reference to its fine-tuned source (which
+    stays memory-mapped for torch checkpoints). Tensors no checkpoint touches are
+    the same in both models and are never copied, so `blend` can be called again
+    with another alpha without reloading anything.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @contextmanager
+    def track(self):
+        _load_observers.append(self._observe)
+        try:
+            yield self
+        finally:
+            _load_observers.remove(self._observe)
+
+    def _observe(self, target, source):
+        key = (target.data_ptr(), tuple(target.shape))
+        if key in self._entries:
+            # a later checkpoint overrides the fine-tuned value, the zero-shot one stays
+            w0 = self._entries[key][1]
+        else:
+            w0 = target.detach().to("cpu", copy=True)
+        self._entries[key] = (target, w0, source)
+
+    @torch.no_grad()
+    def blend(self, alpha):
+        for target, w0, w1 in self._entries.values():
+            target.copy_(w1)
+            target.lerp_(w0.to(target.device), alpha)
+        logging.info("WiSE: blended {} tensors with alpha={}".format(len(self._entries), alpha))
@@ -5,6 +5,26 @@
  For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
+import importlib
+import logging
+import pkgutil
+
+REGISTRY_KINDS = ("builder", "task", "processor", "model", "lr_scheduler", "runner")
+
+
+def lazy_getattr(module_name, attributes):
+    r"""Build a module level ``__getattr__`` (PEP 562) that imports ``attributes[name]`` on first access.
+
+    Keeps ``from models import ChatVLA`` working while ``import models`` stays cheap.
+    """
+
+    def __getattr__(name):
+        if name in attributes:
+            return getattr(importlib.import_module(attributes[name]), name)
+        raise AttributeError("module '{}' has no attribute '{}'".format(module_name, name))
+
+    return __getattr__
+
 
 class Registry:
     mapping = {
@@ -14,10 +34,91 @@ class Registry:
         "model_name_mapping": {},
         "lr_scheduler_name_mapping": {},
         "runner_name_mapping": {},
+        "lazy": {kind: {} for kind in REGISTRY_KINDS},
         "state": {},
         "paths": {},
     }
 
+    @classmethod
+    def register_lazy(cls, kind, name, module):
+        r"""List ``name`` as provided by ``module``, which is imported only when ``name`` is first looked up.
+
+        Args:
+            kind: One of "builder", "task", "processor", "model", "lr_scheduler", "runner".
+            name: Key the module registers with the matching ``register_<kind>`` decorator.
+            module: Dotted import path of the module.
+
+        Usage:
+
+            registry.register_lazy("model", "chatvla", "models.chatvla")
+        """
+        assert kind in REGISTRY_KINDS, "Unknown registry kind {}.".format(kind)
+        lazy = cls.mapping["lazy"][kind]
+        if name in lazy and lazy[name] != module:
+            raise KeyError(
+                "Name '{}' already listed for {}.".format(name, lazy[name])
+            )
+        lazy[name] = module
+
+    @classmethod
+    def _get_class(cls, kind, name):
+        mapping = cls.mapping["{}_name_mapping".format(kind)]
+        module = cls.mapping["lazy"][kind].get(name, None)
+        if name not in mapping and module is not None:
+            importlib.import_module(module)
+            if name not in mapping:
+                raise KeyError(
+                    "Module '{}' is listed for {} '{}' but does not register it.".format(module, kind, name)
+                )
+            unlisted = [
+                k for k, v in mapping.items()
+                if v.__module__ == module and k not in cls.mapping["lazy"][kind]
+            ]
+            if len(unlisted) > 0:
+                logging.warning(
+                    "Module '{}' registers {} {} without a lazy listing.".format(module, kind, unlisted)
+                )
+        return mapping.get(name, None)
+
+    @classmethod
+    def _list(cls, kind):
+        return sorted(
+            set(cls.mapping["{}_name_mapping".format(kind)]) | set(cls.mapping["lazy"][kind])
+        )
+
+    @classmethod
+    def check_lazy_listings(cls, packages=("data.builders", "models", "processors", "runners", "tasks")):
+        r"""Import every module of ``packages`` and compare what they register with the lazy listings.
+
+        Returns a list of problems, empty when every listed name is registered by its module and every
+        registered name is listed.
+        """
+        for package in packages:
+            package = importlib.import_module(package)
+            for info in pkgutil.iter_modules(package.__path__):
+                if not info.ispkg:
+                    importlib.import_module("{}.{}".format(package.__name__, info.name))
+
+        problems = []
+        for kind in REGISTRY_KINDS:
+            mapping = cls.mapping["{}_name_mapping".format(kind)]
+            lazy = cls.mapping["lazy"][kind]
+            if len(lazy) == 0:
+                continue
+            for name, module in lazy.items():
+                if name not in mapping:
+                    problems.append("{} '{}' is listed for '{}' but not registered.".format(kind, name, module))
+                elif mapping[name].__module__ != module:
+                    problems.append(
+                        "{} '{}' is listed for '{}' but registered in '{}'.".format(
+                            kind, name, module, mapping[name].__module__
+                        )
+                    )
+            for name in mapping:
+                if name not in lazy:
+                    problems.append("{} '{}' is registered but not listed.".format(kind, name))
+        return problems
+
     @classmethod
     def register_builder(cls, name):
         r"""Register a dataset builder to registry with key 'name'
@@ -230,51 +331,51 @@ class Registry:
 
     @classmethod
     def get_builder_class(cls, name):
-        return cls.mapping["builder_name_mapping"].get(name, None)
+        return cls._get_class("builder", name)
 
     @classmethod
     def get_model_class(cls, name):
-        return cls.mapping["model_name_mapping"].get(name, None)
+        return cls._get_class("model", name)
 
     @classmethod
     def get_task_class(cls, name):
-        return cls.mapping["task_name_mapping"].get(name, None)
+        return cls._get_class("task", name)
 
     @classmethod
     def get_processor_class(cls, name):
-        return cls.mapping["processor_name_mapping"].get(name, None)
+        return cls._get_class("processor", name)
 
     @classmethod
     def get_lr_scheduler_class(cls, name):
-        return cls.mapping["lr_scheduler_name_mapping"].get(name, None)
+        return cls._get_class("lr_scheduler", name)
 
     @classmethod
     def get_runner_class(cls, name):
-        return cls.mapping["runner_name_mapping"].get(name, None)
+        return cls._get_class("runner", name)
 
     @classmethod
     def list_runners(cls):
-        return sorted(cls.mapping["runner_name_mapping"].keys())
+        return cls._list("runner")
 
     @classmethod
     def list_models(cls):
-        return sorted(cls.mapping["model_name_mapping"].keys())
+        return cls._list("model")
 
     @classmethod
     def list_tasks(cls):
-        return sorted(cls.mapping["task_name_mapping"].keys())
+        return cls._list("task")
 
     @classmethod
     def list_processors(cls):
-        return sorted(cls.mapping["processor_name_mapping"].keys())
+        return cls._list("processor")
 
     @classmethod
     def list_lr_schedulers(cls):
-        return sorted(cls.mapping["lr_scheduler_name_mapping"].keys())
+        return cls._list("lr_scheduler")
 
     @classmethod
     def list_datasets(cls):
-        return sorted(cls.mapping["builder_name_mapping"].keys())
+        return cls._list("builder")
 
     @classmethod
     def get_path(cls, name):
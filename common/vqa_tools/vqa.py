@@ -20,6 +20,7 @@ __version__ = "0.9"
 #  loadQA     - Load questions and answers with the specified question ids.
 #  showQA     - Display the specified questions and answers.
 #  loadRes    - Load result file and create result object.
+#  from_index - Create a VQA object backed by a memory-mapped ground-truth index.
 
 # Help on each function can be accessed by: "help(COCO.function)"
 
@@ -27,6 +28,8 @@ import json
 import datetime
 import copy
 
+from common.vqa_tools.vqa_index import INFO_KEYS, ImageMap, QuestionMap, RowList
+
 
 class VQA:
     def __init__(self, annotation_file=None, question_file=None):
@@ -41,6 +44,7 @@ class VQA:
         self.qa = {}
         self.qqa = {}
         self.imgToQA = {}
+        self.index = None
         if not annotation_file == None and not question_file == None:
             print("loading VQA annotations and questions into memory...")
             time_t = datetime.datetime.utcnow()
@@ -68,6 +72,23 @@ class VQA:
         self.qqa = qqa
         self.imgToQA = imgToQA
 
+    @classmethod
+    def from_index(cls, index):
+        """
+        VQA object over a `VQAIndex` (see `vqa_index.load_vqa_index`).
+        `dataset`, `questions`, `qa`, `qqa` and `imgToQA` are read-only views that build dicts on access.
+        :param index (VQAIndex): ground-truth index of one split
+        :return: vqa (VQA)
+        """
+        vqa = cls()
+        vqa.index = index
+        vqa.dataset = dict(index.meta["dataset_info"], annotations=RowList(index, index.annotation))
+        vqa.questions = dict(index.meta["questions_info"], questions=RowList(index, index.question))
+        vqa.qa = QuestionMap(index, index.annotation)
+        vqa.qqa = QuestionMap(index, index.question)
+        vqa.imgToQA = ImageMap(index)
+        return vqa
+
     def info(self):
         """
         Print information about the VQA annotation file.
@@ -89,6 +110,8 @@ class VQA:
         ansTypes = ansTypes if type(ansTypes) == list else [ansTypes]
 
         if len(imgIds) == len(quesTypes) == len(ansTypes) == 0:
+            if self.index is not None:
+                return self.index.question_ids
             anns = self.dataset["annotations"]
         else:
             if not len(imgIds) == 0:
@@ -170,23 +193,28 @@ class VQA:
             for ans in ann["answers"]:
                 print("Answer %d: %s" % (ans["answer_id"], ans["answer"]))
 
-    def loadRes(self, resFile, quesFile):
+    def loadRes(self, resFile, quesFile=None):
         """
         Load result file and return a result object.
-        :param   resFile (str)     : file name of result file
+        :param   resFile (str or list) : file name of result file, or the list of results itself
+                 quesFile (str)        : question file, not needed for index-backed objects
         :return: res (obj)         : result api object
         """
         res = VQA()
-        res.questions = json.load(open(quesFile))
-        res.dataset["info"] = copy.deepcopy(self.questions["info"])
-        res.dataset["task_type"] = copy.deepcopy(self.questions["task_type"])
-        res.dataset["data_type"] = copy.deepcopy(self.questions["data_type"])
-        res.dataset["data_subtype"] = copy.deepcopy(self.questions["data_subtype"])
-        res.dataset["license"] = copy.deepcopy(self.questions["license"])
+        if self.index is not None:
+            # question lookups go to the shared index instead of a second copy of the question file
+            res.questions = {"questions": []}
+        else:
+            res.questions = json.load(open(quesFile))
+        for key in INFO_KEYS:
+            res.dataset[key] = copy.deepcopy(self.questions[key])
 
         print("Loading and preparing results...     ")
         time_t = datetime.datetime.utcnow()
-        anns = json.load(open(resFile))
+        if isinstance(resFile, str):
+            anns = json.load(open(resFile))
+        else:
+            anns = [dict(ann) for ann in resFile]
         assert type(anns) == list, "results is not an array of objects"
         annsQuesIds = [ann["question_id"] for ann in anns]
         assert set(annsQuesIds) == set(
@@ -198,14 +226,20 @@ class VQA:
                 assert (
                     ann["answer"] in self.qqa[quesId]["multiple_choices"]
                 ), "predicted answer is not one of the multiple choices"
-            qaAnn = self.qa[quesId]
-            ann["image_id"] = qaAnn["image_id"]
-            ann["question_type"] = qaAnn["question_type"]
-            ann["answer_type"] = qaAnn["answer_type"]
+            if self.index is not None:
+                ann["image_id"], ann["question_type"], ann["answer_type"] = self.index.fields(quesId)
+            else:
+                qaAnn = self.qa[quesId]
+                ann["image_id"] = qaAnn["image_id"]
+                ann["question_type"] = qaAnn["question_type"]
+                ann["answer_type"] = qaAnn["answer_type"]
         print(
             "DONE (t=%0.2fs)" % ((datetime.datetime.utcnow() - time_t).total_seconds())
         )
 
         res.dataset["annotations"] = anns
         res.createIndex()
+        if self.index is not None:
+            res.questions = self.questions
+            res.qqa = self.qqa
         return res
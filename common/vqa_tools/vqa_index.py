@@ -0,0 +1,311 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+# Compact on-disk index of VQA ground truth.
+#
+# The annotation and question files of a split are converted once into numpy arrays (question ids,
+# image ids, question / answer types, answer ids) and a string table, stored under an index directory
+# named after the files' path, size and mtime, and memory-mapped. Only the fields used for evaluation are
+# kept. `qa` / `qqa` style dicts are rebuilt on access, so every evaluation works on fresh dicts and nothing
+# is held per question.
+
+import hashlib
+import json
+import os
+import shutil
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+from filelock import FileLock
+
+INDEX_VERSION = 1
+INFO_KEYS = ("info", "task_type", "data_type", "data_subtype", "license")
+ARRAYS = (
+    "strings",
+    "string_offsets",
+    "question_id",
+    "image_id",
+    "question",
+    "question_type",
+    "answer_type",
+    "multiple_choice_answer",
+    "answer_offsets",
+    "answers",
+    "answer_ids",
+    "choice_offsets",
+    "choices",
+)
+
+_INDEX_CACHE = {}
+
+
+class _StringTable:
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def add(self, s):
+        s = "" if s is None else str(s)
+        if s not in self.ids:
+            self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.ids[s]
+
+    def arrays(self):
+        encoded = [s.encode("utf-8") for s in self.strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _encode_ids(values, table):
+    # ints stay ints, anything else (e.g. string instance ids) goes through the string table
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return np.asarray(values, dtype=np.int64), "int"
+    return np.asarray([table.add(v) for v in values], dtype=np.int64), "str"
+
+
+def _source_stamp(*files):
+    return [[os.path.abspath(f), os.path.getsize(f), os.stat(f).st_mtime_ns] for f in files]
+
+
+def build_vqa_index(annotation_file, question_file, path):
+    dataset = json.load(open(annotation_file, "r"))
+    questions = json.load(open(question_file, "r"))
+    ques_by_id = {q["question_id"]: q for q in questions["questions"]}
+    anns = dataset["annotations"]
+
+    table = _StringTable()
+    question_id, qid_kind = _encode_ids([ann["question_id"] for ann in anns], table)
+    image_id, image_kind = _encode_ids([ann["image_id"] for ann in anns], table)
+
+    arrays = dict(question_id=question_id, image_id=image_id)
+    arrays["question"] = np.asarray(
+        [table.add(ques_by_id.get(ann["question_id"], {}).get("question", "")) for ann in anns], dtype=np.int64
+    )
+    for key in ("question_type", "answer_type", "multiple_choice_answer"):
+        arrays[key] = np.asarray([table.add(ann.get(key, "")) for ann in anns], dtype=np.int64)
+
+    answers, answer_ids, answer_offsets = [], [], [0]
+    choices, choice_offsets = [], [0]
+    for ann in anns:
+        for ans in ann["answers"]:
+            answers.append(table.add(ans["answer"]))
+            answer_ids.append(ans.get("answer_id", len(answer_ids) - answer_offsets[-1]))
+        answer_offsets.append(len(answers))
+        for choice in ques_by_id.get(ann["question_id"], {}).get("multiple_choices", []):
+            choices.append(table.add(choice))
+        choice_offsets.append(len(choices))
+    arrays["answers"] = np.asarray(answers, dtype=np.int64)
+    arrays["answer_ids"] = np.asarray(answer_ids, dtype=np.int64)
+    arrays["answer_offsets"] = np.asarray(answer_offsets, dtype=np.int64)
+    arrays["choices"] = np.asarray(choices, dtype=np.int64)
+    arrays["choice_offsets"] = np.asarray(choice_offsets, dtype=np.int64)
+    arrays["strings"], arrays["string_offsets"] = table.arrays()
+
+    meta = {
+        "version": INDEX_VERSION,
+        "source": _source_stamp(annotation_file, question_file),
+        "question_id_kind": qid_kind,
+        "image_id_kind": image_kind,
+        "has_choices": len(choices) > 0,
+        "dataset_info": {k: dataset.get(k, "") for k in INFO_KEYS},
+        "questions_info": {k: questions.get(k, "") for k in INFO_KEYS},
+    }
+
+    # build next to the final location and rename it in, so readers never see a partial index
+    tmp_path = "{}.tmp.{}".format(path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    try:
+        for name in ARRAYS:
+            np.save(os.path.join(tmp_path, name + ".npy"), arrays[name])
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        # another builder got there first: its index describes the same files
+        if not _index_is_current(path, meta["source"]):
+            raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _index_is_current(path, source):
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return meta.get("version") == INDEX_VERSION and meta.get("source") == source
+
+
+def load_vqa_index(annotation_file, question_file, index_root):
+    """
+    Index of the split stored in `annotation_file` / `question_file`.
+
+    The index lives in `index_root` under a name derived from the files' path, size and mtime, so
+    editing either file leads to a new index and an existing one is never overwritten. It is built
+    once under a file lock, whichever process or job gets there first, and then shared. Raises
+    OSError when `index_root` cannot be written and there is no index yet.
+    """
+    source = _source_stamp(annotation_file, question_file)
+    key = hashlib.sha1(json.dumps(source).encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(index_root, "{}.{}.index".format(os.path.basename(annotation_file), key))
+    index = _INDEX_CACHE.get(path)
+    if index is not None:
+        return index
+    if not _index_is_current(path, source):
+        os.makedirs(index_root, exist_ok=True)
+        with FileLock(path + ".lock"):
+            if not _index_is_current(path, source):
+                build_vqa_index(annotation_file, question_file, path)
+    index = VQAIndex(path)
+    _INDEX_CACHE[path] = index
+    return index
+
+
+class VQAIndex:
+    """
+    Memory-mapped ground truth of one VQA split, one row per annotation.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        for name in ARRAYS:
+            setattr(self, "_" + name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+        self._rows = None
+
+    def __len__(self):
+        return len(self._question_id)
+
+    def string(self, i):
+        return bytes(self._strings[self._string_offsets[i]:self._string_offsets[i + 1]]).decode("utf-8")
+
+    def _decode_id(self, kind, value):
+        return int(value) if self.meta[kind] == "int" else self.string(value)
+
+    @property
+    def question_ids(self):
+        if self.meta["question_id_kind"] == "int":
+            return self._question_id.tolist()
+        return [self.string(i) for i in self._question_id]
+
+    def row(self, question_id):
+        if self._rows is None:
+            self._rows = {qid: row for row, qid in enumerate(self.question_ids)}
+        return self._rows[question_id]
+
+    def __contains__(self, question_id):
+        try:
+            self.row(question_id)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def image_id(self, row):
+        return self._decode_id("image_id_kind", self._image_id[row])
+
+    def fields(self, question_id):
+        """
+        (image_id, question_type, answer_type) of a question, without building its answers.
+        """
+        row = self.row(question_id)
+        return self.image_id(row), self.string(self._question_type[row]), self.string(self._answer_type[row])
+
+    def annotation(self, row):
+        start, end = self._answer_offsets[row], self._answer_offsets[row + 1]
+        return {
+            "question_type": self.string(self._question_type[row]),
+            "multiple_choice_answer": self.string(self._multiple_choice_answer[row]),
+            "answers": [
+                {"answer": self.string(a), "answer_id": int(i)}
+                for a, i in zip(self._answers[start:end], self._answer_ids[start:end])
+            ],
+            "image_id": self.image_id(row),
+            "question_id": self._decode_id("question_id_kind", self._question_id[row]),
+            "answer_type": self.string(self._answer_type[row]),
+        }
+
+    def question(self, row):
+        ques = {
+            "question": self.string(self._question[row]),
+            "image_id": self.image_id(row),
+            "question_id": self._decode_id("question_id_kind", self._question_id[row]),
+        }
+        if self.meta["has_choices"]:
+            start, end = self._choice_offsets[row], self._choice_offsets[row + 1]
+            ques["multiple_choices"] = [self.string(c) for c in self._choices[start:end]]
+        return ques
+
+
+class RowList(Sequence):
+    """
+    Read-only list over the index rows, building each dict on access.
+    """
+
+    def __init__(self, index, build):
+        self._index = index
+        self._build = build
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._build(r) for r in range(len(self))[i]]
+        return self._build(range(len(self))[i])
+
+
+class QuestionMap(Mapping):
+    """
+    Read-only `question_id -> dict` mapping over the index, building each dict on access.
+    """
+
+    def __init__(self, index, build):
+        self._index = index
+        self._build = build
+
+    def __getitem__(self, question_id):
+        return self._build(self._index.row(question_id))
+
+    def __contains__(self, question_id):
+        return question_id in self._index
+
+    def __iter__(self):
+        return iter(self._index.question_ids)
+
+    def __len__(self):
+        return len(self._index)
+
+
+class ImageMap(Mapping):
+    """
+    Read-only `image_id -> [annotation, ...]` mapping, grouped on first access.
+    """
+
+    def __init__(self, index):
+        self._index = index
+        self._groups = None
+
+    def _rows(self):
+        if self._groups is None:
+            self._groups = {}
+            for row in range(len(self._index)):
+                self._groups.setdefault(self._index.image_id(row), []).append(row)
+        return self._groups
+
+    def __getitem__(self, image_id):
+        return [self._index.annotation(r) for r in self._rows()[image_id]]
+
+    def __iter__(self):
+        return iter(self._rows())
+
+    def __len__(self):
+        return len(self._rows())
@@ -1,6 +1,26 @@
 from data.builders.base_dataset_builder import load_dataset_config
-from data.builders.vqa_builder import *
-from common.registry import registry
+from common.registry import registry, lazy_getattr
+
+VQA_BUILDERS = {
+    "visualcomet": "VisualCOMETBuilder",
+    "coco_vqa_raw": "COCOVQABuilder_Raw",
+    "gqa_raw": "GQABuilder_Raw",
+    "gqa_ood": "GQAOODBuilder_Raw",
+    "coco_vqa_cp": "COCOVQACPBuilder",
+    "coco_vqa_rephrasings": "COCOVQA_Rephrasings_Builder",
+    "coco_vqa_ce": "COCOVQACEBuilder",
+    "coco_cv-vqa": "COCOCVVQABuilder",
+    "coco_iv-vqa": "COCOIVVQABuilder",
+    "coco_advqa": "COCOADVQABuilder",
+    "textvqa": "TextVQABuilder",
+    "vizwiz": "VizWizBuilder",
+    "coco_okvqa": "COCOOKVQABuilder",
+    "temporal_vqa": "TemporalVQABuilder",
+}
+for builder_name in VQA_BUILDERS:
+    registry.register_lazy("builder", builder_name, "data.builders.vqa_builder")
+
+__getattr__ = lazy_getattr(__name__, {v: "data.builders.vqa_builder" for v in VQA_BUILDERS.values()})
 
 __all__ = [
     "COCOVQACPBuilder",
@@ -58,10 +78,11 @@ def load_dataset(name, cfg_path=None, vis_path=None, data_type=None):
 
 
 class DatasetZoo:
-    def __init__(self) -> None:
-        self.dataset_zoo = {
-            k: list(v.DATASET_CONFIG_DICT.keys())
-            for k, v in sorted(registry.mapping["builder_name_mapping"].items())
+    @property
+    def dataset_zoo(self):
+        return {
+            k: list(registry.get_builder_class(k).DATASET_CONFIG_DICT.keys())
+            for k in registry.list_datasets()
         }
 
     def get_names(self):
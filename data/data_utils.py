@@ -11,6 +11,8 @@ import os
 import random as rnd
 import tarfile
 import zipfile
+from collections import OrderedDict
+
 import cv2
 
 import decord
@@ -26,9 +28,153 @@ from tqdm import tqdm
 decord.bridge.set_bridge("torch")
 MAX_INT = registry.get("MAX_INT")
 
+# open decord readers kept per process
+VIDEO_READER_POOL_SIZE = 4
+# byte budget for decoded frames reused across epochs, off by default; the cache lives in every
+# dataloader worker of every rank, so the host cost is up to num_workers * ranks times this.
+# Set it with `set_frame_cache_bytes` (the runner reads `frame_cache_mb` from the run config).
+FRAME_CACHE_BYTES = 0
+# gaps between requested frames above this are seeked over instead of decoded through
+MAX_DECODE_SKIP = 250
 
-def load_video(video_path, n_frms=MAX_INT, height=-1, width=-1, sampling="uniform"):
+_video_readers = OrderedDict()
+_frame_cache = OrderedDict()
+_frame_cache_bytes = 0
+_cache_pid = None
+
+
+def _reset_caches_after_fork():
+    # decoders must not be shared between dataloader workers
+    global _cache_pid, _frame_cache_bytes
+    if _cache_pid != os.getpid():
+        _video_readers.clear()
+        _frame_cache.clear()
+        _frame_cache_bytes = 0
+        _cache_pid = os.getpid()
+
+
+def set_frame_cache_bytes(nbytes):
+    """
+    Set the per-process budget of the decoded frame cache, 0 disables it.
+
+    Call it before the dataloader workers start: they inherit the budget from the parent.
+    """
+    global FRAME_CACHE_BYTES, _frame_cache_bytes
+    FRAME_CACHE_BYTES = max(int(nbytes), 0)
+    _frame_cache.clear()
+    _frame_cache_bytes = 0
+
+
+def _get_video_reader(video_path, height=-1, width=-1):
+    _reset_caches_after_fork()
+    key = (video_path, height, width)
+    if key in _video_readers:
+        _video_readers.move_to_end(key)
+        return _video_readers[key]
+
+    # decord scales the frames while decoding
     vr = VideoReader(uri=video_path, height=height, width=width)
+    _video_readers[key] = vr
+    if len(_video_readers) > VIDEO_READER_POOL_SIZE:
+        _, evicted = _video_readers.popitem(last=False)
+        if isinstance(evicted, cv2.VideoCapture):
+            evicted.release()
+    return vr
+
+
+def _get_video_capture(video_path):
+    # cv2 captures share the reader pool, so a clip is opened once for its metadata and its frames
+    _reset_caches_after_fork()
+    key = ("cv2", video_path)
+    if key in _video_readers:
+        _video_readers.move_to_end(key)
+        return _video_readers[key]
+
+    cap = cv2.VideoCapture(video_path)
+    _video_readers[key] = cap
+    if len(_video_readers) > VIDEO_READER_POOL_SIZE:
+        _, evicted = _video_readers.popitem(last=False)
+        if isinstance(evicted, cv2.VideoCapture):
+            evicted.release()
+    return cap
+
+
+def _video_metadata(video_path):
+    cap = _get_video_capture(video_path)
+    return int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS)
+
+
+def _frames_nbytes(frames):
+    if isinstance(frames, torch.Tensor):
+        return frames.numel() * frames.element_size()
+    return sum(frame.nbytes for frame in frames)
+
+
+def _get_cached_frames(key):
+    _reset_caches_after_fork()
+    if key not in _frame_cache:
+        return None
+    _frame_cache.move_to_end(key)
+    return _frame_cache[key]
+
+
+def _cache_frames(key, frames):
+    global _frame_cache_bytes
+    if FRAME_CACHE_BYTES <= 0:
+        return
+    nbytes = _frames_nbytes(frames)
+    if nbytes > FRAME_CACHE_BYTES:
+        return
+    _frame_cache[key] = frames
+    _frame_cache_bytes += nbytes
+    while _frame_cache_bytes > FRAME_CACHE_BYTES:
+        _, evicted = _frame_cache.popitem(last=False)
+        _frame_cache_bytes -= _frames_nbytes(evicted)
+
+
+def decode_frames(video_path, frame_indices, target_height, target_width, max_skip=MAX_DECODE_SKIP):
+    """
+    Decode `frame_indices` of a video in one forward pass, resized to (target_height, target_width).
+
+    Frames are decoded in increasing order, grabbing (without converting) the frames in between, so every
+    requested frame costs one decode instead of a seek back to its keyframe. Only gaps longer than
+    `max_skip` frames are seeked over. Returns BGR uint8 frames in the order of `frame_indices`, stopping at
+    the first one that cannot be read. Results are cached per process; callers get copies.
+    """
+    key = ("cv2", video_path, tuple(frame_indices), target_height, target_width)
+    frames = _get_cached_frames(key)
+    if frames is not None:
+        return [frame.copy() for frame in frames]
+
+    decoded = {}
+    cap = _get_video_capture(video_path)
+    position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+    for frame_index in sorted(set(frame_indices)):
+        if frame_index < position or frame_index - position > max_skip:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+            position = frame_index
+        ret = True
+        while ret and position < frame_index:
+            ret = cap.grab()
+            position += 1
+        if ret:
+            ret, frame = cap.read()
+            position += 1
+        if not ret:
+            break
+        decoded[frame_index] = cv2.resize(frame, (target_width, target_height))
+
+    frames = []
+    for frame_index in frame_indices:
+        if frame_index not in decoded:
+            break
+        frames.append(decoded[frame_index])
+    _cache_frames(key, frames)
+    return [frame.copy() for frame in frames]
+
+
+def load_video(video_path, n_frms=MAX_INT, height=-1, width=-1, sampling="uniform"):
+    vr = _get_video_reader(video_path, height=height, width=width)
 
     vlen = len(vr)
     start, end = 0, vlen
@@ -44,10 +190,16 @@ def load_video(video_path, n_frms=MAX_INT, height=-1, width=-1, sampling="unifor
     else:
         raise NotImplementedError
 
-    # get_batch -> T, H, W, C
-    frms = vr.get_batch(indices).permute(3, 0, 1, 2).float()  # (C, T, H, W)
+    # uniform indices repeat every epoch, random head/tail ones do not
+    key = ("decord", video_path, tuple(int(i) for i in indices), height, width) if sampling == "uniform" else None
+    frms = _get_cached_frames(key) if key is not None else None
+    if frms is None:
+        # get_batch decodes the sorted indices in one pass -> T, H, W, C
+        frms = vr.get_batch(indices)
+        if key is not None:
+            _cache_frames(key, frms)
 
-    return frms
+    return frms.permute(3, 0, 1, 2).float()  # (C, T, H, W)
 
 
 def apply_to_sample(f, sample):
@@ -287,9 +439,7 @@ def save_frames_grid(img_array, out_path):
 
 
 def uniform_frame_sampling(video_path, num_frames, target_height, target_width, start_time=None, end_time=None):
-    cap = cv2.VideoCapture(video_path)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    frame_rate = cap.get(cv2.CAP_PROP_FPS)
+    total_frames, frame_rate = _video_metadata(video_path)
 
     if start_time is None:
         start_time = 0
@@ -300,23 +450,11 @@ def uniform_frame_sampling(video_path, num_frames, target_height, target_width,
     end_frame = int(end_time * frame_rate)
     frame_indices = list(range(start_frame, end_frame + 1, (end_frame - start_frame + 1) // num_frames))
 
-    frames = []
-    for frame_index in frame_indices:
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-        ret, frame = cap.read()
-        if not ret:
-            break
-        frame = cv2.resize(frame, (target_width, target_height))
-        frames.append(frame)
-
-    cap.release()
-    return frames
+    return decode_frames(video_path, frame_indices, target_height, target_width)
 
 
 def head_tail_frame_sampling(video_path, num_frames, target_height, target_width, start_time=None, end_time=None):
-    cap = cv2.VideoCapture(video_path)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    frame_rate = cap.get(cv2.CAP_PROP_FPS)
+    total_frames, frame_rate = _video_metadata(video_path)
 
     if start_time is None:
         start_time = 0
@@ -327,16 +465,7 @@ def head_tail_frame_sampling(video_path, num_frames, target_height, target_width
     end_frame = int(end_time * frame_rate)
     frame_indices = [start_frame] + [start_frame + (end_frame - start_frame) // (num_frames - 1) * i for i in range(1, num_frames - 1)] + [end_frame]
 
-    frames = []
-    for frame_index in frame_indices:
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-        ret, frame = cap.read()
-        if not ret:
-            break
-        frame = cv2.resize(frame, (target_width, target_height))
-        frames.append(frame)
-
-    cap.release()
+    frames = decode_frames(video_path, frame_indices, target_height, target_width)
     if len(frames) == 0:
         return None
     return torch.stack([torch.tensor(f).permute(2,0,1).float() for f in frames], dim=1)
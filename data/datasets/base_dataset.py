@@ -23,6 +23,7 @@ class BaseDataset(Dataset):
         ann_root (string): directory to store the annotation file
         """
         self.vis_root = vis_root
+        self.ann_paths = ann_paths
         self.annotation = []
         for ann_path in ann_paths:
             if any(ext in ann_path for ext in ['csv', 'tsv']):
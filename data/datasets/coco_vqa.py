@@ -4,7 +4,7 @@ import random
 from PIL import Image
 import torch
 
-from data.datasets.vqa_datasets import VQADataset, VQAEvalDataset
+from data.datasets.vqa_datasets import VQADataset, VQAEvalDataset, answer_weights
 from data.datasets.base_dataset import BaseDataset
 
 from collections import OrderedDict
@@ -45,15 +45,7 @@ class COCOVQADataset(VQADataset, __DisplMixin):
         image = self.vis_processor(image)
         question = self.text_processor(ann["question"])
 
-        answer_weight = {}
-        for answer in ann["answer"]:
-            if answer in answer_weight.keys():
-                answer_weight[answer] += 1 / len(ann["answer"])
-            else:
-                answer_weight[answer] = 1 / len(ann["answer"])
-
-        answers = list(answer_weight.keys())
-        weights = list(answer_weight.values())
+        answers, weights = answer_weights(ann["answer"])
 
         return {
             "image": image,
@@ -111,15 +103,7 @@ class COCOVQADataset_Raw(VQADataset_Raw, __DisplMixin):
         image_path = os.path.join(self.vis_root, ann["image"])
         image_raw = Image.open(image_path).convert("RGB")
 
-        answer_weight = {}
-        for answer in ann["answer"]:
-            if answer in answer_weight.keys():
-                answer_weight[answer] += 1 / len(ann["answer"])
-            else:
-                answer_weight[answer] = 1 / len(ann["answer"])
-
-        answers = list(answer_weight.keys())
-        weights = list(answer_weight.values())
+        answers, weights = answer_weights(ann["answer"])
 
         # select the most frequent multiple_choice_answer in the list - ann["answer"]
         multiple_choice_answer = max(set(ann["answer"]), key=ann["answer"].count)
@@ -155,6 +139,7 @@ class COCOVQAEvalDataset(VQAEvalDataset, __DisplMixin):
         """
 
         self.vis_root = vis_root
+        self.ann_paths = ann_paths
 
         self.annotation = json.load(open(ann_paths[0]))
 
@@ -201,6 +186,7 @@ class COCOVQAEvalDataset_Raw(VQAEvalDataset, __DisplMixin):
         """
 
         self.vis_root = vis_root
+        self.ann_paths = ann_paths
 
         self.annotation = json.load(open(ann_paths[0]))
 
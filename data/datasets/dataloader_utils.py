@@ -5,10 +5,11 @@
  For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
-import time
+import collections
+import itertools
 import random
 import torch
-from data.data_utils import move_to_cuda
+from torch.utils._pytree import tree_flatten, tree_unflatten
 from torch.utils.data import DataLoader
 
 
@@ -19,9 +20,10 @@ class MultiIterLoader:
     Args:
         loaders (List[Loader]): List of Iterator loaders.
         ratios (List[float]): List of ratios to sample from each loader. If None, all loaders are sampled uniformly.
+        block_size (int): number of loader choices drawn at once.
     """
 
-    def __init__(self, loaders, ratios=None):
+    def __init__(self, loaders, ratios=None, block_size=1024):
         # assert all loaders has __next__ method
         for loader in loaders:
             assert hasattr(
@@ -35,11 +37,15 @@ class MultiIterLoader:
 
         self.loaders = loaders
         self.ratios = ratios
+        self.block_size = block_size
+        self._choices = []
 
     def __next__(self):
-        # random sample from each loader by ratio
-        loader_idx = random.choices(range(len(self.loaders)), self.ratios, k=1)[0]
-        return next(self.loaders[loader_idx])
+        # random sample from each loader by ratio, drawing a block of choices at a time
+        if not self._choices:
+            self._choices = random.choices(range(len(self.loaders)), self.ratios, k=self.block_size)
+            self._choices.reverse()
+        return next(self.loaders[self._choices.pop()])
 
 
 class PrefetchLoader(object):
@@ -48,84 +54,89 @@ class PrefetchLoader(object):
 
     overlap compute and cuda data transfer
     (copied and then modified from nvidia apex)
+
+    Args:
+        loader (DataLoader): loader yielding (nested dicts / lists / tuples of) tensors.
+        device (str or torch.device): target device, cuda if available by default. On cpu batches are passed through.
+        prefetch (int): number of batches whose copy is in flight ahead of the one being consumed.
+        dtype (torch.dtype or str): if given, floating point tensors are cast to it after the copy.
     """
 
-    def __init__(self, loader):
+    def __init__(self, loader, device=None, prefetch=2, dtype=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        if isinstance(dtype, str):
+            dtype = getattr(torch, dtype)
+        assert prefetch >= 1, "prefetch must be at least 1"
+
         self.loader = loader
-        self.stream = torch.cuda.Stream()
+        self.device = torch.device(device)
+        self.prefetch = prefetch
+        self.dtype = dtype
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
 
     def __iter__(self):
         loader_it = iter(self.loader)
-        self.preload(loader_it)
-        batch = self.next(loader_it)
-        while batch is not None:
-            is_tuple = isinstance(batch, tuple)
-            if is_tuple:
-                task, batch = batch
-
-            if is_tuple:
-                yield task, batch
-            else:
-                yield batch
-            batch = self.next(loader_it)
+        if self.stream is None:
+            for batch in loader_it:
+                yield self._unpack(self.transfer(batch)[0])
+            return
+
+        queue = collections.deque()
+        for batch in itertools.islice(loader_it, self.prefetch):
+            queue.append(self.preload(batch))
+        while queue:
+            batch, leaves, ready = queue.popleft()
+            torch.cuda.current_stream(self.device).wait_event(ready)
+            # the tensors were allocated on the side stream but are used (and freed) on the main one
+            for t in leaves:
+                t.record_stream(torch.cuda.current_stream(self.device))
+            for next_batch in itertools.islice(loader_it, 1):
+                queue.append(self.preload(next_batch))
+            yield self._unpack(batch)
 
     def __len__(self):
         return len(self.loader)
 
-    def preload(self, it):
-        try:
-            self.batch = next(it)
-        except StopIteration:
-            self.batch = None
-            return
-        # if record_stream() doesn't work, another option is to make sure
-        # device inputs are created on the main stream.
-        # self.next_input_gpu = torch.empty_like(self.next_input,
-        #                                        device='cuda')
-        # self.next_target_gpu = torch.empty_like(self.next_target,
-        #                                         device='cuda')
-        # Need to make sure the memory allocated for next_* is not still in use
-        # by the main stream at the time we start copying to next_*:
-        # self.stream.wait_stream(torch.cuda.current_stream())
-        with torch.cuda.stream(self.stream):
-            self.batch = move_to_cuda(self.batch)
-            # more code for the alternative if record_stream() doesn't work:
-            # copy_ will record the use of the pinned source tensor in this
-            # side stream.
-            # self.next_input_gpu.copy_(self.next_input, non_blocking=True)
-            # self.next_target_gpu.copy_(self.next_target, non_blocking=True)
-            # self.next_input = self.next_input_gpu
-            # self.next_target = self.next_target_gpu
-
-    def next(self, it):
-        torch.cuda.current_stream().wait_stream(self.stream)
-        batch = self.batch
-        if batch is not None and batch is not {}:
-            record_cuda_stream(batch)
-        self.preload(it)
+    @staticmethod
+    def _unpack(batch):
+        if isinstance(batch, tuple):
+            task, batch = batch
+            return task, batch
         return batch
-    
-    def __next__(self, it):
-        return self.next(it)
+
+    def transfer(self, batch):
+        """
+        Move all tensors of `batch` to the device and cast them, returns (batch, moved tensors).
+        """
+        if batch is None or (isinstance(batch, (dict, list, tuple)) and len(batch) == 0):
+            # datasets may return none samples for missing items
+            return {}, []
+        leaves, spec = tree_flatten(batch)
+        moved = []
+        for i, t in enumerate(leaves):
+            if not torch.is_tensor(t):
+                continue
+            t = t.to(self.device, non_blocking=True)
+            if self.dtype is not None and t.is_floating_point():
+                t = t.to(self.dtype)
+            leaves[i] = t
+            moved.append(t)
+        return tree_unflatten(leaves, spec), moved
+
+    def preload(self, batch):
+        # copies and casts are queued on the side stream, the event marks when they are done
+        with torch.cuda.stream(self.stream):
+            batch, leaves = self.transfer(batch)
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        return batch, leaves, ready
 
     def __getattr__(self, name):
         method = self.loader.__getattribute__(name)
         return method
 
 
-def record_cuda_stream(batch):
-    if isinstance(batch, torch.Tensor):
-        batch.record_stream(torch.cuda.current_stream())
-    elif isinstance(batch, list) or isinstance(batch, tuple):
-        for t in batch:
-            record_cuda_stream(t)
-    elif isinstance(batch, dict):
-        for t in batch.values():
-            record_cuda_stream(t)
-    else:
-        pass
-
-
 class IterLoader:
     """
     A wrapper to convert DataLoader as an infinite iterator.
@@ -151,7 +162,6 @@ class IterLoader:
             self._epoch += 1
             if hasattr(self._dataloader.sampler, "set_epoch") and self._use_distributed:
                 self._dataloader.sampler.set_epoch(self._epoch)
-            time.sleep(2)  # Prevent possible deadlock during epoch transition
             self.iter_loader = iter(self._dataloader)
             data = next(self.iter_loader)
 
@@ -58,6 +58,7 @@ class GQA_Raw(BaseDataset):
         ann_root (string): directory to store the annotation file
         """
         self.vis_root = vis_root
+        self.ann_paths = ann_paths
         self.annotation = []
         for ann_path in ann_paths:
             if any(ext in ann_path for ext in ['csv', 'tsv']):
@@ -164,6 +165,7 @@ class GQAEvalDataset(VQAEvalDataset, __DisplMixin):
         """
 
         self.vis_root = vis_root
+        self.ann_paths = ann_paths
 
         self.annotation = json.load(open(ann_paths[0]))
 
@@ -211,6 +213,7 @@ class GQAEvalDataset_Raw(VQAEvalDataset, __DisplMixin):
         """
 
         self.vis_root = vis_root
+        self.ann_paths = ann_paths
 
         loaded = json.load(open(ann_paths[0]))
         self.annotation = []
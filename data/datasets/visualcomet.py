@@ -4,7 +4,7 @@ import random
 from PIL import Image
 import torch
 
-from data.datasets.vqa_datasets import VQADataset, VQAEvalDataset
+from data.datasets.vqa_datasets import VQADataset, VQAEvalDataset, answer_weights
 from data.datasets.base_dataset import BaseDataset
 
 from collections import OrderedDict
@@ -35,12 +35,7 @@ class VisualCOMETDataset(VQADataset, __DisplMixin):
 
         question = self.text_processor(ann["question"])
 
-        answer_weight = {}
-        for answer in ann["answer"]:
-            answer_weight[answer] = answer_weight.get(answer, 0) + 1 / len(ann["answer"])
-
-        answers = list(answer_weight.keys())
-        weights = list(answer_weight.values())
+        answers, weights = answer_weights(ann["answer"])
 
         return {
             "image": image,
@@ -105,14 +100,12 @@ class VisualCOMETDataset_Raw(BaseDataset):
         
         answer_list = [" ".join(map(str, ans)) if isinstance(ans, list) else str(ans) for ans in qa["answer_choices"]]
 
-        answer_weight = {}
-        for answer in answer_list:
-            answer_weight[answer] = answer_weight.get(answer, 0) + 1 / len(answer_list)
+        answers, weights = answer_weights(answer_list)
 
         return {
             "image_raw": image_raw,
             "text_input_raw": question_str,
             "question_id": question,
-            "answers": list(answer_weight.keys()),
-            "weights": list(answer_weight.values()),
+            "answers": answers,
+            "weights": weights,
         }
\ No newline at end of file
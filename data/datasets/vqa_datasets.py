@@ -10,6 +10,17 @@ import torch
 from data.datasets.base_dataset import BaseDataset
 
 
+def answer_weights(answers):
+    """
+    Unique answers in order of first appearance, and the fraction of the answers each one makes up.
+    """
+    answer_weight = {}
+    for answer in answers:
+        answer_weight[answer] = answer_weight.get(answer, 0) + 1 / len(answers)
+
+    return list(answer_weight.keys()), list(answer_weight.values())
+
+
 class VQADataset(BaseDataset):
     def __init__(self, vis_processor, text_processor, vis_root, ann_paths):
         super().__init__(vis_processor, text_processor, vis_root, ann_paths)
@@ -6,6 +6,7 @@
 """
 
 import argparse
+import logging
 import random
 import os
 print(os.environ["CUBLAS_WORKSPACE_CONFIG"])
@@ -37,19 +38,19 @@ setup_seeds(42)
 import tasks
 from common.config import Config
 from common.logger import setup_logger
+from common.registry import registry
 from common.optims import (
     LinearWarmupCosineLRScheduler,
     LinearWarmupStepLRScheduler,
 )
 from common.utils import now
 
-# imports modules for registration
-from data.builders import *
-from models import *
+# packages list their registry entries; the modules behind them are imported when the config resolves them
+import data.builders
+import models
 from optimizer import *
-from runners import *
-from tasks import *
-from processors import *
+import runners
+import processors
 
 from runners.runner_base import RunnerBase
 
@@ -65,6 +66,11 @@ def parse_args():
         "in xxx=yyy format will be merged into config file (deprecate), "
         "change to --cfg-options instead.",
     )
+    parser.add_argument(
+        "--check-registry",
+        action="store_true",
+        help="import every registered module and check that the lazy registry listings are complete.",
+    )
 
     args = parser.parse_args()
     # if 'LOCAL_RANK' not in os.environ:
@@ -92,7 +98,8 @@ def main():
     job_id = now()
     # job_id = "0"
 
-    cfg = Config(parse_args())
+    args = parse_args()
+    cfg = Config(args)
 
     init_distributed_mode(cfg.run_cfg)
 
@@ -103,6 +110,13 @@ def main():
 
     cfg.pretty_print()
 
+    if args.check_registry:
+        problems = registry.check_lazy_listings()
+        for problem in problems:
+            logging.error(problem)
+        if problems:
+            raise RuntimeError("Lazy registry listings are out of date, see the errors above.")
+
     task = tasks.setup_task(cfg)  # vqa
     datasets = task.build_datasets(cfg)
     model = task.build_model(cfg)
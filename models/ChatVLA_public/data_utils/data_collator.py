@@ -8,7 +8,6 @@ import sys
 import torch
 
 import transformers
-import gc
 
 from PIL import Image
 import numpy as np
@@ -24,11 +23,70 @@ class DataCollatorForSupervisedDataset(object):
     multimodal_processor: transformers.AutoProcessor=None
     computed_type: torch.dtype=None
     tokenizer: transformers.AutoTokenizer=None
+    # pad to the longest sample rounded up to this multiple, truncating at model_max_length
+    pad_to_multiple_of: int=64
+    model_max_length: int=2048
+    # pack several samples into each row up to model_max_length tokens; rows carry `sample_index`
+    pack_sequences: bool=False
+
+    def _pad(self, sequences, padding_value):
+        lengths = [min(len(seq), self.model_max_length) for seq in sequences]
+        max_length = -(-max(lengths) // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        max_length = min(max_length, self.model_max_length)
+        padded = sequences[0].new_full((len(sequences), max_length), padding_value)
+        for row, (seq, length) in enumerate(zip(sequences, lengths)):
+            padded[row, :length] = seq[:length]
+        return padded
+
+    def _pack_order(self, lengths):
+        """
+        First-fit decreasing assignment of samples to rows of at most model_max_length tokens.
+
+        Returns the sample order (samples of a row are consecutive) and the number of samples per row.
+        """
+        rows, free = [], []
+        for idx in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            for row, space in enumerate(free):
+                if lengths[idx] <= space:
+                    rows[row].append(idx)
+                    free[row] -= lengths[idx]
+                    break
+            else:
+                rows.append([idx])
+                free.append(self.model_max_length - lengths[idx])
+        # keep the dataset order inside a row so image patches stay in token order
+        rows = [sorted(row) for row in rows]
+        return [idx for row in rows for idx in row], [len(row) for row in rows]
+
+    def _pack(self, input_ids, labels, row_sizes):
+        """
+        Concatenate consecutive samples into rows; `sample_index` holds the batch index of the sample
+        that owns each token and -1 on padding.
+        """
+        packed_ids, packed_labels, packed_index = [], [], []
+        start = 0
+        for size in row_sizes:
+            seqs = [seq[:self.model_max_length] for seq in input_ids[start:start + size]]
+            packed_ids.append(torch.cat(seqs))
+            packed_labels.append(torch.cat([seq[:self.model_max_length] for seq in labels[start:start + size]]))
+            packed_index.append(torch.cat([
+                torch.full((len(seq),), start + i, dtype=torch.long) for i, seq in enumerate(seqs)
+            ]))
+            start += size
+        return (self._pad(packed_ids, padding_value=self.tokenizer.pad_token_id),
+                self._pad(packed_labels, padding_value=-100),
+                self._pad(packed_index, padding_value=-1))
 
     # @profile
     def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        row_sizes = None
+        if self.pack_sequences:
+            order, row_sizes = self._pack_order([
+                min(instance['input_ids'].shape[-1], self.model_max_length) for instance in instances
+            ])
+            instances = [instances[idx] for idx in order]
+
         input_ids = [instance['input_ids'].squeeze(0) for instance in instances]
-        attention_mask = [instance['attention_mask'].squeeze(0) for instance in instances]
         labels = [instance['labels'].squeeze(0) for instance in instances]
 
         pixel_values = [instances['pixel_values'] for instances in instances if instances['pixel_values'] is not None]
@@ -36,21 +94,19 @@ class DataCollatorForSupervisedDataset(object):
         vl_data_mask = torch.concat([instances["vl_data_mask"] for instances in instances], dim=0).to(torch.bool)
         text_only_mask = torch.concat([instances["text_only_mask"] for instances in instances], dim=0).to(torch.bool)
 
-        labels = torch.nn.utils.rnn.pad_sequence(labels,batch_first=True,padding_value=-100)
-
-        input_ids = torch.nn.utils.rnn.pad_sequence(input_ids,
-                                                    batch_first=True,
-                                                    padding_value=self.tokenizer.pad_token_id)
-
-        input_ids = input_ids[:, :2048]
-        labels = labels[:, :2048]
+        sample_index = None
+        if row_sizes is not None:
+            input_ids, labels, sample_index = self._pack(input_ids, labels, row_sizes)
+        else:
+            labels = self._pad(labels, padding_value=-100)
+            input_ids = self._pad(input_ids, padding_value=self.tokenizer.pad_token_id)
 
         if len(pixel_values) > 0:
+            # one allocation for the patches of all images, in sample order
             pixel_values = torch.concat(pixel_values, dim=0)
             image_grid_thw = torch.concat(image_grid_thw, dim=0)
 
-
-        attention_mask = input_ids.ne(self.tokenizer.pad_token_id),
+        attention_mask = input_ids.ne(self.tokenizer.pad_token_id)
 
         if not isinstance(instances[0]['action'], torch.Tensor):
             actions = torch.tensor(np.array([instance['action'] for instance in instances]))
@@ -61,9 +117,10 @@ class DataCollatorForSupervisedDataset(object):
 
         is_pad_all = torch.stack([instance['is_pad'] for instance in instances])
 
+        # no gc.collect() / torch.cuda.empty_cache() here: this runs in dataloader workers
         batch = dict(
             input_ids=input_ids,
-            attention_mask=attention_mask[0],
+            attention_mask=attention_mask,
             labels=labels,
             image_grid_thw=image_grid_thw,
             actions=actions,
@@ -73,20 +130,6 @@ class DataCollatorForSupervisedDataset(object):
             vl_data_mask=vl_data_mask,
             text_only_mask=text_only_mask,
         )
-
-
-        del input_ids
-        del attention_mask
-        del labels
-        del pixel_values
-        del actions
-        del states
-        del image_grid_thw
-        del is_pad_all
-        del vl_data_mask
-        del text_only_mask
-        gc.collect()
-        torch.cuda.empty_cache()
+        if sample_index is not None:
+            batch['sample_index'] = sample_index
         return batch
-
-
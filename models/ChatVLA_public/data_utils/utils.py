@@ -112,6 +112,8 @@ class EpisodicDataset(torch.utils.data.Dataset):
             vl_data_list = None
         self.vl_data_list = vl_data_list
         self.vl_image_dir = vl_image_dir
+        self._build_episode_index()
+        self._modality_lengths = None
 
 
 
@@ -132,22 +134,34 @@ class EpisodicDataset(torch.utils.data.Dataset):
     def __len__(self):
         return sum(self.episode_len)
 
+    def _build_episode_index(self):
+        # int arrays over episodes (the vl data counts as one extra episode) for O(log n) lookups
+        self.cumulative_len = np.asarray(self.cumulative_len, dtype=np.int64)
+        self.episode_start = self.cumulative_len - np.asarray(self.episode_len, dtype=np.int64)
+        self.episode_ids = np.asarray(self.episode_ids, dtype=np.int64)
+
     @property
     def modality_lengths(self):
         # TODO
         # explain: 3 view (two external 240 * 320, one wrist, 56 * 56), equals to 200 image token, we suppose max 100 tokens for text
-        length_list = [300] * self.cumulative_len[-2]
-        # compute vl sample length
-        for sample in self.vl_data_list:
-            cur_len = sum(len(conv['value'].split()) for conv in sample["conversations"])
-            cur_len += 100  # plus the number of image tokens (suppose to 100)
-            length_list.append(-cur_len)  # vl data length set to -cur_len
-        return length_list
+        if self._modality_lengths is None:
+            num_robot = self.cumulative_len[-2] if self.vl_data_list is not None else self.cumulative_len[-1]
+            robot_lengths = np.full(num_robot, 300, dtype=np.int64)
+            # compute vl sample length, plus the number of image tokens (suppose to 100)
+            vl_lengths = np.fromiter(
+                (sum(len(conv['value'].split()) for conv in sample["conversations"]) + 100
+                 for sample in self.vl_data_list or []),
+                dtype=np.int64,
+            )
+            # vl data length set to -cur_len
+            self._modality_lengths = np.concatenate([robot_lengths, -vl_lengths]).tolist()
+        # a copy, so callers that reorder or edit the list cannot corrupt the cache
+        return list(self._modality_lengths)
 
     def _locate_transition(self, index):
         assert index < self.cumulative_len[-1]
-        episode_index = np.argmax(self.cumulative_len > index)  # argmax returns first True index
-        start_ts = index - (self.cumulative_len[episode_index] - self.episode_len[episode_index])
+        episode_index = np.searchsorted(self.cumulative_len, index, side='right')  # first episode ending after index
+        start_ts = index - self.episode_start[episode_index]
         episode_id = self.episode_ids[episode_index]
         return episode_id, start_ts
 
@@ -539,18 +553,6 @@ def find_all_hdf5(dataset_dir, skip_mirrored_data):
     return hdf5_files
 
 
-def BatchSampler(batch_size, episode_len_l, sample_weights):
-    sample_probs = np.array(sample_weights) / np.sum(sample_weights) if sample_weights is not None else None
-    sum_dataset_len_l = np.cumsum([0] + [np.sum(episode_len) for episode_len in episode_len_l])
-    while True:
-        batch = []
-        for _ in range(batch_size):
-            episode_idx = np.random.choice(len(episode_len_l), p=sample_probs)
-            step_idx = np.random.randint(sum_dataset_len_l[episode_idx], sum_dataset_len_l[episode_idx + 1])
-            batch.append(step_idx)
-        yield batch
-
-
 def load_data(dataset_dir_l, name_filter, camera_names,  chunk_size, config,
               skip_mirrored_data=False, stats_dir_l=None, policy_head_type=None,
               llava_pythia_process=None, vl_file=None, vl_image_dir=None, template_path=None, vl_ratio=0, is_local_debug=False):
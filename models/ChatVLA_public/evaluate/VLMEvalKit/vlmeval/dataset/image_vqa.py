@@ -8,7 +8,7 @@ from tqdm import tqdm
 from .image_base import ImageBaseDataset
 from .utils import build_judge, DEBUG_MESSAGE
 from ..smp import *
-from ..utils import track_progress_rich
+from ..utils import cached_track_progress, cached_pool_map
 
 
 
@@ -47,7 +47,7 @@ class ImageVQADataset(ImageBaseDataset):
 
     # It returns a DataFrame
     def evaluate(self, eval_file, **judge_kwargs):
-        from .utils.vqa_eval import hit_calculate, process_line
+        from .utils.vqa_eval import hit_calculate, process_lines
 
         data = load(eval_file)
         dataset = self.dataset_name
@@ -55,18 +55,18 @@ class ImageVQADataset(ImageBaseDataset):
         data['prediction'] = [str(x) for x in data['prediction']]
         data['answer'] = [str(x) for x in data['answer']]
         lt = len(data)
-        pool = mp.Pool(16)
         lines = [data.iloc[i] for i in range(lt)]
+        keys = [(line['answer'], line['prediction']) for line in lines]
         if listinstr(['TextVQA'], dataset):
-            res = pool.map(partial(process_line, method='vqa_score'), lines)
+            res = cached_pool_map(partial(process_lines, method='vqa_score'), lines, keys, batched=True)
         elif listinstr(['ChartQA'], dataset):
-            res = pool.map(partial(process_line, method='relaxed_accuracy'), lines)
+            res = cached_pool_map(partial(process_lines, method='relaxed_accuracy'), lines, keys, batched=True)
         elif listinstr(['OCRVQA', 'GQA'], dataset):
-            res = pool.map(partial(process_line, method='accuracy'), lines)
+            res = cached_pool_map(partial(process_lines, method='accuracy'), lines, keys, batched=True)
         elif listinstr(['DocVQA', 'InfoVQA'], dataset):
-            res = pool.map(partial(process_line, method='anls'), lines)
+            res = cached_pool_map(partial(process_lines, method='anls'), lines, keys, batched=True)
         else:  # default using vqa_score to calculate score
-            res = pool.map(process_line, lines)
+            res = cached_pool_map(process_lines, lines, keys, batched=True)
         hit = hit_calculate(res, dataset)
         ret = dict()
         if 'split' in data:
@@ -109,7 +109,7 @@ class VizWiz(ImageBaseDataset):
 
     @classmethod
     def evaluate(self, eval_file, **judge_kwargs):
-        from .utils.vqa_eval import hit_calculate, process_line
+        from .utils.vqa_eval import hit_calculate, process_lines
 
         suffix = eval_file.split('.')[-1]
         result_file = eval_file.replace(f'.{suffix}', '_acc.csv')
@@ -121,9 +121,9 @@ class VizWiz(ImageBaseDataset):
             data['answer'] = [str(x) for x in data['answers']]
 
             lt = len(data)
-            pool = mp.Pool(16)
             lines = [data.iloc[i] for i in range(lt)]
-            res = pool.map(process_line, lines)
+            keys = [(line['answer'], line['prediction']) for line in lines]
+            res = cached_pool_map(process_lines, lines, keys, batched=True)
 
             hit = hit_calculate(res, 'VizWiz')
             ret = dict()
@@ -238,9 +238,11 @@ class MathVista(ImageBaseDataset):
             indices = [i for i in indices if i not in ans]
 
             if len(indices):
-                new_results = track_progress_rich(
+                new_results = cached_track_progress(
                     MathVista_auxeval,
                     tups,
+                    [line for _, line in tups],
+                    judge=model,
                     nproc=nproc,
                     chunksize=nproc,
                     keys=indices,
@@ -309,9 +311,11 @@ class MathVerse(ImageBaseDataset):
             indices = [i for i in indices if i not in ans]
 
             if len(indices):
-                new_results = track_progress_rich(
+                new_results = cached_track_progress(
                     MathVerse_auxeval_extract,
                     tups,
+                    [line for _, line in tups],
+                    judge=model,
                     nproc=nproc,
                     chunksize=nproc,
                     keys=indices,
@@ -343,9 +347,11 @@ class MathVerse(ImageBaseDataset):
             indices = [i for i in indices if i not in ans]
 
             if len(indices):
-                new_results = track_progress_rich(
+                new_results = cached_track_progress(
                     MathVerse_auxeval_score,
                     tups,
+                    [line for _, line in tups],
+                    judge=model,
                     nproc=nproc,
                     chunksize=nproc,
                     keys=indices,
@@ -407,9 +413,11 @@ class MathVision(ImageBaseDataset):
             indices = [i for i in indices if i not in ans]
 
             if len(indices):
-                new_results = track_progress_rich(
+                new_results = cached_track_progress(
                     MATH_V_auxeval,
                     tups,
+                    [line for _, line in tups],
+                    judge=model,
                     nproc=nproc,
                     chunksize=nproc,
                     keys=indices,
@@ -672,7 +680,8 @@ class LLaVABench(ImageBaseDataset):
 
             prompts = [build_prompt(line) for line in lines]
             tups = [(model, prompt) for prompt in prompts]
-            scores = track_progress_rich(LLaVABench_atomeval, tups, nproc=nproc, chunksize=nproc)
+            scores = cached_track_progress(
+                LLaVABench_atomeval, tups, prompts, judge=model, nproc=nproc, chunksize=nproc)
             data['gpt4_score'] = [x[0] for x in scores]
             data['score'] = [x[1] for x in scores]
             dump(data, record_file)
@@ -715,9 +724,11 @@ class MMVet(ImageBaseDataset):
             indices = [i for i in indices if i not in ans]
 
             if len(indices):
-                new_results = track_progress_rich(
+                new_results = cached_track_progress(
                     MMVet_auxeval,
                     tups,
+                    [line for _, line in tups],
+                    judge=model,
                     nproc=nproc,
                     chunksize=nproc,
                     keys=indices,
@@ -1087,9 +1098,11 @@ class QSpatial(ImageBaseDataset):
                 indices = [i for i in indices if i not in ans]
 
                 if len(indices):
-                    new_results = track_progress_rich(
+                    new_results = cached_track_progress(
                         QSpatial_auxeval,
                         tups,
+                        [line for _, line in tups],
+                        judge=model,
                         nproc=nproc,
                         chunksize=nproc,
                         keys=indices,
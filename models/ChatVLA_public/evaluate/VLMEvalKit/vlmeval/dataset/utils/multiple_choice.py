@@ -1,5 +1,5 @@
 import pandas as pd
-from ...utils import can_infer, track_progress_rich
+from ...utils import can_infer, cached_track_progress
 from ...smp import *
 import numpy as np
 import re
@@ -357,7 +357,15 @@ def mcq_vanilla_eval(model, data, meta, nproc, result_file, dataset_name=None):
     tups = [dict(model=model, item=x, dataset_name=dataset_name) for x in items]
     keys = [x['index'] for x in items]
     if len(tups):
-        res = track_progress_rich(eval_vanilla, tups, nproc=nproc, chunksize=nproc, save=result_file, keys=keys)
+        res = cached_track_progress(
+            eval_vanilla,
+            tups,
+            [(x, dataset_name) for x in items],
+            judge=model,
+            nproc=nproc,
+            chunksize=nproc,
+            save=result_file,
+            keys=keys)
         result = load(result_file)
         for k, v in zip(keys, res):
             if k not in result:
@@ -415,9 +423,11 @@ def mcq_circular_eval(model, data, meta, nproc, result_file, dataset_name=None):
                 result[k] = dict(
                     hit=0, log='Failed in Prefetch, no GPT-based answer matching under `exact_matching` policy.')
         else:
-            res = track_progress_rich(
+            res = cached_track_progress(
                 eval_circular_group,
                 tups,
+                [(x, dataset_name) for x in remain],
+                judge=model,
                 nproc=nproc,
                 chunksize=nproc,
                 save=result_file,
@@ -3,158 +3,155 @@
 # Copyright (c) 2014, Aishwarya Agrawal
 
 from ...smp import *
+from functools import lru_cache
 from typing import Optional
 
 
+ARTICLES = {'a', 'an', 'the'}
+MANUAL_MAP = {
+    'none': '0',
+    'zero': '0',
+    'one': '1',
+    'two': '2',
+    'three': '3',
+    'four': '4',
+    'five': '5',
+    'six': '6',
+    'seven': '7',
+    'eight': '8',
+    'nine': '9',
+    'ten': '10',
+}
+CONTRACTIONS = {
+    'aint': "ain't",
+    'arent': "aren't",
+    'cant': "can't",
+    'couldve': "could've",
+    'couldnt': "couldn't",
+    "couldn'tve": "couldn't've",
+    "couldnt've": "couldn't've",
+    'didnt': "didn't",
+    'doesnt': "doesn't",
+    'dont': "don't",
+    'hadnt': "hadn't",
+    "hadnt've": "hadn't've",
+    "hadn'tve": "hadn't've",
+    'hasnt': "hasn't",
+    'havent': "haven't",
+    'hed': "he'd",
+    "hed've": "he'd've",
+    "he'dve": "he'd've",
+    'hes': "he's",
+    'howd': "how'd",
+    'howll': "how'll",
+    'hows': "how's",
+    "Id've": "I'd've",
+    "I'dve": "I'd've",
+    'Im': "I'm",
+    'Ive': "I've",
+    'isnt': "isn't",
+    'itd': "it'd",
+    "itd've": "it'd've",
+    "it'dve": "it'd've",
+    'itll': "it'll",
+    "let's": "let's",
+    'maam': "ma'am",
+    'mightnt': "mightn't",
+    "mightnt've": "mightn't've",
+    "mightn'tve": "mightn't've",
+    'mightve': "might've",
+    'mustnt': "mustn't",
+    'mustve': "must've",
+    'neednt': "needn't",
+    'notve': "not've",
+    'oclock': "o'clock",
+    'oughtnt': "oughtn't",
+    "ow's'at": "'ow's'at",
+    "'ows'at": "'ow's'at",
+    "'ow'sat": "'ow's'at",
+    'shant': "shan't",
+    "shed've": "she'd've",
+    "she'dve": "she'd've",
+    "she's": "she's",
+    'shouldve': "should've",
+    'shouldnt': "shouldn't",
+    "shouldnt've": "shouldn't've",
+    "shouldn'tve": "shouldn't've",
+    "somebody'd": 'somebodyd',
+    "somebodyd've": "somebody'd've",
+    "somebody'dve": "somebody'd've",
+    'somebodyll': "somebody'll",
+    'somebodys': "somebody's",
+    'someoned': "someone'd",
+    "someoned've": "someone'd've",
+    "someone'dve": "someone'd've",
+    'someonell': "someone'll",
+    'someones': "someone's",
+    'somethingd': "something'd",
+    "somethingd've": "something'd've",
+    "something'dve": "something'd've",
+    'somethingll': "something'll",
+    'thats': "that's",
+    'thered': "there'd",
+    "thered've": "there'd've",
+    "there'dve": "there'd've",
+    'therere': "there're",
+    'theres': "there's",
+    'theyd': "they'd",
+    "theyd've": "they'd've",
+    "they'dve": "they'd've",
+    'theyll': "they'll",
+    'theyre': "they're",
+    'theyve': "they've",
+    'twas': "'twas",
+    'wasnt': "wasn't",
+    "wed've": "we'd've",
+    "we'dve": "we'd've",
+    'weve': "we've",
+    'werent': "weren't",
+    'whatll': "what'll",
+    'whatre': "what're",
+    'whats': "what's",
+    'whatve': "what've",
+    'whens': "when's",
+    'whered': "where'd",
+    'wheres': "where's",
+    'whereve': "where've",
+    'whod': "who'd",
+    "whod've": "who'd've",
+    "who'dve": "who'd've",
+    'wholl': "who'll",
+    'whos': "who's",
+    'whove': "who've",
+    'whyll': "why'll",
+    'whyre': "why're",
+    'whys': "why's",
+    'wont': "won't",
+    'wouldve': "would've",
+    'wouldnt': "wouldn't",
+    "wouldnt've": "wouldn't've",
+    "wouldn'tve": "wouldn't've",
+    'yall': "y'all",
+    "yall'll": "y'all'll",
+    "y'allll": "y'all'll",
+    "yall'd've": "y'all'd've",
+    "y'alld've": "y'all'd've",
+    "y'all'dve": "y'all'd've",
+    'youd': "you'd",
+    "youd've": "you'd've",
+    "you'dve": "you'd've",
+    'youll': "you'll",
+    'youre': "you're",
+    'youve': "you've",
+}
+
 def _process_digit_article(inText):
     outText = []
-    tempText = inText.lower().split()
-    articles = ['a', 'an', 'the']
-    manualMap = {
-        'none': '0',
-        'zero': '0',
-        'one': '1',
-        'two': '2',
-        'three': '3',
-        'four': '4',
-        'five': '5',
-        'six': '6',
-        'seven': '7',
-        'eight': '8',
-        'nine': '9',
-        'ten': '10',
-    }
-    contractions = {
-        'aint': "ain't",
-        'arent': "aren't",
-        'cant': "can't",
-        'couldve': "could've",
-        'couldnt': "couldn't",
-        "couldn'tve": "couldn't've",
-        "couldnt've": "couldn't've",
-        'didnt': "didn't",
-        'doesnt': "doesn't",
-        'dont': "don't",
-        'hadnt': "hadn't",
-        "hadnt've": "hadn't've",
-        "hadn'tve": "hadn't've",
-        'hasnt': "hasn't",
-        'havent': "haven't",
-        'hed': "he'd",
-        "hed've": "he'd've",
-        "he'dve": "he'd've",
-        'hes': "he's",
-        'howd': "how'd",
-        'howll': "how'll",
-        'hows': "how's",
-        "Id've": "I'd've",
-        "I'dve": "I'd've",
-        'Im': "I'm",
-        'Ive': "I've",
-        'isnt': "isn't",
-        'itd': "it'd",
-        "itd've": "it'd've",
-        "it'dve": "it'd've",
-        'itll': "it'll",
-        "let's": "let's",
-        'maam': "ma'am",
-        'mightnt': "mightn't",
-        "mightnt've": "mightn't've",
-        "mightn'tve": "mightn't've",
-        'mightve': "might've",
-        'mustnt': "mustn't",
-        'mustve': "must've",
-        'neednt': "needn't",
-        'notve': "not've",
-        'oclock': "o'clock",
-        'oughtnt': "oughtn't",
-        "ow's'at": "'ow's'at",
-        "'ows'at": "'ow's'at",
-        "'ow'sat": "'ow's'at",
-        'shant': "shan't",
-        "shed've": "she'd've",
-        "she'dve": "she'd've",
-        "she's": "she's",
-        'shouldve': "should've",
-        'shouldnt': "shouldn't",
-        "shouldnt've": "shouldn't've",
-        "shouldn'tve": "shouldn't've",
-        "somebody'd": 'somebodyd',
-        "somebodyd've": "somebody'd've",
-        "somebody'dve": "somebody'd've",
-        'somebodyll': "somebody'll",
-        'somebodys': "somebody's",
-        'someoned': "someone'd",
-        "someoned've": "someone'd've",
-        "someone'dve": "someone'd've",
-        'someonell': "someone'll",
-        'someones': "someone's",
-        'somethingd': "something'd",
-        "somethingd've": "something'd've",
-        "something'dve": "something'd've",
-        'somethingll': "something'll",
-        'thats': "that's",
-        'thered': "there'd",
-        "thered've": "there'd've",
-        "there'dve": "there'd've",
-        'therere': "there're",
-        'theres': "there's",
-        'theyd': "they'd",
-        "theyd've": "they'd've",
-        "they'dve": "they'd've",
-        'theyll': "they'll",
-        'theyre': "they're",
-        'theyve': "they've",
-        'twas': "'twas",
-        'wasnt': "wasn't",
-        "wed've": "we'd've",
-        "we'dve": "we'd've",
-        'weve': "we've",
-        'werent': "weren't",
-        'whatll': "what'll",
-        'whatre': "what're",
-        'whats': "what's",
-        'whatve': "what've",
-        'whens': "when's",
-        'whered': "where'd",
-        'wheres': "where's",
-        'whereve': "where've",
-        'whod': "who'd",
-        "whod've": "who'd've",
-        "who'dve": "who'd've",
-        'wholl': "who'll",
-        'whos': "who's",
-        'whove': "who've",
-        'whyll': "why'll",
-        'whyre': "why're",
-        'whys': "why's",
-        'wont': "won't",
-        'wouldve': "would've",
-        'wouldnt': "wouldn't",
-        "wouldnt've": "wouldn't've",
-        "wouldn'tve": "wouldn't've",
-        'yall': "y'all",
-        "yall'll": "y'all'll",
-        "y'allll": "y'all'll",
-        "yall'd've": "y'all'd've",
-        "y'alld've": "y'all'd've",
-        "y'all'dve": "y'all'd've",
-        'youd': "you'd",
-        "youd've": "you'd've",
-        "you'dve": "you'd've",
-        'youll': "you'll",
-        'youre': "you're",
-        'youve': "you've",
-    }
-    for word in tempText:
-        word = manualMap.setdefault(word, word)
-        if word not in articles:
-            outText.append(word)
-    for wordId, word in enumerate(outText):
-        if word in contractions:
-            outText[wordId] = contractions[word]
-    outText = ' '.join(outText)
-    return outText
+    for word in inText.lower().split():
+        word = MANUAL_MAP.get(word, word)
+        if word not in ARTICLES:
+            outText.append(CONTRACTIONS.get(word, word))
+    return ' '.join(outText)
 
 
 def hit_calculate(result, dataset_name, anls_threshold=0.5):
@@ -212,19 +209,38 @@ def relaxed_correctness(target: str,
 
 
 def levenshtein_distance(s1, s2):
+    """Edit distance with the bit-parallel algorithm of Myers / Hyyrö.
+
+    The shorter string is encoded as bit vectors (Python ints have no width limit), so each character of the
+    longer one costs a handful of integer operations instead of a row of the O(len1 * len2) table.
+    """
     if len(s1) > len(s2):
         s1, s2 = s2, s1
+    m = len(s1)
+    if m == 0:
+        return len(s2)
 
-    distances = range(len(s1) + 1)
-    for i2, c2 in enumerate(s2):
-        distances_ = [i2 + 1]
-        for i1, c1 in enumerate(s1):
-            if c1 == c2:
-                distances_.append(distances[i1])
-            else:
-                distances_.append(1 + min((distances[i1], distances[i1 + 1], distances_[-1])))
-        distances = distances_
-    return distances[-1]
+    peq = {}
+    for i, c in enumerate(s1):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    mask = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv, mv, dist = mask, 0, m
+    for c in s2:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & last:
+            dist += 1
+        elif mh & last:
+            dist -= 1
+        ph = (ph << 1) | 1
+        mh <<= 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+    return dist
 
 
 def anls_compute(groundtruth, prediction):
@@ -236,6 +252,7 @@ def anls_compute(groundtruth, prediction):
     return values
 
 
+@lru_cache(maxsize=1 << 16)
 def process_answer(answer):
     answer = answer.replace('\n', ' ')
     answer = answer.replace('\t', ' ')
@@ -254,17 +271,9 @@ def process_line(line, method='vqa_score'):
     if method == 'vqa_score':
         ret['gt'] = [process_answer(x) for x in answers]
         ret['pred'] = process_answer(line['prediction'])
-        ret['match'] = []
-        for current_idx, gtAnsDatum in enumerate(ret['gt']):
-            otherGTAns = [
-                item for ret_gt_idx, item in enumerate(ret['gt'])
-                if ret_gt_idx != current_idx
-            ]
-            matchingAns = [
-                item for item in otherGTAns if item == ret['pred']
-            ]
-            acc = min(1, float(len(matchingAns)) / 3)
-            ret['match'].append(acc)
+        # each answer is scored against the other annotators: min(1, #others equal to pred / 3)
+        n_equal = ret['gt'].count(ret['pred'])
+        ret['match'] = [min(1, float(n_equal - (x == ret['pred'])) / 3) for x in ret['gt']]
     elif method == 'anls':
         ret['gt'] = answers
         ret['pred'] = line['prediction']
@@ -283,3 +292,19 @@ def process_line(line, method='vqa_score'):
         ret['match'] = [x == ret['pred'] for x in ret['gt']]
 
     return ret
+
+
+def process_lines(lines, method='vqa_score'):
+    """``process_line`` over a whole split in one process.
+
+    Rows with the same answer and prediction are scored once and normalized strings are memoized, so a
+    split is scored in seconds without a process pool.
+    """
+    scored = {}
+    ret = []
+    for line in lines:
+        key = (line['answer'], line['prediction'])
+        if key not in scored:
+            scored[key] = process_line(line, method=method)
+        ret.append(dict(scored[key]))
+    return ret
@@ -2,6 +2,7 @@
 
 import os
 import os.path as osp
+import re
 from pathlib import Path
 
 import subprocess
@@ -19,22 +20,26 @@ def modelscope_flag_set():
     return os.environ.get('VLMEVALKIT_USE_MODELSCOPE', None) in ['1', 'True']
 
 
+_PUNCT = [
+    ';', r'/', '[', ']', '"', '{', '}', '(', ')', '=', '+', '\\', '_', '-',
+    '>', '<', '@', '`', ',', '?', '!'
+]
+_COMMA_STRIP = re.compile('(\d)(,)(\d)')  # noqa: W605
+_PERIOD_STRIP = re.compile('(?!<=\d)(\.)(?!\d)')  # noqa: W605
+
+
 def process_punctuation(inText):
-    import re
     outText = inText
-    punct = [
-        ';', r'/', '[', ']', '"', '{', '}', '(', ')', '=', '+', '\\', '_', '-',
-        '>', '<', '@', '`', ',', '?', '!'
-    ]
-    commaStrip = re.compile('(\d)(,)(\d)')  # noqa: W605
-    periodStrip = re.compile('(?!<=\d)(\.)(?!\d)')  # noqa: W605
-    for p in punct:
-        if (p + ' ' in inText or ' ' + p in inText) or (re.search(
-                commaStrip, inText) is not None):
+    comma = _COMMA_STRIP.search(inText) is not None
+    for p in _PUNCT:
+        if p not in outText:
+            continue
+        if comma or (p + ' ' in inText or ' ' + p in inText):
             outText = outText.replace(p, '')
         else:
             outText = outText.replace(p, ' ')
-    outText = periodStrip.sub('', outText, re.UNICODE)
+    # re.UNICODE lands in the count argument, kept as is so scores stay comparable
+    outText = _PERIOD_STRIP.sub('', outText, re.UNICODE)
     return outText
 
 def h2r(value):
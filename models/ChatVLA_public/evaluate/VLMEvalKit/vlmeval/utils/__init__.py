@@ -1,7 +1,9 @@
 from .matching_util import can_infer, can_infer_option, can_infer_text
-from .mp_util import track_progress_rich
+from .mp_util import track_progress_rich, get_process_pool, pool_map, pool_map_batched
+from .judge_cache import JudgeCache, get_judge_cache, cached_track_progress, cached_pool_map
 
 
 __all__ = [
-    'can_infer', 'can_infer_option', 'can_infer_text', 'track_progress_rich',
+    'can_infer', 'can_infer_option', 'can_infer_text', 'track_progress_rich', 'get_process_pool', 'pool_map', 'pool_map_batched',
+    'JudgeCache', 'get_judge_cache', 'cached_track_progress', 'cached_pool_map',
 ]
@@ -0,0 +1,208 @@
+import hashlib
+import inspect
+import json
+import os
+import os.path as osp
+import pickle
+import sqlite3
+import sys
+import threading
+from functools import lru_cache, partial
+
+import numpy as np
+import pandas as pd
+
+from ..smp import load, dump, LMUDataRoot
+from .mp_util import track_progress_rich, pool_map, pool_map_batched
+
+# judge outputs that record a failed call rather than a verdict are never cached
+FAIL_MARKERS = ('Failed to obtain answer via API', 'retries failed', 'Failed to predict')
+# columns that do not reach the judge prompt (images are large and only the text is judged)
+SKIP_FIELDS = ('index', 'image', 'image_path')
+
+
+def _plain(obj):
+    if isinstance(obj, pd.DataFrame):
+        return [_plain(obj.iloc[i]) for i in range(len(obj))]
+    if isinstance(obj, pd.Series):
+        obj = obj.to_dict()
+    if isinstance(obj, dict):
+        return {str(k): _plain(v) for k, v in obj.items() if k not in SKIP_FIELDS}
+    if isinstance(obj, (list, tuple)):
+        return [_plain(x) for x in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def content_key(*parts):
+    """Hash of question / prediction / reference content; pandas rows drop their index and image."""
+    payload = json.dumps(_plain(parts), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def judge_id(model):
+    """Everything about the judge that changes its verdicts, ``exact_matching`` for no judge."""
+    if model is None:
+        return 'exact_matching'
+    fields = dict(
+        model=getattr(model, 'model', type(model).__name__),
+        temperature=getattr(model, 'temperature', None),
+        max_tokens=getattr(model, 'max_tokens', None),
+        system_prompt=getattr(model, 'system_prompt', None),
+        kwargs=getattr(model, 'default_kwargs', None),
+    )
+    return json.dumps(fields, sort_keys=True, default=str)
+
+
+@lru_cache(maxsize=None)
+def _module_version(module_name):
+    try:
+        source = inspect.getsource(sys.modules[module_name])
+    except (KeyError, OSError, TypeError):
+        source = module_name
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+
+
+def prompt_version(func):
+    """Identifies the scoring function and the prompts it builds; editing its module invalidates old entries."""
+    keywords = {}
+    while isinstance(func, partial):
+        keywords.update(func.keywords)
+        func = func.func
+    version = f'{func.__module__}.{func.__qualname__}@{_module_version(func.__module__)}'
+    if keywords:
+        version += json.dumps(keywords, sort_keys=True, default=str)
+    return version
+
+
+def is_cacheable(value):
+    return not any(m in str(value) for m in FAIL_MARKERS)
+
+
+class JudgeCache:
+    """Judge and scoring results keyed by content hash, in a SQLite file shared by runs and processes.
+
+    The database runs in WAL mode, so concurrent evaluators read without blocking and writers queue on the
+    busy timeout instead of failing. Each thread and each forked process opens its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS judge (key TEXT PRIMARY KEY, value BLOB)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get_many(self, keys):
+        conn = self._connect()
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        # stay under the SQLite host parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = conn.execute(
+                f'SELECT key, value FROM judge WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+            found.update({k: pickle.loads(v) for k, v in rows})
+        return found
+
+    def put_many(self, items):
+        items = [(k, pickle.dumps(v)) for k, v in items]
+        if not len(items):
+            return
+        conn = self._connect()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO judge (key, value) VALUES (?, ?)', items)
+
+
+_judge_cache = None
+_judge_cache_lock = threading.Lock()
+
+
+def get_judge_cache():
+    """The shared cache at ``$VLMEVAL_JUDGE_CACHE`` (default ``<LMUData>/judge_cache.db``), None if set to 0."""
+    global _judge_cache
+    path = os.environ.get('VLMEVAL_JUDGE_CACHE', None)
+    if path in ['0', 'False', 'false']:
+        return None
+    path = path or osp.join(LMUDataRoot(), 'judge_cache.db')
+    with _judge_cache_lock:
+        if _judge_cache is None or _judge_cache.path != path:
+            _judge_cache = JudgeCache(path)
+        return _judge_cache
+
+
+def cached_track_progress(func, tasks, cache_keys, judge=None, save=None, keys=None, **kwargs):
+    """``track_progress_rich`` that answers from the judge cache first.
+
+    ``cache_keys`` holds the judged content of each task (e.g. the data row). Only misses reach ``func``;
+    hits are written to ``save`` under their ``keys`` as if they had been computed, so callers that read
+    back ``save`` are unchanged.
+    """
+    cache = get_judge_cache()
+    if cache is None:
+        return track_progress_rich(func, tasks, save=save, keys=keys, **kwargs)
+
+    tasks = list(tasks)
+    assert len(cache_keys) == len(tasks)
+    prefix = (judge_id(judge), prompt_version(func))
+    hashes = [content_key(prefix, k) for k in cache_keys]
+    hits = cache.get_many(hashes)
+    todo = [i for i, h in enumerate(hashes) if h not in hits]
+    results = [hits.get(h) for h in hashes]
+
+    if len(todo):
+        new_results = track_progress_rich(
+            func,
+            [tasks[i] for i in todo],
+            save=save,
+            keys=[keys[i] for i in todo] if keys is not None else None,
+            **kwargs)
+        for i, v in zip(todo, new_results):
+            results[i] = v
+        cache.put_many([(hashes[i], v) for i, v in zip(todo, new_results) if is_cacheable(v)])
+
+    if save is not None and keys is not None and len(todo) < len(tasks):
+        computed = set(todo)
+        res = load(save) if osp.exists(save) else {}
+        res.update({keys[i]: results[i] for i in range(len(tasks)) if i not in computed})
+        dump(res, save)
+    return results
+
+
+def cached_pool_map(func, items, cache_keys, nproc=16, batched=False):
+    """``pool_map`` for rule-based scoring that only scores items missing from the judge cache.
+
+    With ``batched``, ``func`` takes a list of items: the missing items are split into one chunk per worker
+    of the shared pool (see ``pool_map_batched``).
+    """
+    cache = get_judge_cache()
+    if cache is None:
+        return pool_map_batched(func, items, nproc=nproc) if batched else pool_map(func, items, nproc=nproc)
+
+    items = list(items)
+    assert len(cache_keys) == len(items)
+    prefix = ('rule', prompt_version(func))
+    hashes = [content_key(prefix, k) for k in cache_keys]
+    hits = cache.get_many(hashes)
+    todo = [i for i, h in enumerate(hashes) if h not in hits]
+    results = [hits.get(h) for h in hashes]
+    if len(todo):
+        todo_items = [items[i] for i in todo]
+        if batched:
+            new_results = pool_map_batched(func, todo_items, nproc=nproc)
+        else:
+            new_results = pool_map(func, todo_items, nproc=nproc)
+        for i, v in zip(todo, new_results):
+            results[i] = v
+        cache.put_many([(hashes[i], v) for i, v in zip(todo, new_results)])
+    return results
@@ -1,27 +1,73 @@
 
 from typing import Callable, Iterable
 
-
+import atexit
+import os
 import os.path as osp
+import pickle
+import random
+import threading
+import time
 
 from ..smp import load, dump
 
 
+def _journal_path(save):
+    return save + '.journal'
+
+
+def _read_journal(path):
+    # records of an interrupted run; a torn last record is dropped
+    records = {}
+    if not osp.exists(path):
+        return records
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                key, value = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                break
+            records[key] = value
+    return records
+
+
+def _call_with_retry(func, args, kwargs, max_retries, retry_delay):
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            if attempt == max_retries:
+                raise
+            # exponential backoff with jitter, this also holds back the worker slot
+            time.sleep(retry_delay * (2 ** attempt) * (0.5 + random.random()))
+
+
 def track_progress_rich(
         func: Callable,
         tasks: Iterable = tuple(),
         nproc: int = 1,
         save=None,
         keys=None,
+        max_inflight=None,
+        max_retries=0,
+        retry_delay=1.0,
+        rate_limit=None,
         **kwargs) -> list:
+    """Run ``func`` over ``tasks`` in a thread pool and return the results in task order.
 
-    from concurrent.futures import ThreadPoolExecutor
+    At most ``max_inflight`` (default ``2 * nproc``) tasks are submitted at a time and tasks are consumed
+    lazily, so long benchmarks keep a flat memory footprint. Results are handled as they complete: with
+    ``save`` and ``keys`` each one is appended to ``<save>.journal``, which is folded into ``save`` at the
+    end. Keys found in the journal of an interrupted run are not recomputed. ``rate_limit`` caps task
+    starts per second and failing calls are retried ``max_retries`` times with exponential backoff.
+    """
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
     from tqdm import tqdm
     if save is not None:
         assert osp.exists(osp.dirname(save)) or osp.dirname(save) == ''
         if not osp.exists(save):
             dump({}, save)
-    if keys is not None:
+    if keys is not None and hasattr(tasks, '__len__'):
         assert len(keys) == len(tasks)
     if not callable(func):
         raise TypeError('func must be a callable object')
@@ -29,29 +75,121 @@ def track_progress_rich(
         raise TypeError(
             f'tasks must be an iterable object, but got {type(tasks)}')
     assert nproc > 0, 'nproc must be a positive number'
-    res = load(save) if save is not None else {}
+    max_inflight = max_inflight or 2 * nproc
+    journal = None
+    recovered = {}
+    if save is not None and keys is not None:
+        recovered = _read_journal(_journal_path(save))
+        journal = open(_journal_path(save), 'ab')
+
     results = []
+    min_interval = 1.0 / rate_limit if rate_limit else 0.0
+    next_start = time.monotonic()
+    pbar = tqdm(total=len(tasks) if hasattr(tasks, '__len__') else None)
+
+    def _finish(i, value):
+        results[i] = value
+        if journal is not None:
+            pickle.dump((keys[i], value), journal)
+            journal.flush()
+        pbar.update(1)
+
+    try:
+        with ThreadPoolExecutor(max_workers=nproc) as executor:
+            inflight = {}
+            for i, inputs in enumerate(tasks):
+                results.append(None)
+                if keys is not None and keys[i] in recovered:
+                    results[i] = recovered.pop(keys[i])
+                    pbar.update(1)
+                    continue
+
+                while len(inflight) >= max_inflight:
+                    done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _finish(inflight.pop(future), future.result())
+
+                if min_interval:
+                    delay = next_start - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_start = max(next_start, time.monotonic()) + min_interval
+
+                if not isinstance(inputs, (tuple, list, dict)):
+                    inputs = (inputs, )
+                if isinstance(inputs, dict):
+                    args, call_kwargs = (), inputs
+                else:
+                    args, call_kwargs = inputs, {}
+                future = executor.submit(_call_with_retry, func, args, call_kwargs, max_retries, retry_delay)
+                inflight[future] = i
 
-    with ThreadPoolExecutor(max_workers=nproc) as executor:
-        futures = []
-
-        for inputs in tasks:
-            if not isinstance(inputs, (tuple, list, dict)):
-                inputs = (inputs, )
-            if isinstance(inputs, dict):
-                future = executor.submit(func, **inputs)
-            else:
-                future = executor.submit(func, *inputs)
-            futures.append(future)
-
-        for i, future in enumerate(tqdm(futures)):
-            tmp = future.result()
-            if keys is not None:
-                res[keys[i]] = tmp
-                if i % 10 == 0 and save is not None:
-                    dump(res, save)
-            results.append(tmp)
+            while inflight:
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _finish(inflight.pop(future), future.result())
+    finally:
+        pbar.close()
+        if journal is not None:
+            journal.close()
 
     if save is not None:
+        res = load(save)
+        if keys is not None:
+            res.update({k: v for k, v in zip(keys, results)})
         dump(res, save)
+        if journal is not None:
+            os.remove(_journal_path(save))
     return results
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _close_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        pool, _, pid = _process_pool
+        # a pool inherited through fork belongs to the parent
+        if pid == os.getpid():
+            pool.terminate()
+        _process_pool = None
+
+
+atexit.register(_close_process_pool)
+
+
+def get_process_pool(nproc=16):
+    """A process pool for CPU-bound scoring that is created once and shared by every evaluator."""
+    global _process_pool
+    import multiprocessing as mp
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _, pool_nproc, pid = _process_pool
+            if pool_nproc != nproc or pid != os.getpid():
+                _close_process_pool()
+        if _process_pool is None:
+            _process_pool = (mp.Pool(nproc), nproc, os.getpid())
+        return _process_pool[0]
+
+
+def pool_map(func, items, nproc=16):
+    """``Pool.map`` on the shared pool, with chunks sized for tens of thousands of short calls."""
+    items = list(items)
+    chunksize = max(1, len(items) // (nproc * 4))
+    return get_process_pool(nproc).map(func, items, chunksize=chunksize)
+
+
+def pool_map_batched(func, items, nproc=16, min_chunk=1000):
+    """Call ``func`` on contiguous chunks of ``items`` in the shared pool and concatenate the returned lists.
+
+    ``func`` takes a list and returns one result per item. Inputs smaller than ``min_chunk`` are scored in
+    this process, where starting the pool would cost more than it saves.
+    """
+    items = list(items)
+    if nproc <= 1 or len(items) < 2 * min_chunk:
+        return func(items)
+    size = max(min_chunk, -(-len(items) // nproc))
+    chunks = [items[i:i + size] for i in range(0, len(items), size)]
+    return [r for chunk in get_process_pool(nproc).map(func, chunks) for r in chunk]
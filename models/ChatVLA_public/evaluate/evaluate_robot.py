@@ -24,6 +24,7 @@ from policy_heads import *
 # from cv2 import aruco
 from qwen2_vla.utils.image_processing_qwen2_vla import *
 from qwen2_vla.utils.processing_qwen2_vla import *
+from qwen2_vla.utils.prefix_cache import PrefixKVCache
 # ARUCO_DICT = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_250)
 
 import copy
@@ -87,6 +88,9 @@ class qwen2_vla_policy:
 
         self.tokenizer.add_special_tokens({'additional_special_tokens': ["[SOA]"]})
 
+        # every query of a rollout starts with the same chat template text, prefill it once
+        self.prefix_cache = PrefixKVCache() if policy_config.get('prefix_cache', False) else None
+
         self.config = AutoConfig.from_pretrained('/'.join(model_path.split('/')[:-1]), trust_remote_code=True)
 
     def datastruct_droid2qwen2vla(self, raw_lang):
@@ -210,7 +214,8 @@ def eval_bc(policy, env, policy_config, raw_lang=None, eval_in_vqa=False, query_
 
                     batch = policy.process_batch_to_qwen2_vla(curr_image, robot_state, raw_lang)
                     all_actions, outputs = policy.policy.evaluate(**batch, is_eval=True,
-                                                                      tokenizer=policy.tokenizer, eval_in_vqa=eval_in_vqa)
+                                                                      tokenizer=policy.tokenizer, eval_in_vqa=eval_in_vqa,
+                                                                      prefix_cache=policy.prefix_cache)
                     action_queue.extend(
                             torch.chunk(all_actions, chunks=all_actions.shape[1], dim=1)[0:query_frequency])
 
@@ -267,6 +272,7 @@ if __name__ == '__main__':
         "enable_lora": False,
         "action_head": action_head,
         'save_model': False,
+        'prefix_cache': False,
     }
     global im_size
     im_size = 320
@@ -15,9 +15,12 @@
 import argparse
 import torch
 import glob
+import json
 import math
 import os
+import pickle
 import re
+import struct
 from collections import OrderedDict
 from dataclasses import dataclass
 
@@ -93,10 +96,20 @@ def get_model_state_files(checkpoint_dir):
     return get_checkpoint_files(checkpoint_dir, "*_model_states.pt")
 
 
-def parse_model_states(files):
+def load_mmap(file):
+    # tensors stay on disk and are paged in only when read
+    try:
+        return torch.load(file, map_location=device, mmap=True)
+    except (RuntimeError, TypeError, ValueError, pickle.UnpicklingError):
+        # torch without the mmap argument (TypeError), or legacy (non zipfile) serialization that
+        # cannot be mapped (RuntimeError / ValueError / UnpicklingError depending on the torch version)
+        return torch.load(file, map_location=device)
+
+
+def parse_model_states(files, lazy=False):
     zero_model_states = []
     for file in files:
-        state_dict = torch.load(file, map_location=device)
+        state_dict = load_mmap(file) if lazy else torch.load(file, map_location=device)
 
         if BUFFER_NAMES not in state_dict:
             raise ValueError(f"{file} is not a model state checkpoint")
@@ -105,7 +118,8 @@ def parse_model_states(files):
             print("Found buffers:", buffer_names)
 
         # recover just the buffers while restoring them to fp32 if they were saved in fp16
-        buffers = {k: v.float() for k, v in state_dict["module"].items() if k in buffer_names}
+        # (lazily: they are cast when read)
+        buffers = {k: v if lazy else v.float() for k, v in state_dict["module"].items() if k in buffer_names}
         param_shapes = state_dict[PARAM_SHAPES]
 
         # collect parameters that are included in param_shapes
@@ -139,12 +153,16 @@ def parse_model_states(files):
     return zero_model_states
 
 
-def parse_optim_states(files, ds_checkpoint_dir):
+def parse_optim_states(files, ds_checkpoint_dir, lazy=False):
+    """
+    With ``lazy`` the shards are memory mapped and the fp32 groups of every rank are returned as a
+    list per rank instead of being merged, so nothing is read until a parameter is reconstructed.
+    """
 
     total_files = len(files)
     state_dicts = []
     for f in files:
-        state_dicts.append(torch.load(f, map_location=device))
+        state_dicts.append(load_mmap(f) if lazy else torch.load(f, map_location=device))
 
     if not ZERO_STAGE in state_dicts[0][OPTIMIZER_STATE_DICT]:
         raise ValueError(f"{files[0]} is not a zero checkpoint")
@@ -172,7 +190,7 @@ def parse_optim_states(files, ds_checkpoint_dir):
     else:
         raise ValueError(f"unknown zero stage {zero_stage}")
 
-    if zero_stage == 2:
+    if zero_stage == 2 or lazy:
         fp32_flat_groups = [state_dicts[i][OPTIMIZER_STATE_DICT][fp32_groups_key] for i in range(len(state_dicts))]
     elif zero_stage == 3:
         # if there is more than one param group, there will be multiple flattened tensors - one
@@ -495,6 +513,10 @@ def get_fp32_state_dict_from_zero_checkpoint(checkpoint_dir, tag=None):
     If you want it all done for you, use ``load_state_dict_from_zero_checkpoint`` instead.
 
     """
+    return _get_fp32_state_dict_from_zero_checkpoint(get_ds_checkpoint_dir(checkpoint_dir, tag))
+
+
+def get_ds_checkpoint_dir(checkpoint_dir, tag=None):
     if tag is None:
         latest_path = os.path.join(checkpoint_dir, 'latest')
         if os.path.isfile(latest_path):
@@ -508,7 +530,198 @@ def get_fp32_state_dict_from_zero_checkpoint(checkpoint_dir, tag=None):
     if not os.path.isdir(ds_checkpoint_dir):
         raise FileNotFoundError(f"Directory '{ds_checkpoint_dir}' doesn't exist")
 
-    return _get_fp32_state_dict_from_zero_checkpoint(ds_checkpoint_dir)
+    return ds_checkpoint_dir
+
+
+def _narrow_partitions(partitions, offset, numel):
+    # a zero2 param can straddle the flat partitions of consecutive ranks
+    pieces = []
+    for partition in partitions:
+        if numel == 0:
+            break
+        if offset >= partition.numel():
+            offset -= partition.numel()
+            continue
+        take = min(partition.numel() - offset, numel)
+        pieces.append(partition.narrow(0, offset, take))
+        numel -= take
+        offset = 0
+    return torch.cat(pieces, 0) if len(pieces) > 1 else pieces[0]
+
+
+def _zero2_tensor_sources(sources, world_size, fp32_flat_groups, zero_model_states, trainable_only):
+    if not trainable_only and zero_model_states[0].frozen_param_shapes:
+        fragments = zero_model_states[0].frozen_param_fragments
+        for name, shape in zero_model_states[0].frozen_param_shapes.items():
+            sources[name] = (shape, fragments[name].dtype, lambda name=name, shape=shape: fragments[name].reshape(shape))
+
+    align_to = 2 * world_size
+    for group_idx, shapes in enumerate(zero_model_states[0].param_shapes):
+        partitions = [fp32_flat_groups[rank][group_idx] for rank in range(world_size)]
+        offset = 0
+        for name, shape in shapes.items():
+            sources[name] = (shape, torch.float32, lambda partitions=partitions, offset=offset, shape=shape:
+                             _narrow_partitions(partitions, offset, shape.numel()).view(shape))
+            offset += shape.numel()
+        # see _zero2_merge_trainable_params for the alignment
+        avail_numel = sum(partition.numel() for partition in partitions)
+        if align_to * math.ceil(offset / align_to) != align_to * math.ceil(avail_numel / align_to):
+            raise ValueError(f"consumed {offset} numels out of {avail_numel} - something is wrong")
+
+
+def _zero3_tensor_sources(sources, world_size, fp32_flat_groups, zero_model_states, trainable_only):
+    if not trainable_only and zero_model_states[0].frozen_param_shapes:
+        for name, shape in zero_model_states[0].frozen_param_shapes.items():
+            sources[name] = (shape, zero_model_states[0].frozen_param_fragments[name].dtype,
+                             lambda name=name, shape=shape: torch.cat(
+                tuple(model_state.frozen_param_fragments[name] for model_state in zero_model_states),
+                0).narrow(0, 0, shape.numel()).view(shape))
+
+    # each param group has its own flat partition per rank, params are zipped across ranks
+    consumed, avail_numel = 0, 0
+    for group_idx, shapes in enumerate(zero_model_states[0].param_shapes):
+        partitions = [fp32_flat_groups[rank][group_idx] for rank in range(world_size)]
+        offset = 0
+        for name, shape in shapes.items():
+            partitioned_numel, _ = zero3_partitioned_param_info(shape.numel(), world_size)
+            sources[name] = (shape, torch.float32, lambda partitions=partitions, offset=offset,
+                             partitioned_numel=partitioned_numel,
+                             shape=shape: torch.cat(
+                tuple(partition.narrow(0, offset, partitioned_numel) for partition in partitions),
+                0).narrow(0, 0, shape.numel()).view(shape))
+            offset += partitioned_numel
+        consumed += offset * world_size
+        avail_numel += partitions[0].numel() * world_size
+
+    if consumed != avail_numel:
+        raise ValueError(f"consumed {consumed} numels out of {avail_numel} - something is wrong")
+
+
+def get_zero_checkpoint_tensor_sources(checkpoint_dir, tag=None, trainable_only=False):
+    """
+    Describe the consolidated state dict of a ZeRO 2 or 3 checkpoint without reading any weights.
+
+    Returns an ordered ``{name: (shape, dtype, fetch)}``, where ``fetch()`` reconstructs that single
+    tensor (fp32 for trainable parameters and floating buffers) from the memory-mapped rank shards.
+    Reading the tensors one at a time keeps the peak memory at the size of the largest parameter
+    instead of the whole model. With ``trainable_only`` buffers
+    and frozen parameters are left out.
+    """
+    ds_checkpoint_dir = get_ds_checkpoint_dir(checkpoint_dir, tag)
+    print(f"Processing zero checkpoint '{ds_checkpoint_dir}'")
+
+    optim_files = [f for f in get_optim_files(ds_checkpoint_dir) if not "expp" in f]
+    zero_stage, world_size, fp32_flat_groups = parse_optim_states(optim_files, ds_checkpoint_dir, lazy=True)
+    print(f"Detected checkpoint of type zero stage {zero_stage}, world_size: {world_size}")
+
+    model_files = [f for f in get_model_state_files(ds_checkpoint_dir) if not "expert" in f]
+    zero_model_states = parse_model_states(model_files, lazy=True)
+    print(f'Parsing checkpoint created by deepspeed=={zero_model_states[0].ds_version}')
+
+    sources = OrderedDict()
+    if not trainable_only:
+        for name, buffer in zero_model_states[0].buffers.items():
+            # integer buffers (e.g. position ids, step counters) keep their dtype
+            if buffer.is_floating_point():
+                sources[name] = (buffer.shape, torch.float32, lambda buffer=buffer: buffer.float())
+            else:
+                sources[name] = (buffer.shape, buffer.dtype, lambda buffer=buffer: buffer)
+
+    if zero_stage == 2:
+        _zero2_tensor_sources(sources, world_size, fp32_flat_groups, zero_model_states, trainable_only)
+    elif zero_stage == 3:
+        _zero3_tensor_sources(sources, world_size, fp32_flat_groups, zero_model_states, trainable_only)
+
+    # recover shared parameters
+    for name, source in zero_model_states[0].shared_params:
+        if source in sources:
+            sources[name] = sources[source]
+
+    return sources
+
+
+SAFETENSORS_DTYPES = {
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
+
+def _write_safetensors_stream(path, entries):
+    """
+    Write ``[(name, shape, dtype, fetch)]`` as one safetensors file, fetching one tensor at a time.
+
+    The header only needs shapes and dtypes, so it is written first and the tensor bytes are appended
+    as they are produced.
+    """
+    header, offset = {"__metadata__": {"format": "pt"}}, 0
+    for name, shape, dtype, _ in entries:
+        nbytes = math.prod(shape) * torch.empty((), dtype=dtype).element_size()
+        header[name] = {"dtype": SAFETENSORS_DTYPES[dtype], "shape": list(shape), "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header += b" " * (-len(header) % 8)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, shape, dtype, fetch in entries:
+            tensor = fetch()
+            if tensor.is_floating_point():
+                tensor = tensor.to(dtype)
+            tensor = tensor.contiguous()
+            if tuple(tensor.shape) != tuple(shape):
+                raise ValueError(f"{name}: expected shape {tuple(shape)}, got {tuple(tensor.shape)}")
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy())
+            del tensor
+    os.replace(tmp_path, path)
+
+
+def convert_zero_checkpoint_to_safetensors(checkpoint_dir, output_dir, tag=None, dtype=torch.float32,
+                                           trainable_only=False, max_shard_size=5 * 1024 ** 3):
+    """
+    Stream a ZeRO 2 or 3 checkpoint into sharded safetensors files plus a
+    ``model.safetensors.index.json``, in the layout ``from_pretrained`` reads.
+
+    Tensors are reconstructed and written one at a time (see ``get_zero_checkpoint_tensor_sources``),
+    so host memory stays bounded by the largest parameter. Floating point tensors are cast to
+    ``dtype``; ``trainable_only`` exports only the parameters the optimizer updated. Names get the
+    same ``base_model.`` stripping as ``convert_zero_checkpoint_to_fp32_state_dict``.
+    """
+    sources = get_zero_checkpoint_tensor_sources(checkpoint_dir, tag, trainable_only=trainable_only)
+    names = {k: (k[11:] if k.startswith('base_model.') else k) for k in sources}
+    if any(v.startswith('model.gpt_neox.') for v in names.values()):
+        names = {k: (v[6:] if v.startswith('model.') else v) for k, v in names.items()}
+
+    shards, shard_bytes, total_size = [[]], 0, 0
+    for name, (shape, source_dtype, fetch) in sources.items():
+        entry_dtype = dtype if source_dtype.is_floating_point else source_dtype
+        nbytes = math.prod(shape) * torch.empty((), dtype=entry_dtype).element_size()
+        if shards[-1] and shard_bytes + nbytes > max_shard_size:
+            shards.append([])
+            shard_bytes = 0
+        shards[-1].append((names[name], shape, entry_dtype, fetch))
+        shard_bytes += nbytes
+        total_size += nbytes
+
+    os.makedirs(output_dir, exist_ok=True)
+    weight_map = {}
+    for idx, entries in enumerate(shards):
+        shard_name = "model.safetensors" if len(shards) == 1 else f"model-{idx + 1:05d}-of-{len(shards):05d}.safetensors"
+        print(f"Saving {len(entries)} tensors to {os.path.join(output_dir, shard_name)}")
+        _write_safetensors_stream(os.path.join(output_dir, shard_name), entries)
+        weight_map.update({entry[0]: shard_name for entry in entries})
+
+    if len(shards) > 1:
+        with open(os.path.join(output_dir, "model.safetensors.index.json"), "w") as f:
+            json.dump({"metadata": {"total_size": total_size}, "weight_map": weight_map}, f, indent=2)
 
 
 def convert_zero_checkpoint_to_fp32_state_dict(checkpoint_dir, output_file, tag=None):
@@ -622,11 +835,20 @@ def load_state_dict_from_zero_checkpoint(model, checkpoint_dir, tag=None):
 
     """
     logger.info(f"Extracting fp32 weights")
-    state_dict = get_fp32_state_dict_from_zero_checkpoint(checkpoint_dir, tag)
+    sources = get_zero_checkpoint_tensor_sources(checkpoint_dir, tag)
 
     logger.info(f"Overwriting model with fp32 weights")
     model = model.cpu()
-    model.load_state_dict(state_dict, strict=False)
+    # copy one reconstructed tensor at a time; keys the model doesn't have are skipped as with strict=False
+    targets = model.state_dict(keep_vars=True)
+    with torch.no_grad():
+        for name, (shape, _, fetch) in sources.items():
+            if name not in targets:
+                continue
+            if tuple(targets[name].shape) != tuple(shape):
+                raise RuntimeError(f"size mismatch for {name}: copying a param with shape {tuple(shape)} from "
+                                   f"checkpoint, the shape in current model is {tuple(targets[name].shape)}.")
+            targets[name].copy_(fetch())
 
     return model
 
@@ -675,8 +897,23 @@ if __name__ == "__main__":
         type=str,
         help="path to the pytorch fp32 state_dict output file (e.g. path/checkpoint-12/pytorch_model.bin)")
     parser.add_argument("-d", "--debug", action='store_true', help="enable debug")
+    parser.add_argument("--safetensors",
+                        action='store_true',
+                        help="stream sharded safetensors into output_file, used as a directory")
+    parser.add_argument("--dtype", type=str, default="fp32", choices=["fp32", "bf16", "fp16"],
+                        help="dtype of the --safetensors export")
+    parser.add_argument("--trainable_only", action='store_true',
+                        help="only export the trainable parameters with --safetensors")
+    parser.add_argument("--max_shard_size", type=int, default=5 * 1024 ** 3,
+                        help="max bytes per safetensors shard")
     args = parser.parse_args()
 
     debug = args.debug
 
-    convert_zero_checkpoint_to_fp32_state_dict(args.checkpoint_dir, args.output_file)
+    if args.safetensors:
+        dtype = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}[args.dtype]
+        convert_zero_checkpoint_to_safetensors(args.checkpoint_dir, args.output_file, dtype=dtype,
+                                               trainable_only=args.trainable_only,
+                                               max_shard_size=args.max_shard_size)
+    else:
+        convert_zero_checkpoint_to_fp32_state_dict(args.checkpoint_dir, args.output_file)
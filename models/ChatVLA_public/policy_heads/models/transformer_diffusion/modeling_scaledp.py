@@ -95,6 +95,13 @@ def modulate(x, shift, scale):
     return x * (1 + scale.unsqueeze(1)) + shift.unsqueeze(1)
 
 
+def expand_to_noise_samples(c, n):
+    """
+    Repeat per-condition modulation (B, D) for `n` = num_noise_samples * B inputs stacked noise sample major.
+    """
+    return c if c.shape[0] == n else c.repeat(n // c.shape[0], 1)
+
+
 #################################################################################
 #               Embedding Layers for Timesteps and Class Labels                 #
 #################################################################################
@@ -164,7 +171,8 @@ class ScaleDPBlock(nn.Module):
         )
 
     def forward(self, x, c, attn_mask=None):
-        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.adaLN_modulation(c).chunk(6, dim=1)
+        modulation = expand_to_noise_samples(self.adaLN_modulation(c), x.shape[0])
+        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = modulation.chunk(6, dim=1)
         x = x + gate_msa.unsqueeze(1) * self.attn(modulate(self.norm1(x), shift_msa, scale_msa), attn_mask=attn_mask) # norm, scale&shift, attn, scale,
         x = x + gate_mlp.unsqueeze(1) * self.mlp(modulate(self.norm2(x), shift_mlp, scale_mlp))
         return x
@@ -185,7 +193,7 @@ class FinalLayer(nn.Module):
         )
 
     def forward(self, x, c):
-        shift, scale = self.adaLN_modulation(c).chunk(2, dim=1)
+        shift, scale = expand_to_noise_samples(self.adaLN_modulation(c), x.shape[0]).chunk(2, dim=1)
         x = modulate(self.norm_final(x), shift, scale)
         x = self.linear(x)
         return x
@@ -390,27 +398,24 @@ class ScaleDP(PreTrainedModel):
             timesteps, noise = timesteps.to(actions.device), noise.to(actions.device)
 
             # add noise to the clean actions according to the noise magnitude at each diffusion iteration
-            # (this is the forward diffusion process)
-            noisy_actions = torch.cat([self.noise_scheduler.add_noise(
-                actions, noise[i], timesteps)
-                for i in range(len(noise))], dim=0)  # [num_noise_samples * B, Ta, action_dim]
+            # (this is the forward diffusion process), all noise samples at once
+            noise = noise.view(num_noise_samples * B, *noise.size()[2:])
+            noisy_actions = self.noise_scheduler.add_noise(
+                actions.repeat(num_noise_samples, 1, 1), noise, timesteps.repeat(num_noise_samples)
+            )  # [num_noise_samples * B, Ta, action_dim]
 
             noisy_actions = noisy_actions.to(dtype=actions.dtype)
             assert hidden_states.ndim == 3
 
-            hidden_states = hidden_states.repeat(num_noise_samples, 1, 1)
-            timesteps = timesteps.repeat(num_noise_samples)
-            is_pad = is_pad.repeat(num_noise_samples, 1)
-            states = states.repeat(num_noise_samples,  1)
-
+            # the observation conditioning is computed once per batch element and shared by its noise samples
             noise_pred = self.model_forward(
                 noisy_actions,
                 timesteps,
-                global_cond=hidden_states,
-                states=states
+                obs_cond=self.encode_obs(hidden_states, states),
             )
-            noise = noise.view(noise.size(0) * noise.size(1), *noise.size()[2:])
             loss = torch.nn.functional.mse_loss(noise_pred, noise, reduction='none')
+            # average over noise samples so the loss lines up with is_pad, [B, Ta, action_dim]
+            loss = loss.view(num_noise_samples, B, *loss.size()[1:]).mean(dim=0)
             # loss = (loss * ~is_pad.unsqueeze(-1)).mean()
 
             return {'loss': loss}
@@ -424,14 +429,13 @@ class ScaleDP(PreTrainedModel):
             noisy_action = torch.randn((B, Tp, action_dim)).cuda()
 
             naction = noisy_action.to(dtype=hidden_states.dtype)
+            obs_cond = self.encode_obs(hidden_states, states)
             # init scheduler
             self.noise_scheduler.set_timesteps(self.num_inference_timesteps)
 
             for k in self.noise_scheduler.timesteps:
                 # predict noise
-                noise_pred = self.model_forward(
-                    naction, k, global_cond=hidden_states, states=states
-                )
+                noise_pred = self.model_forward(naction, k, obs_cond=obs_cond)
 
                 # inverse diffusion step (remove noise)
                 naction = self.noise_scheduler.step(
@@ -442,16 +446,30 @@ class ScaleDP(PreTrainedModel):
 
             return naction
 
-    def model_forward(self, x, t, global_cond, states):
+    def encode_obs(self, global_cond, states):
         """
-        Forward pass of ScaleDP.
-        x: (N, T, input_dim) noisy actions
-        t: (N,) tensor of diffusion timesteps
-        global_cond: (N, n_obs_steps, D) tensor of conditions: image embeddings
+        Observation conditioning of ScaleDP.
+        global_cond: (B, n_obs_steps, D) tensor of conditions: image embeddings
+        states: (B, state_dim) robot states or None
+        returns: (B, n_emb)
         """
         global_cond = self.global_1d_pool(global_cond.permute(0, 2, 1)).squeeze(-1)
         global_cond = self.norm_after_pool(global_cond)
         global_cond = torch.cat([global_cond, states], dim=-1) if states is not None else global_cond
+        if self.obs_as_cond:
+            global_cond = self.cond_obs_emb(global_cond)  # (B, D)
+        return global_cond
+
+    def model_forward(self, x, t, global_cond=None, states=None, obs_cond=None):
+        """
+        Forward pass of ScaleDP.
+        x: (N, T, input_dim) noisy actions, N = num_noise_samples * B stacked noise sample major
+        t: (B,) tensor of diffusion timesteps
+        global_cond: (B, n_obs_steps, D) tensor of conditions: image embeddings
+        obs_cond: (B, n_emb) output of `encode_obs`, used instead of global_cond and states
+        """
+        if obs_cond is None:
+            obs_cond = self.encode_obs(global_cond, states)
 
         if not torch.is_tensor(t):
             t = torch.tensor([t], dtype=torch.long, device=x.device)
@@ -460,11 +478,9 @@ class ScaleDP(PreTrainedModel):
         t = t.expand(t.shape[0])
 
         x = self.x_embedder(x) + self.pos_embed.to(device=x.device, dtype=x.dtype)  # (N, T, D), where T = prediction_horizon
-        t = self.t_embedder(t)  # (N, D)
-        if self.obs_as_cond:
-            global_cond = self.cond_obs_emb(global_cond)  # (N, D)
-        # c = t + global_cond.sum(dim=1)  # (N, D)
-        c = t + global_cond  # (N, D)
+        t = self.t_embedder(t)  # (B, D)
+        # c = t + global_cond.sum(dim=1)  # (B, D)
+        c = t + obs_cond  # (B, D), broadcast over noise samples in the blocks
         for block in self.blocks:
             # x = block(x, c, attn_mask=self.mask)  # (N, T, D)
             x = block(x, c, attn_mask=None)  # (N, T, D)
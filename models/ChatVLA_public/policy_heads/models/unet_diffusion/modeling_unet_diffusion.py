@@ -128,6 +128,9 @@ class ConditionalResidualBlock1D(nn.Module):
 
         embed = embed.reshape(
             embed.shape[0], 2, self.out_channels, 1)
+        if embed.shape[0] != out.shape[0]:
+            # one condition shared by several noise samples, stacked noise sample major
+            embed = embed.repeat(out.shape[0] // embed.shape[0], 1, 1, 1)
         scale = embed[:, 0, ...]
         bias = embed[:, 1, ...]
         out = scale * out + bias
@@ -264,22 +267,19 @@ class ConditionalUnet1D(PreTrainedModel):
             timesteps, noise = timesteps.to(actions.device), noise.to(actions.device)
 
             # add noise to the clean actions according to the noise magnitude at each diffusion iteration
-            # (this is the forward diffusion process)
-            noisy_actions = torch.cat([self.noise_scheduler.add_noise(
-                actions, noise[i], timesteps)
-                for i in range(len(noise))], dim=0)  # [num_noise_samples * B, Ta, action_dim]
+            # (this is the forward diffusion process), all noise samples at once
+            noise = noise.view(num_noise_samples * B, *noise.size()[2:])
+            noisy_actions = self.noise_scheduler.add_noise(
+                actions.repeat(num_noise_samples, 1, 1), noise, timesteps.repeat(num_noise_samples)
+            )  # [num_noise_samples * B, Ta, action_dim]
 
             noisy_actions = noisy_actions.to(dtype=actions.dtype)
             assert hidden_states.ndim == 3
 
-            hidden_states = hidden_states.repeat(num_noise_samples, 1, 1)
-            timesteps = timesteps.repeat(num_noise_samples)
-            is_pad = is_pad.repeat(num_noise_samples, 1)
-            states = states.repeat(num_noise_samples, 1)
-
-            noise_pred = self.model_forward(noisy_actions, timesteps, global_cond=hidden_states, states=states)
-            noise = noise.view(noise.size(0) * noise.size(1), *noise.size()[2:])
+            # the observation conditioning is computed once per batch element and shared by its noise samples
+            noise_pred = self.model_forward(noisy_actions, timesteps, obs_cond=self.encode_obs(hidden_states, states))
             loss = torch.nn.functional.mse_loss(noise_pred, noise, reduction='none')
+            loss = loss.view(num_noise_samples, B, *loss.size()[1:])
             loss = (loss * ~is_pad.unsqueeze(-1)).mean()
             # loss_dict['loss'] = loss
             return {'loss': loss}
@@ -293,12 +293,13 @@ class ConditionalUnet1D(PreTrainedModel):
             noisy_action = torch.randn((B, Tp, action_dim)).cuda()
 
             naction = noisy_action.to(dtype=hidden_states.dtype)
+            obs_cond = self.encode_obs(hidden_states, states)
             # init scheduler
             self.noise_scheduler.set_timesteps(self.num_inference_timesteps)
 
             for k in self.noise_scheduler.timesteps:
                 # predict noise
-                noise_pred = self.model_forward(naction, k, global_cond=hidden_states, states=states)
+                noise_pred = self.model_forward(naction, k, obs_cond=obs_cond)
 
                 # inverse diffusion step (remove noise)
                 naction = self.noise_scheduler.step(
@@ -309,26 +310,38 @@ class ConditionalUnet1D(PreTrainedModel):
 
             return naction
 
+    def encode_obs(self, global_cond, states=None):
+        """
+        global_cond: (B,1,global_cond_dim)
+        states: (B,state_dim) or None
+        output: (B,global_cond_dim)
+        """
+        # global_cond = self.global_1d_pool(global_cond.permute(0, 2, 1)).squeeze(-1)
+        global_cond = global_cond.squeeze(1)
+
+        global_cond = self.norm_after_pool(global_cond)
+        global_cond = torch.cat([global_cond, states], dim=-1) if states is not None else global_cond
+        return self.combine(global_cond)
+
     def model_forward(self,
                 sample: torch.Tensor,
                 timestep: Union[torch.Tensor, float, int],
                 global_cond=None,
-                states=None):
+                states=None,
+                obs_cond=None):
         """
-        x: (B,T,input_dim)
+        x: (N,T,input_dim), N = num_noise_samples * B stacked noise sample major
         timestep: (B,) or int, diffusion step
-        global_cond: (B,global_cond_dim)
-        output: (B,T,input_dim)
+        global_cond: (B,1,global_cond_dim)
+        obs_cond: (B,global_cond_dim) output of `encode_obs`, used instead of global_cond and states
+        output: (N,T,input_dim)
         """
-        # (B,T,C)
+        # (N,T,C)
         sample = sample.moveaxis(-1, -2)
-        # (B,C,T)
-        # global_cond = self.global_1d_pool(global_cond.permute(0, 2, 1)).squeeze(-1)
-        global_cond = global_cond.squeeze(1)
-
-        global_cond = self.norm_after_pool(global_cond)
-        global_cond = torch.cat([global_cond, states], dim=-1) if states is not None else global_cond
-        global_cond = self.combine(global_cond)
+        # (N,C,T)
+        if obs_cond is None:
+            obs_cond = self.encode_obs(global_cond, states)
+        global_cond = obs_cond
         # 1. time
         timesteps = timestep
         if not torch.is_tensor(timesteps):
@@ -336,7 +349,7 @@ class ConditionalUnet1D(PreTrainedModel):
         elif torch.is_tensor(timesteps) and len(timesteps.shape) == 0:
             timesteps = timesteps[None].to(sample.device)
         # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
-        timesteps = timesteps.expand(sample.shape[0])
+        timesteps = timesteps.expand(global_cond.shape[0])
 
         global_feature = self.diffusion_step_encoder(timesteps)
 
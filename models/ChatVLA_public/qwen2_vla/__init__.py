@@ -2,4 +2,5 @@ from .model_load_utils import *
 from .train.qwen2_vla_trainer import *
 from .models.modeling_qwen2_vla import *
 from .models.configuration_qwen2_vla import *
-from .utils.processing_qwen2_vla import *
\ No newline at end of file
+from .utils.processing_qwen2_vla import *
+from .utils.prefix_cache import *
\ No newline at end of file
@@ -21,6 +21,7 @@
 
 import math
 from dataclasses import dataclass
+from functools import partial
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import torch
@@ -385,6 +386,44 @@ class VisionFlashAttention2(nn.Module):
         return attn_output
 
 
+def vision_varlen_sdpa(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, cu_seqlens: torch.Tensor) -> torch.Tensor:
+    """
+    Block-diagonal attention over the images packed along dim 0 of q/k/v ([seq, heads, head_dim]).
+
+    Images with the same number of patches are gathered into one [num_images, heads, L, head_dim]
+    batch, so the cost is the sum of per-image squares and no [seq, seq] mask is built.
+    """
+    seq_length, num_heads, head_dim = q.shape
+    seqlens = (cu_seqlens[1:] - cu_seqlens[:-1]).tolist()
+
+    def _attend(index, num_images, length):
+        q_i, k_i, v_i = (
+            (x if index is None else x.index_select(0, index))
+            .view(num_images, length, num_heads, head_dim)
+            .transpose(1, 2)
+            for x in (q, k, v)
+        )
+        out = F.scaled_dot_product_attention(q_i, k_i, v_i, dropout_p=0.0)
+        return out.transpose(1, 2).reshape(num_images * length, num_heads, head_dim)
+
+    # common case: every camera / image has the same resolution
+    if len(set(seqlens)) == 1:
+        return _attend(None, len(seqlens), seqlens[0])
+
+    starts_by_length = {}
+    for start, length in zip(cu_seqlens[:-1].tolist(), seqlens):
+        if length > 0:
+            starts_by_length.setdefault(length, []).append(start)
+
+    attn_output = torch.empty_like(q)
+    for length, starts in starts_by_length.items():
+        index = (
+            torch.tensor(starts, device=q.device).unsqueeze(1) + torch.arange(length, device=q.device)
+        ).flatten()
+        attn_output.index_copy_(0, index, _attend(index, len(starts), length))
+    return attn_output
+
+
 class VisionSdpaAttention(nn.Module):
     def __init__(self, dim: int, num_heads: int = 16) -> None:
         super().__init__()
@@ -400,15 +439,7 @@ class VisionSdpaAttention(nn.Module):
         q = apply_rotary_pos_emb_vision(q.unsqueeze(0), rotary_pos_emb).squeeze(0)
         k = apply_rotary_pos_emb_vision(k.unsqueeze(0), rotary_pos_emb).squeeze(0)
 
-        attention_mask = torch.zeros([1, seq_length, seq_length], device=q.device, dtype=torch.bool)
-        for i in range(1, len(cu_seqlens)):
-            attention_mask[..., cu_seqlens[i - 1]: cu_seqlens[i], cu_seqlens[i - 1]: cu_seqlens[i]] = True
-        q = q.transpose(0, 1)
-        k = k.transpose(0, 1)
-        v = v.transpose(0, 1)
-        attn_output = F.scaled_dot_product_attention(q, k, v, attention_mask, dropout_p=0.0)
-        attn_output = attn_output.transpose(0, 1)
-        attn_output = attn_output.reshape(seq_length, -1)
+        attn_output = vision_varlen_sdpa(q, k, v, cu_seqlens).reshape(seq_length, -1)
         attn_output = self.proj(attn_output)
         return attn_output
 
@@ -492,6 +523,66 @@ def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
     return hidden_states.reshape(batch, num_key_value_heads * n_rep, slen, head_dim)
 
 
+def packed_varlen_meta(sample_index: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, int]:
+    """
+    Flash-attention varlen inputs for rows that pack several samples.
+
+    `sample_index` of shape `(batch_size, sequence_length)` holds the batch index of the sample owning each
+    token and -1 on padding. Returns the flat indices of the non-padding tokens, the cumulative sample lengths
+    over those tokens and the longest sample.
+    """
+    flat = sample_index.reshape(-1)
+    token_index = torch.nonzero(flat >= 0, as_tuple=True)[0]
+    _, seqlens = torch.unique_consecutive(flat[token_index], return_counts=True)
+    cu_seqlens = F.pad(seqlens.cumsum(0, dtype=torch.int32), (1, 0))
+    return token_index, cu_seqlens, int(seqlens.max())
+
+
+def packed_causal_mask(sample_index: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """
+    Block-diagonal causal mask of shape `(batch_size, 1, sequence_length, sequence_length)` for packed rows,
+    in the additive form eager and SDPA attention take. Padding tokens only attend to themselves so that no
+    row of the mask is fully masked.
+    """
+    seq_len = sample_index.shape[1]
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=sample_index.device).tril()
+    allowed = (sample_index[:, :, None] == sample_index[:, None, :]) & causal
+    allowed |= torch.eye(seq_len, dtype=torch.bool, device=sample_index.device)
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=sample_index.device)
+    return mask.masked_fill_(~allowed, torch.finfo(dtype).min).unsqueeze(1)
+
+
+def unpack_samples(sample_index: torch.Tensor, samples: torch.Tensor, *tensors_and_pads):
+    """
+    Gather the tokens of `samples` out of packed rows into one left-aligned row per sample.
+
+    Each of `tensors_and_pads` is a `(tensor, padding_value)` pair whose tensor has the packed
+    `(batch_size, sequence_length, ...)` layout; one tensor of shape `(len(samples), max_sample_length, ...)`
+    is returned for each, in that order.
+    """
+    rows, cols = torch.nonzero(sample_index >= 0, as_tuple=True)
+    owner = sample_index[rows, cols]
+    keep = torch.isin(owner, samples)
+    rows, cols, owner = rows[keep], cols[keep], owner[keep]
+
+    # samples are contiguous runs, so a token's offset is its distance to the first token of its sample
+    num_samples = int(sample_index.max()) + 1
+    starts = cols.new_full((num_samples,), sample_index.shape[1])
+    starts.scatter_reduce_(0, owner, cols, reduce="amin")
+    offsets = cols - starts[owner]
+    slots = owner.new_full((num_samples,), -1)
+    slots[samples] = torch.arange(len(samples), device=slots.device)
+    out_rows = slots[owner]
+    length = int(offsets.max()) + 1 if len(offsets) > 0 else 1
+
+    unpacked = []
+    for tensor, padding_value in tensors_and_pads:
+        out = tensor.new_full((len(samples), length) + tuple(tensor.shape[2:]), padding_value)
+        out[out_rows, offsets] = tensor[rows, cols]
+        unpacked.append(out)
+    return unpacked
+
+
 class Qwen2VLAttention(nn.Module):
     """
     Multi-headed attention from 'Attention Is All You Need' paper. Modified to use sliding window attention: Longformer
@@ -643,6 +734,7 @@ class Qwen2VLFlashAttention2(Qwen2VLAttention):
             use_cache: bool = False,
             cache_position: Optional[torch.LongTensor] = None,
             position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,  # will become mandatory in v4.46
+            packed_varlen: Optional[Tuple[torch.Tensor, torch.Tensor, int]] = None,
     ):
         bsz, q_len, _ = hidden_states.size()
 
@@ -751,17 +843,36 @@ class Qwen2VLFlashAttention2(Qwen2VLAttention):
         else:
             sliding_window = None
 
-        attn_output = _flash_attention_forward(
-            query_states,
-            key_states,
-            value_states,
-            attention_mask,
-            q_len,
-            dropout=dropout_rate,
-            sliding_window=sliding_window,
-            is_causal=self.is_causal,
-            use_top_left_mask=self._flash_attn_uses_top_left_mask,
-        )
+        if packed_varlen is not None:
+            # packed rows: attend within each sample only, see `packed_varlen_meta`
+            token_index, cu_seqlens, max_seqlen = packed_varlen
+            window_size = (sliding_window, sliding_window) if sliding_window is not None else (-1, -1)
+            packed_output = flash_attn_varlen_func(
+                query_states.reshape(bsz * q_len, self.num_heads, self.head_dim)[token_index],
+                key_states.reshape(bsz * q_len, self.num_heads, self.head_dim)[token_index],
+                value_states.reshape(bsz * q_len, self.num_heads, self.head_dim)[token_index],
+                cu_seqlens,
+                cu_seqlens,
+                max_seqlen,
+                max_seqlen,
+                dropout_p=dropout_rate,
+                causal=True,
+                window_size=window_size,
+            )
+            attn_output = packed_output.new_zeros(bsz * q_len, self.num_heads, self.head_dim)
+            attn_output = attn_output.index_copy(0, token_index, packed_output)
+        else:
+            attn_output = _flash_attention_forward(
+                query_states,
+                key_states,
+                value_states,
+                attention_mask,
+                q_len,
+                dropout=dropout_rate,
+                sliding_window=sliding_window,
+                is_causal=self.is_causal,
+                use_top_left_mask=self._flash_attn_uses_top_left_mask,
+            )
 
         attn_output = attn_output.reshape(bsz, q_len, self.hidden_size).contiguous()
         attn_output = self.o_proj(attn_output)
@@ -914,6 +1025,7 @@ class Qwen2VLDecoderLayer(nn.Module):
             position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,  # will become mandatory in v4.46
             vl_data_mask: Optional[torch.Tensor] = None,
             eval_in_vqa: Optional[bool] = False,
+            packed_varlen: Optional[Tuple[torch.Tensor, torch.Tensor, int]] = None,
             **kwargs,
     ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
         """
@@ -933,6 +1045,8 @@ class Qwen2VLDecoderLayer(nn.Module):
             position_embeddings (`Tuple[torch.FloatTensor, torch.FloatTensor]`, *optional*):
                 Tuple containing the cosine and sine positional embeddings of shape `(batch_size, seq_len, head_dim)`,
                 with `head_dim` being the embedding dimension of each attention head.
+            packed_varlen (`Tuple[torch.Tensor, torch.Tensor, int]`, *optional*):
+                Varlen layout of packed rows for flash attention, see `packed_varlen_meta`.
             kwargs (`dict`, *optional*):
                 Arbitrary kwargs to be ignored, used for FSDP and other methods that injects code
                 into the model
@@ -943,6 +1057,7 @@ class Qwen2VLDecoderLayer(nn.Module):
         hidden_states = self.input_layernorm(hidden_states)
 
         # Self Attention
+        attn_kwargs = {} if packed_varlen is None else {"packed_varlen": packed_varlen}
         hidden_states, self_attn_weights, present_key_value = self.self_attn(
             hidden_states=hidden_states,
             attention_mask=attention_mask,
@@ -952,6 +1067,7 @@ class Qwen2VLDecoderLayer(nn.Module):
             use_cache=use_cache,
             cache_position=cache_position,
             position_embeddings=position_embeddings,
+            **attn_kwargs,
         )
         hidden_states = residual + hidden_states
 
@@ -1055,6 +1171,10 @@ class Qwen2VisionTransformerPretrainedModel(Qwen2VLPreTrainedModel):
             dim=config.hidden_size, context_dim=config.embed_dim, spatial_merge_size=config.spatial_merge_size
         )
 
+        # rotary embeddings per frame grid and per batch of grids
+        self._rot_pos_emb_cache = {}
+        self._rot_pos_emb_cache_size = 256
+
     def get_dtype(self) -> torch.dtype:
         try:
             return self.blocks[0].mlp.fc2.weight.dtype
@@ -1067,33 +1187,37 @@ class Qwen2VisionTransformerPretrainedModel(Qwen2VLPreTrainedModel):
         except:
             return self.blocks[0].norm1.weight.device
 
+    def _grid_rot_pos_emb(self, h, w):
+        """
+        Rotary embedding of one h x w frame, in the patch order produced by the spatial merge.
+        """
+        key = (h, w, self.rotary_pos_emb.inv_freq.device, self.rotary_pos_emb.inv_freq.dtype)
+        if key not in self._rot_pos_emb_cache:
+            # the cache outlives inference_mode() blocks, so build it as a regular tensor
+            with torch.inference_mode(False), torch.no_grad():
+                merge = self.spatial_merge_size
+                hpos_ids = torch.arange(h).unsqueeze(1).expand(-1, w)
+                hpos_ids = hpos_ids.reshape(h // merge, merge, w // merge, merge).permute(0, 2, 1, 3).flatten()
+                wpos_ids = torch.arange(w).unsqueeze(0).expand(h, -1)
+                wpos_ids = wpos_ids.reshape(h // merge, merge, w // merge, merge).permute(0, 2, 1, 3).flatten()
+                pos_ids = torch.stack([hpos_ids, wpos_ids], dim=-1).to(key[2])
+                self._rot_pos_emb_cache[key] = self.rotary_pos_emb(max(h, w))[pos_ids].flatten(1)
+        return self._rot_pos_emb_cache[key]
+
     def rot_pos_emb(self, grid_thw):
-        pos_ids = []
-        for t, h, w in grid_thw:
-            hpos_ids = torch.arange(h).unsqueeze(1).expand(-1, w)
-            hpos_ids = hpos_ids.reshape(
-                h // self.spatial_merge_size,
-                self.spatial_merge_size,
-                w // self.spatial_merge_size,
-                self.spatial_merge_size,
-            )
-            hpos_ids = hpos_ids.permute(0, 2, 1, 3)
-            hpos_ids = hpos_ids.flatten()
-
-            wpos_ids = torch.arange(w).unsqueeze(0).expand(h, -1)
-            wpos_ids = wpos_ids.reshape(
-                h // self.spatial_merge_size,
-                self.spatial_merge_size,
-                w // self.spatial_merge_size,
-                self.spatial_merge_size,
+        grids = tuple(tuple(grid) for grid in grid_thw.tolist())
+        key = (grids, self.rotary_pos_emb.inv_freq.device, self.rotary_pos_emb.inv_freq.dtype)
+        if key in self._rot_pos_emb_cache:
+            return self._rot_pos_emb_cache[key]
+
+        if len(self._rot_pos_emb_cache) >= self._rot_pos_emb_cache_size:
+            # dynamic-resolution VQA can produce many distinct grids
+            self._rot_pos_emb_cache.clear()
+        with torch.inference_mode(False), torch.no_grad():
+            rotary_pos_emb = torch.cat(
+                [self._grid_rot_pos_emb(h, w).repeat(t, 1) for t, h, w in grids], dim=0
             )
-            wpos_ids = wpos_ids.permute(0, 2, 1, 3)
-            wpos_ids = wpos_ids.flatten()
-            pos_ids.append(torch.stack([hpos_ids, wpos_ids], dim=-1).repeat(t, 1))
-        pos_ids = torch.cat(pos_ids, dim=0)
-        max_grid_size = grid_thw[:, 1:].max()
-        rotary_pos_emb_full = self.rotary_pos_emb(max_grid_size)
-        rotary_pos_emb = rotary_pos_emb_full[pos_ids].flatten(1)
+        self._rot_pos_emb_cache[key] = rotary_pos_emb
         return rotary_pos_emb
 
     def forward(self, hidden_states: torch.Tensor, grid_thw: torch.Tensor,
@@ -1155,6 +1279,7 @@ class Qwen2VLModel(Qwen2VLPreTrainedModel):
             visual_token_mask: Optional[torch.Tensor] = None,
             vl_data_mask: Optional[torch.Tensor] = None,
             eval_in_vqa: Optional[bool] = None,
+            sample_index: Optional[torch.Tensor] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -1189,9 +1314,17 @@ class Qwen2VLModel(Qwen2VLPreTrainedModel):
         elif position_ids.dim() == 2:
             position_ids = position_ids[None, ...].expand(3, position_ids.shape[0], -1)
 
-        causal_mask = self._update_causal_mask(
-            attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions
-        )
+        packed_varlen = None
+        if sample_index is None:
+            causal_mask = self._update_causal_mask(
+                attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions
+            )
+        elif self.config._attn_implementation == "flash_attention_2":
+            # packed rows: samples must not attend to each other
+            causal_mask = None
+            packed_varlen = packed_varlen_meta(sample_index)
+        else:
+            causal_mask = packed_causal_mask(sample_index, inputs_embeds.dtype)
 
         hidden_states = inputs_embeds
 
@@ -1213,7 +1346,8 @@ class Qwen2VLModel(Qwen2VLPreTrainedModel):
                     def create_custom_forward(module):
                         def custom_forward(*inputs):
                             return module(*inputs[:-2], output_attentions, use_cache, cache_position,
-                                          position_embeddings,  vl_data_mask=inputs[-2], visual_token_mask=inputs[-1])
+                                          position_embeddings,  vl_data_mask=inputs[-2], visual_token_mask=inputs[-1],
+                                          packed_varlen=packed_varlen)
 
                         return custom_forward
 
@@ -1228,8 +1362,11 @@ class Qwen2VLModel(Qwen2VLPreTrainedModel):
                         visual_token_mask,
                     )
                 else:
+                    layer_call = decoder_layer.__call__
+                    if packed_varlen is not None:
+                        layer_call = partial(decoder_layer.__call__, packed_varlen=packed_varlen)
                     layer_outputs = self._gradient_checkpointing_func(
-                        decoder_layer.__call__,
+                        layer_call,
                         hidden_states,
                         causal_mask,
                         position_ids,
@@ -1251,7 +1388,8 @@ class Qwen2VLModel(Qwen2VLPreTrainedModel):
                     position_embeddings=position_embeddings,
                     vl_data_mask=vl_data_mask,
                     visual_token_mask=visual_token_mask,
-                    eval_in_vqa=eval_in_vqa
+                    eval_in_vqa=eval_in_vqa,
+                    packed_varlen=packed_varlen,
                 )
 
             hidden_states = layer_outputs[0]
@@ -1503,6 +1641,38 @@ QWEN2_VL_INPUTS_DOCSTRING = r"""
 """
 
 
+class _FinalHiddenStateRecorder:
+    """
+    Forward hook for the final norm of `Qwen2VLModel` that copies its output into one
+    preallocated [batch, prompt_len + max_new_tokens, hidden] buffer during `generate`.
+
+    The first call is the prefill (prompt hidden states); every later call adds the
+    hidden state of one generated token.
+    """
+
+    def __init__(self, max_new_tokens):
+        self.max_new_tokens = max_new_tokens
+        self.buffer = None
+        self.prompt_length = 0
+        self.length = 0
+
+    def __call__(self, module, inputs, output):
+        if self.buffer is None:
+            batch_size, self.prompt_length, hidden_size = output.shape
+            self.buffer = output.new_empty(batch_size, self.prompt_length + self.max_new_tokens, hidden_size)
+        step = output.shape[1]
+        self.buffer[:, self.length:self.length + step] = output
+        self.length += step
+
+    @property
+    def prompt_hidden_states(self):
+        return self.buffer[:, :self.prompt_length]
+
+    @property
+    def generated_hidden_states(self):
+        return self.buffer[:, self.prompt_length:self.length]
+
+
 class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMixin):
     _tied_weights_keys = ["lm_head.weight"]
 
@@ -1557,6 +1727,7 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
             image_grid_thw: Optional[torch.LongTensor] = None,
             video_grid_thw: Optional[torch.LongTensor] = None,
             attention_mask: Optional[torch.Tensor] = None,
+            sample_index: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Calculate the 3D rope index based on image and video's temporal, height and width in LLM.
@@ -1597,85 +1768,39 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
 
                 - 1 for tokens that are **not masked**,
                 - 0 for tokens that are **masked**.
+            sample_index (`torch.Tensor` of shape `(batch_size, sequence_length)`, *optional*):
+                For packed rows, the batch index of the sample owning each token and -1 on padding. Positions
+                restart at 0 for every sample.
 
         Returns:
             position_ids (`torch.LongTensor` of shape `(3, batch_size, sequence_length)`)
             mrope_position_deltas (`torch.Tensor` of shape `(batch_size)`)
         """
-        spatial_merge_size = self.config.vision_config.spatial_merge_size
-        image_token_id = self.config.image_token_id
-        video_token_id = self.config.video_token_id
-        vision_start_token_id = self.config.vision_start_token_id
         mrope_position_deltas = []
-        if image_grid_thw is not None or video_grid_thw is not None:
+        if image_grid_thw is not None or video_grid_thw is not None or sample_index is not None:
             total_input_ids = input_ids
             position_ids = torch.ones(
                 3, input_ids.shape[0], input_ids.shape[1], dtype=input_ids.dtype, device=input_ids.device
             )
             image_index, video_index = 0, 0
             for i, input_ids in enumerate(total_input_ids):
-                if attention_mask is not None:
-                    input_ids = input_ids[attention_mask[i] == 1]
-                image_nums, video_nums = 0, 0
-                vision_start_indices = torch.argwhere(input_ids == vision_start_token_id).squeeze(1)
-                vision_tokens = input_ids[vision_start_indices + 1]
-                image_nums = (vision_tokens == image_token_id).sum()
-                video_nums = (vision_tokens == video_token_id).sum()
-                input_tokens = input_ids.tolist()
-                llm_pos_ids_list: list = []
-                st = 0
-                remain_images, remain_videos = image_nums, video_nums
-                for _ in range(image_nums + video_nums):
-                    if image_token_id in input_tokens and remain_images > 0:
-                        ed_image = input_tokens.index(image_token_id, st)
-                    else:
-                        ed_image = len(input_tokens) + 1
-                    if video_token_id in input_tokens and remain_videos > 0:
-                        ed_video = input_tokens.index(video_token_id, st)
-                    else:
-                        ed_video = len(input_tokens) + 1
-                    if ed_image < ed_video:
-                        t, h, w = (
-                            image_grid_thw[image_index][0],
-                            image_grid_thw[image_index][1],
-                            image_grid_thw[image_index][2],
-                        )
-                        image_index += 1
-                        remain_images -= 1
-                        ed = ed_image
-                    else:
-                        t, h, w = (
-                            video_grid_thw[video_index][0],
-                            video_grid_thw[video_index][1],
-                            video_grid_thw[video_index][2],
-                        )
-                        video_index += 1
-                        remain_videos -= 1
-                        ed = ed_video
-                    llm_grid_t, llm_grid_h, llm_grid_w = (
-                        t.item(),
-                        h.item() // spatial_merge_size,
-                        w.item() // spatial_merge_size,
+                if sample_index is not None:
+                    # one segment per packed sample, positions restart at each of them
+                    _, seqlens = torch.unique_consecutive(sample_index[i], return_counts=True)
+                    segments = torch.split(torch.arange(len(input_ids), device=input_ids.device), seqlens.tolist())
+                    segments = [seg for seg in segments if sample_index[i, seg[0]] >= 0]
+                elif attention_mask is not None:
+                    segments = [torch.nonzero(attention_mask[i] == 1, as_tuple=True)[0]]
+                else:
+                    segments = [torch.arange(len(input_ids), device=input_ids.device)]
+                row_max = 0
+                for seg in segments:
+                    llm_positions, image_index, video_index = self._get_rope_index_segment(
+                        input_ids[seg], image_grid_thw, video_grid_thw, image_index, video_index
                     )
-                    text_len = ed - st
-
-                    st_idx = llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
-                    llm_pos_ids_list.append(torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx)
-
-                    t_index = torch.arange(llm_grid_t).view(-1, 1).expand(-1, llm_grid_h * llm_grid_w).flatten()
-                    h_index = torch.arange(llm_grid_h).view(1, -1, 1).expand(llm_grid_t, -1, llm_grid_w).flatten()
-                    w_index = torch.arange(llm_grid_w).view(1, 1, -1).expand(llm_grid_t, llm_grid_h, -1).flatten()
-                    llm_pos_ids_list.append(torch.stack([t_index, h_index, w_index]) + text_len + st_idx)
-                    st = ed + llm_grid_t * llm_grid_h * llm_grid_w
-
-                if st < len(input_tokens):
-                    st_idx = llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
-                    text_len = len(input_tokens) - st
-                    llm_pos_ids_list.append(torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx)
-
-                llm_positions = torch.cat(llm_pos_ids_list, dim=1).reshape(3, -1)
-                position_ids[..., i, attention_mask[i] == 1] = llm_positions.to(position_ids.device)
-                mrope_position_deltas.append(llm_positions.max() + 1 - len(total_input_ids[i]))
+                    position_ids[..., i, seg] = llm_positions.to(position_ids.device)
+                    row_max = max(row_max, int(llm_positions.max()))
+                mrope_position_deltas.append(row_max + 1 - len(total_input_ids[i]))
             mrope_position_deltas = torch.tensor(mrope_position_deltas, device=input_ids.device).unsqueeze(1)
             return position_ids, mrope_position_deltas
         else:
@@ -1699,6 +1824,76 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
 
             return position_ids, mrope_position_deltas
 
+    def _get_rope_index_segment(self, input_ids, image_grid_thw, video_grid_thw, image_index, video_index):
+        """
+        3D rope positions, starting at 0, for the tokens of one sample.
+
+        Returns the positions of shape `(3, len(input_ids))` and the image and video counters advanced past the
+        vision inputs of this sample.
+        """
+        spatial_merge_size = self.config.vision_config.spatial_merge_size
+        image_token_id = self.config.image_token_id
+        video_token_id = self.config.video_token_id
+        vision_start_token_id = self.config.vision_start_token_id
+        vision_start_indices = torch.argwhere(input_ids == vision_start_token_id).squeeze(1)
+        vision_tokens = input_ids[vision_start_indices + 1]
+        image_nums = (vision_tokens == image_token_id).sum()
+        video_nums = (vision_tokens == video_token_id).sum()
+        input_tokens = input_ids.tolist()
+        llm_pos_ids_list: list = []
+        st = 0
+        remain_images, remain_videos = image_nums, video_nums
+        for _ in range(image_nums + video_nums):
+            if image_token_id in input_tokens and remain_images > 0:
+                ed_image = input_tokens.index(image_token_id, st)
+            else:
+                ed_image = len(input_tokens) + 1
+            if video_token_id in input_tokens and remain_videos > 0:
+                ed_video = input_tokens.index(video_token_id, st)
+            else:
+                ed_video = len(input_tokens) + 1
+            if ed_image < ed_video:
+                t, h, w = (
+                    image_grid_thw[image_index][0],
+                    image_grid_thw[image_index][1],
+                    image_grid_thw[image_index][2],
+                )
+                image_index += 1
+                remain_images -= 1
+                ed = ed_image
+            else:
+                t, h, w = (
+                    video_grid_thw[video_index][0],
+                    video_grid_thw[video_index][1],
+                    video_grid_thw[video_index][2],
+                )
+                video_index += 1
+                remain_videos -= 1
+                ed = ed_video
+            llm_grid_t, llm_grid_h, llm_grid_w = (
+                t.item(),
+                h.item() // spatial_merge_size,
+                w.item() // spatial_merge_size,
+            )
+            text_len = ed - st
+
+            st_idx = llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
+            llm_pos_ids_list.append(torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx)
+
+            t_index = torch.arange(llm_grid_t).view(-1, 1).expand(-1, llm_grid_h * llm_grid_w).flatten()
+            h_index = torch.arange(llm_grid_h).view(1, -1, 1).expand(llm_grid_t, -1, llm_grid_w).flatten()
+            w_index = torch.arange(llm_grid_w).view(1, 1, -1).expand(llm_grid_t, llm_grid_h, -1).flatten()
+            llm_pos_ids_list.append(torch.stack([t_index, h_index, w_index]) + text_len + st_idx)
+            st = ed + llm_grid_t * llm_grid_h * llm_grid_w
+
+        if st < len(input_tokens):
+            st_idx = llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
+            text_len = len(input_tokens) - st
+            llm_pos_ids_list.append(torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx)
+
+        llm_positions = torch.cat(llm_pos_ids_list, dim=1).reshape(3, -1)
+        return llm_positions, image_index, video_index
+
     def _update_model_kwargs_for_generation(
             self,
             outputs: ModelOutput,
@@ -1744,6 +1939,7 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
             is_pad: bool = False,
             is_eval: bool = False,
             eval_in_vqa: bool = False,
+            sample_index: Optional[torch.Tensor] = None,
     ) -> Union[Tuple, Qwen2VLCausalLMOutputWithPast]:
         r"""
         Args:
@@ -1751,6 +1947,10 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
                 Labels for computing the masked language modeling loss. Indices should either be in `[0, ...,
                 config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
                 (masked), the loss is only computed for the tokens with labels in `[0, ..., config.vocab_size]`.
+            sample_index (`torch.Tensor` of shape `(num_rows, sequence_length)`, *optional*):
+                Set when the collator packed several samples into each row: the index of the sample owning each
+                token, -1 on padding. Per-sample inputs (`actions`, `states`, `is_pad`, `vl_data_mask`,
+                `text_only_mask`) stay indexed by sample.
 
         Returns:
 
@@ -1787,12 +1987,14 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
         self.computed_type = torch.bfloat16
         input_ids = input_ids.to("cuda")
         attention_mask = attention_mask.to("cuda")
+        if sample_index is not None:
+            sample_index = sample_index.to("cuda")
         if not is_eval:
             labels = labels.to("cuda")
             actions = actions.to(dtype=self.computed_type, device='cuda')
             states = states.to(dtype=self.computed_type, device='cuda')
             position_ids, rope_deltas = self.get_rope_index(
-                input_ids, image_grid_thw, video_grid_thw, attention_mask
+                input_ids, image_grid_thw, video_grid_thw, attention_mask, sample_index=sample_index
             )
 
         if pixel_values is not None:
@@ -1849,7 +2051,12 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
                 attention_mask = attention_mask.to(inputs_embeds.device)
 
         # assert image_mask is not None, f"inputs_embeds: {inputs_embeds}, pixel_values: {pixel_values}"
-        
+
+        # packed rows mix samples, so the expert is picked per token
+        expert_mask = vl_data_mask
+        if sample_index is not None and vl_data_mask is not None:
+            expert_mask = vl_data_mask.to(sample_index.device)[sample_index.clamp(min=0)]
+
         outputs = self.model(
             input_ids=None,
             position_ids=position_ids,
@@ -1861,8 +2068,9 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             visual_token_mask=image_mask,
-            vl_data_mask=vl_data_mask,
-            eval_in_vqa=eval_in_vqa
+            vl_data_mask=expert_mask,
+            eval_in_vqa=eval_in_vqa,
+            sample_index=sample_index,
         )
 
 
@@ -1883,6 +2091,9 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
         if labels is not None and self.with_llm_head:
             shift_logits = logits[..., :-1, :].contiguous()
             shift_labels = labels[..., 1:].contiguous()
+            if sample_index is not None:
+                # never predict the first token of a packed sample from the sample before it
+                shift_labels = shift_labels.masked_fill(sample_index[:, :-1] != sample_index[:, 1:], -100)
             # Flatten the tokens
             loss_fct = CrossEntropyLoss(reduction='none')
             shift_logits = shift_logits.view(-1, self.config.vocab_size)
@@ -1899,16 +2110,24 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
             valid_elements = (shift_labels != -100).sum()
             
             # Calculate proportions for each type of loss
-            reasoning_expanded_mask = ~vl_data_mask.unsqueeze(1).repeat(1,logits.shape[1]-1).view(-1)
+            if sample_index is None:
+                token_vl_mask = vl_data_mask.unsqueeze(1).repeat(1, logits.shape[1] - 1)
+                token_text_mask = text_only_mask.unsqueeze(1).repeat(1, logits.shape[1] - 1)
+            else:
+                # route every label to the sample that owns it
+                label_owner = sample_index[:, 1:].clamp(min=0)
+                token_vl_mask = vl_data_mask.to(label_owner.device)[label_owner]
+                token_text_mask = text_only_mask.to(label_owner.device)[label_owner]
+            reasoning_expanded_mask = ~token_vl_mask.reshape(-1)
             reasoning_expanded_mask = reasoning_expanded_mask & (shift_labels != -100)
             reasoning_loss = (llm_loss * reasoning_expanded_mask).sum() / valid_elements
             del reasoning_expanded_mask
 
-            text_expanded_mask = text_only_mask.unsqueeze(1).repeat(1,logits.shape[1]-1).view(-1)
+            text_expanded_mask = token_text_mask.reshape(-1)
             text_expanded_mask = text_expanded_mask & (shift_labels != -100)
             text_loss = (llm_loss * text_expanded_mask).sum() / valid_elements
             del text_expanded_mask
-            vl_expanded_mask = ((vl_data_mask & ~text_only_mask).unsqueeze(1).repeat(1,logits.shape[1]-1).view(-1))
+            vl_expanded_mask = (token_vl_mask & ~token_text_mask).reshape(-1)
             vl_expanded_mask = vl_expanded_mask & (shift_labels != -100)
             vl_data_loss = (llm_loss * vl_expanded_mask).sum() / valid_elements
             del vl_expanded_mask
@@ -1939,8 +2158,20 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
                 rope_deltas=rope_deltas,
             )
 
+        if sample_index is not None:
+            # give the action head one left-aligned row per robot sample, as without packing
+            robot_samples = torch.nonzero(~vl_data_mask, as_tuple=True)[0]
+            if len(robot_samples) == 0:
+                robot_samples = robot_samples.new_zeros(1)
+            input_ids, labels, hidden_states = unpack_samples(
+                sample_index, robot_samples.to(sample_index.device),
+                (input_ids, 151643), (labels, -100), (hidden_states, 0)
+            )
+            actions = actions[robot_samples.to(actions.device)]
+            states = states[robot_samples.to(states.device)]
+            is_pad = is_pad[robot_samples.to(is_pad.device)]
         # preprocess for action data
-        if vl_data_mask is not None:
+        elif vl_data_mask is not None:
             if False in vl_data_mask:
                 input_ids = input_ids[~vl_data_mask]
                 labels = labels[~vl_data_mask]
@@ -2051,9 +2282,14 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
             pixel_values_videos=None,
             image_grid_thw=None,
             video_grid_thw=None,
+            prefix_length=0,
             **kwargs,
     ):
         # print("============prepare_inputs_for_generation================")
+        # `prefix_length` tokens are already in `past_key_values` (see PrefixKVCache), so the
+        # prefill step starts at cache_position == prefix_length instead of 0
+        is_prefill = cache_position is None or cache_position[0] == prefix_length
+        full_input_ids = input_ids
         # If we have cache: let's slice `input_ids` through `cache_position`, to keep only the unprocessed tokens
         # Exception 1: when passing input_embeds, input_ids may be missing entries
         # Exception 2: some generation methods do special slicing of input_ids, so we don't need to do it here
@@ -2065,10 +2301,13 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
 
         rope_deltas = kwargs.get("rope_deltas", None)
         if attention_mask is not None and position_ids is None:
-            if cache_position is None or (cache_position is not None and cache_position[0] == 0):
+            if is_prefill:
+                # rope indices depend on the whole prompt, including the cached prefix
                 position_ids, rope_deltas = self.get_rope_index(
-                    input_ids, image_grid_thw, video_grid_thw, attention_mask
+                    full_input_ids, image_grid_thw, video_grid_thw, attention_mask
                 )
+                if prefix_length > 0:
+                    position_ids = position_ids[..., prefix_length:]
             else:
                 batch_size, seq_length = input_ids.shape
                 delta = (
@@ -2079,12 +2318,12 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
                 position_ids = position_ids.add(delta)
                 position_ids = position_ids.unsqueeze(0).expand(3, -1, -1)
 
-        if cache_position[0] != 0:
+        if not is_prefill:
             pixel_values = None
             pixel_values_videos = None
 
         # if `inputs_embeds` are passed, we only want to use them in the 1st generation step
-        if inputs_embeds is not None and cache_position[0] == 0:
+        if inputs_embeds is not None and is_prefill:
             model_inputs = {"inputs_embeds": inputs_embeds, "input_ids": None}
         else:
             model_inputs = {"input_ids": input_ids, "inputs_embeds": None}
@@ -2135,25 +2374,44 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
                  pixel_values=None,
                  attention_mask=None,
                  image_grid_thw=None,
+                 eval_in_vqa=False,
+                 prefix_cache=None,
                  ):
         input_ids = input_ids.to('cuda')
-        with torch.inference_mode():
-            outputs = self.generate(
-                input_ids,
-                pixel_values=pixel_values,
-                attention_mask=attention_mask,
-                image_grid_thw=image_grid_thw,
-                is_eval=is_eval,
-                num_beams=1,
-                do_sample=False,
-                temperature=0.2,
-                max_new_tokens=256,
-                eos_token_id=tokenizer.eos_token_id,  # End of sequence token
-                pad_token_id=tokenizer.eos_token_id,  # Pad token
-                use_cache=True,
-                output_hidden_states=True,
-                return_dict_in_generate=True,
+        prefix_kwargs = {}
+        prefix_hidden_states = None
+        if prefix_cache is not None:
+            attention_mask = attention_mask.to(input_ids.device)
+            past_key_values, prefix_length, prefix_hidden_states = prefix_cache.fork(
+                self, input_ids, attention_mask, eval_in_vqa=eval_in_vqa
             )
+            if prefix_length > 0:
+                prefix_kwargs = dict(past_key_values=past_key_values, prefix_length=prefix_length)
+        max_new_tokens = 256
+        # keep only the final-layer hidden states instead of every layer at every step
+        recorder = _FinalHiddenStateRecorder(max_new_tokens)
+        handle = self.model.norm.register_forward_hook(recorder)
+        try:
+            with torch.inference_mode():
+                outputs = self.generate(
+                    input_ids,
+                    pixel_values=pixel_values,
+                    attention_mask=attention_mask,
+                    image_grid_thw=image_grid_thw,
+                    is_eval=is_eval,
+                    eval_in_vqa=eval_in_vqa,
+                    num_beams=1,
+                    do_sample=False,
+                    temperature=0.2,
+                    max_new_tokens=max_new_tokens,
+                    eos_token_id=tokenizer.eos_token_id,  # End of sequence token
+                    pad_token_id=tokenizer.eos_token_id,  # Pad token
+                    use_cache=True,
+                    return_dict_in_generate=True,
+                    **prefix_kwargs,
+                )
+        finally:
+            handle.remove()
 
         output_ids = outputs.sequences
         input_token_len = input_ids.shape[1]
@@ -2163,13 +2421,13 @@ class Qwen2VLForConditionalGenerationForVLA(Qwen2VLPreTrainedModel, GenerationMi
         outputs_text = tokenizer.batch_decode(output_ids[:, input_token_len:], skip_special_tokens=False)[0]
 
         outputs_text = outputs_text.strip()
-        last_hidden_states = [each[-1] for each in outputs.hidden_states]  # all hidden states
-        # all_hidden_states = torch.cat(last_hidden_states, dim=1)
-
-        input_embeddings = torch.cat(last_hidden_states[0:1], dim=1)
+        input_embeddings = recorder.prompt_hidden_states
+        if prefix_hidden_states is not None:
+            # the prefill step only produced hidden states for the uncached part of the prompt
+            input_embeddings = torch.cat([prefix_hidden_states.to(input_embeddings.dtype), input_embeddings], dim=1)
         identity = torch.mean(input_embeddings, dim=1)
 
-        reasoning_embeddings = torch.cat(last_hidden_states[1:], dim=1)
+        reasoning_embeddings = recorder.generated_hidden_states
         input_embeddings = self.input_action_proj(input_embeddings.squeeze(0))
         reasoning_embeddings = self.reasoning_action_proj(reasoning_embeddings.squeeze(0))
         all_hidden_states = self.reasoning_film(input_embeddings, reasoning_embeddings).unsqueeze(1)
@@ -1,6 +1,6 @@
 import os
-import random
 
+import numpy as np
 import torch
 import torch.nn as nn
 
@@ -44,6 +44,47 @@ def get_mm_adapter_state_maybe_zero_3(named_params, keys_to_match):
     return to_return
 
 
+def _even_chunk_assignment(lengths, num_chunks):
+    """
+    Greedy shortest-chunk assignment for every row of `lengths` at once.
+
+    `lengths` has shape (rows, n) with n divisible by `num_chunks`. Walking each row in order, an item goes
+    to the shortest chunk that is not full yet (lowest chunk id on ties). Returns, per item, the chunk id and
+    the position inside that chunk.
+    """
+    rows, n = lengths.shape
+    per_chunk = n // num_chunks
+    full = np.iinfo(np.int64).max
+    chunk_lengths = np.zeros((rows, num_chunks), dtype=np.int64)
+    chunk_sizes = np.zeros((rows, num_chunks), dtype=np.int64)
+    chunk_ids = np.empty((rows, n), dtype=np.int64)
+    slots = np.empty((rows, n), dtype=np.int64)
+    row_ids = np.arange(rows)
+    for j in range(n):
+        shortest = chunk_lengths.argmin(axis=1)
+        chunk_ids[:, j] = shortest
+        slots[:, j] = chunk_sizes[row_ids, shortest]
+        chunk_sizes[row_ids, shortest] += 1
+        chunk_lengths[row_ids, shortest] += lengths[:, j]
+        filled = chunk_sizes[row_ids, shortest] == per_chunk
+        chunk_lengths[row_ids[filled], shortest[filled]] = full
+    return chunk_ids, slots
+
+
+def _split_rows_to_even_chunks(indices, lengths, num_chunks):
+    """
+    Vectorized `split_to_even_chunks` over the rows of `indices` (shape (rows, n)); returns the rows
+    reordered chunk after chunk.
+    """
+    rows, n = indices.shape
+    if n % num_chunks != 0:
+        return np.concatenate([indices[:, i::num_chunks] for i in range(num_chunks)], axis=1)
+    chunk_ids, slots = _even_chunk_assignment(lengths[indices], num_chunks)
+    out = np.empty_like(indices)
+    out[np.arange(rows)[:, None], chunk_ids * (n // num_chunks) + slots] = indices
+    return out
+
+
 def split_to_even_chunks(indices, lengths, num_chunks):
     """
     Split a list of indices into `chunks` chunks of roughly equal lengths.
@@ -52,38 +93,46 @@ def split_to_even_chunks(indices, lengths, num_chunks):
     if len(indices) % num_chunks != 0:
         return [indices[i::num_chunks] for i in range(num_chunks)]
 
-    num_indices_per_chunk = len(indices) // num_chunks
+    chunked = _split_rows_to_even_chunks(np.asarray(indices, dtype=np.int64)[None], np.asarray(lengths), num_chunks)
+    return [chunk.tolist() for chunk in np.split(chunked[0], num_chunks)]
 
-    chunks = [[] for _ in range(num_chunks)]
-    chunks_lengths = [0 for _ in range(num_chunks)]
-    for index in indices:
-        shortest_chunk = chunks_lengths.index(min(chunks_lengths))
-        chunks[shortest_chunk].append(index)
-        chunks_lengths[shortest_chunk] += lengths[index]
-        if len(chunks[shortest_chunk]) == num_indices_per_chunk:
-            chunks_lengths[shortest_chunk] = float("inf")
 
-    return chunks
+def _length_grouped_order(lengths, batch_size, world_size, generator=None):
+    """
+    `get_length_grouped_indices` as an int64 array: random megabatches, each sorted by length (longest
+    first, stable) and split into `world_size` chunks of even total length.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    indices = torch.randperm(len(lengths), generator=generator).numpy()
+    megabatch_size = world_size * batch_size * mega_batch_mult
+    num_full = len(indices) // megabatch_size * megabatch_size
+
+    parts = []
+    for block in (indices[:num_full].reshape(-1, megabatch_size), indices[num_full:][None]):
+        if block.size == 0:
+            continue
+        order = np.argsort(-lengths[block], axis=1, kind="stable")
+        block = np.take_along_axis(block, order, axis=1)
+        parts.append(_split_rows_to_even_chunks(block, lengths, world_size).reshape(-1))
+    return np.concatenate(parts) if parts else indices
 
 
 def get_modality_length_grouped_indices(lengths, batch_size, world_size, sample_weights=None, generator=None):
     # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    assert all(l != 0 for l in lengths), "Should not have zero length."
-    robo_indices, robo_lengths = zip(*[(i, l) for i, l in enumerate(lengths) if l > 0])
-    vl_indices, vl_lengths = zip(*[(i, -l) for i, l in enumerate(lengths) if l < 0])
+    lengths = np.asarray(lengths, dtype=np.int64)
+    assert np.all(lengths != 0), "Should not have zero length."
+    robo_indices = np.flatnonzero(lengths > 0)
+    vl_indices = np.flatnonzero(lengths < 0)
 
     assert len(robo_indices) > 0, "Should have at least one robotics sample."
     assert len(vl_indices) > 0, "Should have at least one visual language sample."
     print(f"There are {len(robo_indices)} robotics data and {len(vl_indices)} visual language data.")
-    robo_shuffle = [robo_indices[i] for i in get_length_grouped_indices(robo_lengths, batch_size, world_size, generator=None)]
-    vl_shuffle = [vl_indices[i] for i in get_length_grouped_indices(vl_lengths, batch_size, world_size, generator=None)]
+    robo_shuffle = robo_indices[_length_grouped_order(lengths[robo_indices], batch_size, world_size, generator=generator)]
+    vl_shuffle = vl_indices[_length_grouped_order(-lengths[vl_indices], batch_size, world_size, generator=generator)]
     megabatch_size = world_size * batch_size * mega_batch_mult
     robo_megabatches = [robo_shuffle[i: i + megabatch_size] for i in range(0, len(robo_shuffle), megabatch_size)]
     vl_megabatches = [vl_shuffle[i: i + megabatch_size] for i in range(0, len(vl_shuffle), megabatch_size)]
 
-    last_robo = robo_megabatches[-1]
-    last_vl = vl_megabatches[-1]
-    additional_batch = last_robo + last_vl
     if sample_weights is not None:
         assert len(sample_weights) == 2, "Sample weights should have exactly two elements. One for robot data, another for vl data."
         print("Using custom sample weights: 1:1")
@@ -93,44 +142,32 @@ def get_modality_length_grouped_indices(lengths, batch_size, world_size, sample_
         repeat_nums = len(vl_megabatches) // len(robo_megabatches)
         robo_len = len(robo_megabatches)
         robo_megabatches = robo_megabatches * repeat_nums
-        robo_random = random.sample(range(robo_len - 1), len(vl_megabatches) - len(robo_megabatches))
-        temp = [robo_megabatches[i] for i in robo_random]
-        robo_megabatches = robo_megabatches + temp
+        num_extra = len(vl_megabatches) - len(robo_megabatches)
+        robo_random = torch.randperm(robo_len - 1, generator=generator)[:num_extra].tolist()
+        robo_megabatches = robo_megabatches + [robo_megabatches[i] for i in robo_random]
 
-        # construct megabatches according to sample weights 1:1
+        # construct megabatches according to sample weights 1:1, half a batch of each per rank
         megabatches = []
-        for x,y in zip(robo_megabatches, vl_megabatches):
+        half = batch_size // 2
+        for x, y in zip(robo_megabatches, vl_megabatches):
             tmp = []
             for i in range(world_size):
-                tmp += x[i * batch_size: i * batch_size + batch_size // 2] + y[i * batch_size: i * batch_size + batch_size // 2]
-                tmp += x[i * batch_size + batch_size // 2: i * batch_size + batch_size] + y[i * batch_size + batch_size // 2: i * batch_size + batch_size]
-                megabatches.append(tmp)
+                b = i * batch_size
+                tmp += [x[b: b + half], y[b: b + half], x[b + half: b + batch_size], y[b + half: b + batch_size]]
+            megabatches.append(np.concatenate(tmp))
     else:
+        # throw the last batch of both dataset
         megabatches = robo_megabatches[:-1] + vl_megabatches[:-1]
     # shuffle
-    megabatch_indices = torch.randperm(len(megabatches), generator=generator)
-    megabatches = [megabatches[i] for i in megabatch_indices]
-
-    # throw the last batch of both dataset
-    # if len(additional_batch) >= megabatch_size:
-    #     megabatches = [additional_batch[:megabatch_size]] + megabatches
-    #     additional_batch = additional_batch[megabatch_size:]
-    #
-    # if len(additional_batch) > 0:
-    #     megabatches.append(additional_batch)
-
-    return [i for megabatch in megabatches for i in megabatch]
+    megabatch_indices = torch.randperm(len(megabatches), generator=generator).tolist()
+    if not megabatches:
+        return []
+    return np.concatenate([megabatches[i] for i in megabatch_indices]).tolist()
 
 
 def get_length_grouped_indices(lengths, batch_size, world_size, generator=None, merge=True):
     # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    indices = torch.randperm(len(lengths), generator=generator)
-    megabatch_size = world_size * batch_size * mega_batch_mult
-    megabatches = [indices[i: i + megabatch_size].tolist() for i in range(0, len(lengths), megabatch_size)]
-    megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
-    megabatches = [split_to_even_chunks(megabatch, lengths, world_size) for megabatch in megabatches]
-
-    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+    return _length_grouped_order(lengths, batch_size, world_size, generator=generator).tolist()
 
 
 def _is_peft_model(model):
@@ -10,9 +10,11 @@ class StaticMoE(nn.Module):
         self.experts = nn.ModuleList([expert_module_class(config) for _ in range(2)])
     def forward(self, x, vl_data_mask, eval_in_vqa=False):
         if self.training:
+            # one flag per sample [B], or per token [B, L] when samples are packed into rows
             vl_data_mask = vl_data_mask.type_as(x)
-            mask_dim = x.shape[-2:]
-            vl_data_mask = vl_data_mask.repeat(mask_dim[1], mask_dim[0], 1).transpose(0, 2)
+            if vl_data_mask.dim() == 1:
+                vl_data_mask = vl_data_mask.unsqueeze(-1)
+            vl_data_mask = vl_data_mask.unsqueeze(-1)
             output = self.experts[0](x) * vl_data_mask \
                                 + self.experts[1](x) * (1. - vl_data_mask)
         else:
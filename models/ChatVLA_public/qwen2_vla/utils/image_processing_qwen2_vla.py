@@ -46,7 +46,7 @@ from transformers.image_utils import (
     valid_images,
     validate_preprocess_arguments,
 )
-from transformers.utils import TensorType, is_vision_available, logging
+from transformers.utils import TensorType, is_torch_available, is_vision_available, logging
 
 
 logger = logging.get_logger(__name__)
@@ -55,6 +55,17 @@ logger = logging.get_logger(__name__)
 if is_vision_available():
     from PIL import Image
 
+if is_torch_available():
+    import torch
+    import torch.nn.functional as F
+
+# resampling filters the torch path reproduces; anything else goes through PIL
+TORCH_INTERPOLATION_MODES = {
+    PILImageResampling.NEAREST: "nearest",
+    PILImageResampling.BILINEAR: "bilinear",
+    PILImageResampling.BICUBIC: "bicubic",
+}
+
 
 def make_batched_images(images) -> List[List[ImageInput]]:
     """
@@ -158,6 +169,8 @@ class Qwen2VLImageProcessor(BaseImageProcessor):
             The temporal patch size of the vision encoder.
         merge_size (`int`, *optional*, defaults to 2):
             The merge size of the vision encoder to llm encoder.
+        use_torch_preprocess (`bool`, *optional*, defaults to `True`):
+            Whether to resize, normalize and patchify uint8 images with batched torch ops instead of numpy/PIL.
     """
 
     model_input_names = ["pixel_values", "image_grid_thw", "pixel_values_videos", "video_grid_thw"]
@@ -177,6 +190,7 @@ class Qwen2VLImageProcessor(BaseImageProcessor):
         patch_size: int = 14,
         temporal_patch_size: int = 2,
         merge_size: int = 2,
+        use_torch_preprocess: bool = True,
         **kwargs,
     ) -> None:
         super().__init__(**kwargs)
@@ -194,6 +208,7 @@ class Qwen2VLImageProcessor(BaseImageProcessor):
         self.merge_size = merge_size
         self.size = {"min_pixels": min_pixels, "max_pixels": max_pixels}
         self.do_convert_rgb = do_convert_rgb
+        self.use_torch_preprocess = use_torch_preprocess
 
     def _preprocess(
         self,
@@ -314,6 +329,139 @@ class Qwen2VLImageProcessor(BaseImageProcessor):
 
         return flatten_patches, (grid_t, grid_h, grid_w)
 
+    @staticmethod
+    def _to_uint8_tensor(image, input_data_format=None):
+        """
+        Convert one image to a uint8 (num_channels, height, width) tensor, or return None when it is not uint8 RGB-like.
+        """
+        if is_vision_available() and isinstance(image, Image.Image):
+            image = np.array(image)
+        elif torch.is_tensor(image):
+            image = image.cpu().numpy()
+        if not isinstance(image, np.ndarray) or image.dtype != np.uint8 or image.ndim != 3:
+            return None
+
+        if input_data_format is None:
+            input_data_format = infer_channel_dimension_format(image)
+        image = torch.from_numpy(np.ascontiguousarray(image))
+        if input_data_format == ChannelDimension.LAST:
+            image = image.permute(2, 0, 1)
+        return image
+
+    def _patchify(self, frames: "torch.Tensor"):
+        """
+        Torch version of the patch reshape at the end of `_preprocess`. A single frame is expanded
+        (a view) to `temporal_patch_size`, so it is only duplicated by the final copy.
+        """
+        if frames.shape[0] == 1:
+            frames = frames.expand(self.temporal_patch_size, -1, -1, -1)
+        num_frames, channel, height, width = frames.shape
+        grid_t = num_frames // self.temporal_patch_size
+        grid_h, grid_w = height // self.patch_size, width // self.patch_size
+        patches = frames.reshape(
+            grid_t,
+            self.temporal_patch_size,
+            channel,
+            grid_h // self.merge_size,
+            self.merge_size,
+            self.patch_size,
+            grid_w // self.merge_size,
+            self.merge_size,
+            self.patch_size,
+        )
+        patches = patches.permute(0, 3, 6, 4, 7, 2, 1, 5, 8)
+        flatten_patches = patches.reshape(
+            grid_t * grid_h * grid_w, channel * self.temporal_patch_size * self.patch_size * self.patch_size
+        )
+        return flatten_patches, (grid_t, grid_h, grid_w)
+
+    def _preprocess_torch(
+        self,
+        items: List[List[ImageInput]],
+        do_resize: bool,
+        resample: PILImageResampling,
+        do_rescale: bool,
+        rescale_factor: float,
+        do_normalize: bool,
+        image_mean: Union[float, List[float]],
+        image_std: Union[float, List[float]],
+        do_convert_rgb: bool,
+        input_data_format: Optional[Union[str, ChannelDimension]] = None,
+        device=None,
+    ):
+        """
+        Batched torch version of `_preprocess` for uint8 inputs. `items` holds the frames of each image
+        (a single frame) or video. Returns one `(patches, grid_thw)` per item, or None if an input needs the
+        numpy path.
+
+        Items of the same size are resized together, and rescale and normalize are fused into one
+        multiply-subtract. Resizing uses antialiased interpolation rounded back to uint8 values, matching
+        the PIL resize of `_preprocess` within tolerance.
+        """
+        if not is_torch_available() or (do_resize and resample not in TORCH_INTERPOLATION_MODES):
+            return None
+
+        frames_per_item = []
+        for frames in items:
+            if do_convert_rgb:
+                frames = [convert_to_rgb(frame) for frame in frames]
+            frames = [self._to_uint8_tensor(frame, input_data_format) for frame in frames]
+            if any(frame is None for frame in frames):
+                return None
+            frames_per_item.append(torch.stack(frames))
+
+        num_channels = frames_per_item[0].shape[1]
+        scale = torch.ones(num_channels, device=device)
+        shift = torch.zeros(num_channels, device=device)
+        if do_rescale:
+            scale = scale * rescale_factor
+        if do_normalize:
+            mean = torch.as_tensor(image_mean, dtype=torch.float32, device=device).expand(num_channels)
+            std = torch.as_tensor(image_std, dtype=torch.float32, device=device).expand(num_channels)
+            scale, shift = scale / std, mean / std
+        scale, shift = scale.view(1, -1, 1, 1), shift.view(1, -1, 1, 1)
+
+        items_by_size = {}
+        for index, frames in enumerate(frames_per_item):
+            items_by_size.setdefault(tuple(frames.shape[1:]), []).append(index)
+
+        outputs = [None] * len(items)
+        for (_, height, width), indices in items_by_size.items():
+            batch = torch.cat([frames_per_item[i] for i in indices]).to(device=device, dtype=torch.float32)
+            if do_resize:
+                resized_height, resized_width = smart_resize(
+                    height,
+                    width,
+                    factor=self.patch_size * self.merge_size,
+                    min_pixels=self.min_pixels,
+                    max_pixels=self.max_pixels,
+                )
+                if (resized_height, resized_width) != (height, width):
+                    mode = TORCH_INTERPOLATION_MODES[resample]
+                    batch = F.interpolate(
+                        batch,
+                        size=(resized_height, resized_width),
+                        mode=mode,
+                        align_corners=None if mode == "nearest" else False,
+                        antialias=mode != "nearest",
+                    )
+                    batch = batch.round_().clamp_(0, 255)
+            batch = batch.mul_(scale).sub_(shift)
+
+            offset = 0
+            for i in indices:
+                num_frames = frames_per_item[i].shape[0]
+                outputs[i] = self._patchify(batch[offset:offset + num_frames])
+                offset += num_frames
+
+        return outputs
+
+    def _collect(self, outputs, return_tensors):
+        pixel_values = torch.cat([patches for patches, _ in outputs])
+        if return_tensors not in ("pt", TensorType.PYTORCH):
+            pixel_values = pixel_values.cpu().numpy()
+        return pixel_values, np.array([grid_thw for _, grid_thw in outputs])
+
     def preprocess(
         self,
         images: ImageInput,
@@ -330,6 +478,7 @@ class Qwen2VLImageProcessor(BaseImageProcessor):
         return_tensors: Optional[Union[str, TensorType]] = None,
         data_format: Optional[ChannelDimension] = ChannelDimension.FIRST,
         input_data_format: Optional[Union[str, ChannelDimension]] = None,
+        device=None,
     ):
         """
         Args:
@@ -378,6 +527,8 @@ class Qwen2VLImageProcessor(BaseImageProcessor):
                 - `"channels_first"` or `ChannelDimension.FIRST`: image in (num_channels, height, width) format.
                 - `"channels_last"` or `ChannelDimension.LAST`: image in (height, width, num_channels) format.
                 - `"none"` or `ChannelDimension.NONE`: image in (height, width) format.
+            device (`str` or `torch.device`, *optional*):
+                Device for the torch preprocessing path. Defaults to CPU.
 
         """
         do_resize = do_resize if do_resize is not None else self.do_resize
@@ -411,7 +562,27 @@ class Qwen2VLImageProcessor(BaseImageProcessor):
             resample=resample,
         )
 
-        if images is not None:
+        torch_kwargs = dict(
+            do_resize=do_resize,
+            resample=resample,
+            do_rescale=do_rescale,
+            rescale_factor=rescale_factor,
+            do_normalize=do_normalize,
+            image_mean=image_mean,
+            image_std=image_std,
+            do_convert_rgb=do_convert_rgb,
+            input_data_format=input_data_format,
+            device=device,
+        )
+        use_torch = self.use_torch_preprocess and data_format == ChannelDimension.FIRST
+
+        outputs = None
+        if images is not None and use_torch:
+            outputs = self._preprocess_torch([[image] for image in images], **torch_kwargs)
+        if outputs is not None:
+            pixel_values, vision_grid_thws = self._collect(outputs, return_tensors)
+            data = {"pixel_values": pixel_values, "image_grid_thw": vision_grid_thws}
+        elif images is not None:
             pixel_values, vision_grid_thws = [], []
             for image in images:
                 patches, image_grid_thw = self._preprocess(
@@ -433,7 +604,13 @@ class Qwen2VLImageProcessor(BaseImageProcessor):
             vision_grid_thws = np.array(vision_grid_thws)
             data = {"pixel_values": pixel_values, "image_grid_thw": vision_grid_thws}
 
-        if videos is not None:
+        outputs = None
+        if videos is not None and use_torch:
+            outputs = self._preprocess_torch([list(video) for video in videos], **torch_kwargs)
+        if outputs is not None:
+            pixel_values, vision_grid_thws = self._collect(outputs, return_tensors)
+            data = {"pixel_values_videos": pixel_values, "video_grid_thw": vision_grid_thws}
+        elif videos is not None:
             pixel_values, vision_grid_thws = [], []
             for images in videos:
                 patches, video_grid_thw = self._preprocess(
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+
+import torch
+from transformers.cache_utils import DynamicCache
+
+
+class PrefixKVCache:
+    """
+    Reuse the past key/values of a tokenized text prefix across generate calls.
+
+    Prompts built from the same chat template (and robot rollouts that repeat one
+    instruction) start with identical text tokens. The prefix ends at the first
+    vision token, since everything after it depends on the image content. Each
+    distinct prefix is prefilled once and forked per request.
+    """
+
+    def __init__(self, max_entries=8, min_prefix_len=1):
+        self.max_entries = max_entries
+        self.min_prefix_len = min_prefix_len
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def prefix_length(self, model, input_ids, attention_mask=None):
+        """
+        Length of the text prefix shared by every row of `input_ids`.
+
+        Stops before the first vision token and keeps at least one token for the
+        prefill step. Returns 0 when rows are left-padded or differ at the start.
+        """
+        config = model.config
+        boundary = torch.zeros_like(input_ids[0], dtype=torch.bool)
+        for name in ("vision_start_token_id", "image_token_id", "video_token_id"):
+            token_id = getattr(config, name, None)
+            if token_id is not None:
+                boundary |= input_ids[0] == token_id
+
+        length = input_ids.shape[1] - 1
+        if boundary.any():
+            length = min(length, int(boundary.int().argmax()))
+
+        stop = (input_ids != input_ids[:1]).any(dim=0)
+        if attention_mask is not None:
+            stop |= (attention_mask == 0).any(dim=0)
+        if stop.any():
+            length = min(length, int(stop.int().argmax()))
+
+        return length if length >= self.min_prefix_len else 0
+
+    @torch.no_grad()
+    def get(self, model, prefix_ids, eval_in_vqa=False):
+        """
+        Return (legacy key/values, last hidden states) for `prefix_ids` of shape [1, P].
+
+        The expert routing depends on `eval_in_vqa`, so it is part of the key.
+        """
+        key = (tuple(prefix_ids[0].tolist()), bool(eval_in_vqa))
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        prefix_ids = prefix_ids.to(model.device)
+        prefix_len = prefix_ids.shape[1]
+        # text before any vision token gets plain positions on all three rope axes
+        position_ids = torch.arange(prefix_len, device=prefix_ids.device).view(1, 1, -1).expand(3, 1, -1)
+        outputs = model.model(
+            input_ids=None,
+            inputs_embeds=model.model.embed_tokens(prefix_ids),
+            position_ids=position_ids,
+            attention_mask=torch.ones_like(prefix_ids),
+            past_key_values=DynamicCache(),
+            use_cache=True,
+            return_dict=True,
+            eval_in_vqa=eval_in_vqa,
+        )
+        entry = (outputs.past_key_values.to_legacy_cache(), outputs.last_hidden_state)
+
+        self._entries[key] = entry
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def fork(self, model, input_ids, attention_mask=None, eval_in_vqa=False):
+        """
+        Build a per-request cache that already holds the shared prefix.
+
+        Returns (past_key_values, prefix_length, prefix_hidden_states); the cache is
+        None and the length 0 when no prefix can be reused. The cached tensors are
+        only expanded into a `DynamicCache`, whose updates never write into them.
+        """
+        prefix_len = self.prefix_length(model, input_ids, attention_mask)
+        if prefix_len == 0:
+            return None, 0, None
+
+        key_values, hidden_states = self.get(model, input_ids[:1, :prefix_len], eval_in_vqa=eval_in_vqa)
+        batch_size = input_ids.shape[0]
+        past_key_values = DynamicCache.from_legacy_cache(
+            tuple((k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1)) for k, v in key_values)
+        )
+
+        return past_key_values, prefix_len, hidden_states.expand(batch_size, -1, -1)
@@ -23,6 +23,7 @@ Processor class for Qwen2-VL.
 
 from typing import List, Union
 
+from transformers.data.data_collator import pad_without_fast_tokenizer_warning
 from transformers.feature_extraction_utils import BatchFeature
 from transformers.image_utils import ImageInput
 from transformers.video_utils import VideoInput
@@ -42,6 +43,10 @@ class Qwen2VLProcessorKwargs(ProcessingKwargs, total=False):
     }
 
 
+# tokenizer arguments reproduced when splicing pad runs into input_ids; others expand the text instead
+SPLICE_TEXT_KWARGS = {"padding", "max_length", "pad_to_multiple_of", "return_tensors", "return_attention_mask", "add_special_tokens"}
+
+
 class Qwen2VLProcessor(ProcessorMixin):
     r"""
     Constructs a Qwen2-VL processor which wraps a Qwen2-VL image processor and a Qwen2 tokenizer into a single processor.
@@ -129,6 +134,18 @@ class Qwen2VLProcessor(ProcessorMixin):
         if not isinstance(text, list):
             text = [text]
 
+        merge_length = self.image_processor.merge_size**2
+        pad_runs = {}
+        if image_grid_thw is not None:
+            pad_runs["<|image_pad|>"] = [int(grid.prod()) // merge_length for grid in image_grid_thw]
+        if video_grid_thw is not None:
+            pad_runs["<|video_pad|>"] = [int(grid.prod()) // merge_length for grid in video_grid_thw]
+
+        text_kwargs = output_kwargs["text_kwargs"]
+        if pad_runs and all(isinstance(t, str) for t in text) and set(text_kwargs) <= SPLICE_TEXT_KWARGS:
+            text_inputs = self._tokenize_with_pad_runs(text, pad_runs, dict(text_kwargs))
+            return BatchFeature(data={**text_inputs, **image_inputs, **videos_inputs})
+
         if image_grid_thw is not None:
             merge_length = self.image_processor.merge_size**2
             index = 0
@@ -155,6 +172,40 @@ class Qwen2VLProcessor(ProcessorMixin):
 
         return BatchFeature(data={**text_inputs, **image_inputs, **videos_inputs})
 
+    def _tokenize_with_pad_runs(self, text, pad_runs, text_kwargs):
+        """
+        Tokenize `text` with a single id per `<|image_pad|>` / `<|video_pad|>` and splice in a run of
+        the right length for each one, then pad. Gives the same ids as expanding the placeholders in
+        the string, without building and re-lexing the long expanded text.
+        """
+        pad_kwargs = {
+            key: text_kwargs.pop(key)
+            for key in ("padding", "max_length", "pad_to_multiple_of", "return_tensors")
+            if key in text_kwargs
+        }
+        return_attention_mask = text_kwargs.get("return_attention_mask", None)
+        encoded = self.tokenizer(text, padding=False, **text_kwargs)
+
+        run_lengths = {
+            self.tokenizer.convert_tokens_to_ids(token): iter(lengths) for token, lengths in pad_runs.items()
+        }
+        input_ids = []
+        for ids in encoded["input_ids"]:
+            expanded = []
+            for token_id in ids:
+                if token_id in run_lengths:
+                    expanded.extend([token_id] * next(run_lengths[token_id]))
+                else:
+                    expanded.append(token_id)
+            input_ids.append(expanded)
+
+        features = {"input_ids": input_ids}
+        if "attention_mask" in encoded:
+            features["attention_mask"] = [[1] * len(ids) for ids in input_ids]
+        return pad_without_fast_tokenizer_warning(
+            self.tokenizer, features, return_attention_mask=return_attention_mask, **pad_kwargs
+        )
+
     def batch_decode(self, *args, **kwargs):
         """
         This method forwards all its arguments to Qwen2TokenizerFast's [`~PreTrainedTokenizer.batch_decode`]. Please
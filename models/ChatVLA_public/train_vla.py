@@ -121,6 +121,9 @@ class TrainingArguments(transformers.TrainingArguments):
     lora_bias: str = "none"
     non_lora_lr: Optional[float] = None
     group_by_modality_length: bool = field(default=False)
+    # pack several samples into each sequence up to model_max_length tokens
+    pack_sequences: bool = field(default=False)
+    model_max_length: int = field(default=2048)
 
     double_quant: bool = field(
         default=True,
@@ -186,7 +189,9 @@ def train_bc(train_dataset=None, val_dataset=None, model=None, config=None, samp
     compute_dtype = (
         torch.float16 if training_args.fp16 else (torch.bfloat16 if config['training_args'].bf16 else torch.float32))
     data_collator = DataCollatorForSupervisedDataset(multimodal_processor=processor, computed_type=compute_dtype,
-                                                     tokenizer=tokenizer)
+                                                     tokenizer=tokenizer,
+                                                     model_max_length=config['training_args'].model_max_length,
+                                                     pack_sequences=config['training_args'].pack_sequences)
 
     model.config.use_cache = True
     model.config.save_pretrained(config['training_args'].output_dir)
@@ -1,17 +1,26 @@
 import logging
 import torch
 from omegaconf import OmegaConf
-from common.registry import registry
+from common.registry import registry, lazy_getattr
 
 from models.base_model import BaseModel
-from models.paligemma_vqa import PaliGemma_VQA
-from models.llava_vqa import Llava_VQA
-from models.openvla import OpenVLA
-from models.qwenvl import QwenVL
-from models.chatvla import ChatVLA
 
 from processors.base_processor import BaseProcessor
 
+# model wrappers pull in their whole modeling stack, so they are imported when first looked up
+registry.register_lazy("model", "paligemma_vqa", "models.paligemma_vqa")
+registry.register_lazy("model", "llava_vqa", "models.llava_vqa")
+registry.register_lazy("model", "qwenvl", "models.qwenvl")
+registry.register_lazy("model", "chatvla", "models.chatvla")
+
+__getattr__ = lazy_getattr(__name__, {
+    "PaliGemma_VQA": "models.paligemma_vqa",
+    "Llava_VQA": "models.llava_vqa",
+    "OpenVLA": "models.openvla",
+    "QwenVL": "models.qwenvl",
+    "ChatVLA": "models.chatvla",
+})
+
 
 __all__ = [
     "load_model",
@@ -169,10 +178,12 @@ class ModelZoo:
     >>> print(len(model_zoo))
     """
 
-    def __init__(self) -> None:
-        self.model_zoo = {
-            k: list(v.PRETRAINED_MODEL_CONFIG_DICT.keys())
-            for k, v in registry.mapping["model_name_mapping"].items()
+    @property
+    def model_zoo(self):
+        # resolving every listed model imports all of them, so only do it when the zoo is inspected
+        return {
+            k: list(registry.get_model_class(k).PRETRAINED_MODEL_CONFIG_DICT.keys())
+            for k in registry.list_models()
         }
 
     def __str__(self) -> str:
@@ -11,6 +11,7 @@ import os
 import numpy as np
 import torch
 import torch.nn as nn
+from common.checkpoint import load_state_dict_mmap
 from common.dist_utils import download_cached_file, is_dist_avail_and_initialized
 from common.utils import get_abs_path, is_url
 from omegaconf import OmegaConf
@@ -34,21 +35,15 @@ class BaseModel(nn.Module):
         """
 
         if is_url(url_or_filename):
-            cached_file = download_cached_file(
+            checkpoint_path = download_cached_file(
                 url_or_filename, check_hash=False, progress=True
             )
-            checkpoint = torch.load(cached_file, map_location="cpu")
-        elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location="cpu")
+        elif os.path.exists(url_or_filename):
+            checkpoint_path = url_or_filename
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        if "model" in checkpoint.keys():
-            state_dict = checkpoint["model"]
-        else:
-            state_dict = checkpoint
-
-        msg = self.load_state_dict(state_dict, strict=False)
+        msg = load_state_dict_mmap(self, checkpoint_path)
 
         logging.info("Missing keys {}".format(msg.missing_keys))
         logging.info("load checkpoint from %s" % url_or_filename)
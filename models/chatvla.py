@@ -8,18 +8,20 @@ import torch
 from transformers import AutoProcessor, AutoModelForVision2Seq, AutoModelForCausalLM
 from common.registry import registry
 from models.base_model import BaseModel
+from common.checkpoint import WiSEInterpolator, load_state_dict_mmap
 from common.utils import get_abs_path, is_url, download_cached_file
 import numpy as np
 from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
 import contextlib
 import copy
-from tasks.vqa_task_utils import QAOutput
+from tasks.vqa_task_utils import QAOutput, LemmatizerMixin
 
 from models.ChatVLA_public.qwen2_vla import *
+from models.ChatVLA_public.qwen2_vla.utils.prefix_cache import PrefixKVCache
 from models.ChatVLA_public.policy_heads import *
 
 @registry.register_model("chatvla")
-class ChatVLA(BaseModel):
+class ChatVLA(LemmatizerMixin, BaseModel):
     """
     ChatVLA model.
     """
@@ -34,13 +36,17 @@ class ChatVLA(BaseModel):
         dtype=torch.bfloat16,
         apply_lemmatizer=False,
         return_action=False,
+        prefix_cache=False,
     ):
         super().__init__()
+        self.init_lemmatizer(apply_lemmatizer)
 
         self.model_id = model_id
         print("model_id", model_id)
         self.dtype = dtype
         self.return_action = return_action
+        # every question is wrapped in the same chat template, prefill its text prefix once
+        self.prefix_cache = PrefixKVCache() if prefix_cache else None
 
         self.processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
 
@@ -54,9 +60,6 @@ class ChatVLA(BaseModel):
         self.config = self.model.config
 
         # print(self.config)
-
-        self._apply_lemmatizer = apply_lemmatizer
-        self._lemmatizer = None
     
     def maybe_autocast(self, dtype=torch.float16):
         # if on cpu, don't use autocast
@@ -150,12 +153,21 @@ class ChatVLA(BaseModel):
                 outputs = self._lemmatize(outputs)
             return tuple(all_actions, outputs)
         else:
+            prefix_kwargs = {}
+            if self.prefix_cache is not None:
+                past_key_values, prefix_length, _ = self.prefix_cache.fork(
+                    self.model, model_inputs["input_ids"], model_inputs["attention_mask"], eval_in_vqa=True
+                )
+                if prefix_length > 0:
+                    prefix_kwargs = dict(past_key_values=past_key_values, prefix_length=prefix_length)
+
             outputs = self.model.generate(
                 **model_inputs,
                 is_eval=True,
                 eval_in_vqa=True,
                 max_new_tokens=100, 
                 do_sample=False,
+                **prefix_kwargs,
             )
 
             outputs = outputs[:, input_len:]
@@ -171,51 +183,17 @@ class ChatVLA(BaseModel):
             else:
                 return output_text
 
-    def _lemmatize(self, answers):
-        def apply(answer):
-            doc = self.lemmatizer(answer)
-
-            words = []
-            for token in doc:
-                if token.pos_ in ["NOUN", "VERB"]:
-                    words.append(token.lemma_)
-                else:
-                    words.append(token.text)
-            answer = " ".join(words)
-
-            return answer
-
-        return [apply(answer) for answer in answers]
-
-    @property
-    def lemmatizer(self):
-        if self._lemmatizer is None:
-            try:
-                import spacy
-
-                self._lemmatizer = spacy.load("en_core_web_sm")
-            except ImportError:
-                logging.error(
-                    """
-                    Please install spacy and en_core_web_sm model to apply lemmatization.
-                    python -m spacy download en_core_web_sm
-                    OR
-                    import spacy.cli
-                    spacy.cli.download("en_core_web_sm")
-                    """
-                )
-                exit(1)
-
-        return self._lemmatizer
-
     @classmethod
     def from_config(cls, cfg):
         model_id = cfg.get("model_id", "zzymeow/ChatVLA")
         dtype = cfg.get("dtype", torch.bfloat16)
+        prefix_cache = cfg.get("prefix_cache", False)
 
         model = cls(
             model_id=model_id,
             dtype=dtype,
+            apply_lemmatizer=cfg.get("apply_lemmatizer", False),
+            prefix_cache=prefix_cache,
         )
 
         load_finetuned = cfg.get("load_finetuned", False)
@@ -258,25 +236,27 @@ class ChatVLA(BaseModel):
         
         # WiSE
         wise = int(cfg.get("wise", 0))
+        interpolator = None
         if wise == 1:
             assert load_finetuned, "WiSE requires load_finetuned=True"
-            w0 = {key: value.to('cpu') for key, value in model.state_dict().items()}
-            w0 = copy.deepcopy(w0)
-        
-        if load_finetuned:
-            model.load_checkpoint_from_config(cfg)
+            interpolator = WiSEInterpolator()
+
+        # record the zero-shot value of every tensor the checkpoints overwrite
+        with interpolator.track() if interpolator is not None else contextlib.nullcontext():
+            if load_finetuned:
+                model.load_checkpoint_from_config(cfg)
 
-        finetune_lp_path = cfg.get("finetuned_lp", None)
-        if finetune_lp_path is not None:
-            model.load_checkpoint(finetune_lp_path)
-            logging.info("load linear probe checkpoint from %s" % finetune_lp_path)
+            finetune_lp_path = cfg.get("finetuned_lp", None)
+            if finetune_lp_path is not None:
+                model.load_checkpoint(finetune_lp_path)
+                logging.info("load linear probe checkpoint from %s" % finetune_lp_path)
         
-        if wise == 1:
-            w1 = {key: value.to('cpu') for key, value in model.state_dict().items()}
+        if interpolator is not None:
             # alpha * w0 + (1 - alpha) * w1
-            alpha = 0.5
-            wise = {key: (alpha * w0[key] + (1 - alpha) * w1[key]).to(model.device) for key in w1.keys()}
-            model.load_state_dict(wise)
+            alpha = float(cfg.get("wise_alpha", 0.5))
+            interpolator.blend(alpha)
+            model.wise = interpolator
+            model.wise_alphas = [float(a) for a in cfg.get("wise_alphas", [alpha])]
             logging.info("WiSE: load finetuned model and apply WiSE")
 
         # print("Final Model before runner", model)
@@ -285,63 +265,42 @@ class ChatVLA(BaseModel):
     
     def load_from_pretrained(self, url_or_filename):
         if is_url(url_or_filename):
-            cached_file = download_cached_file(
+            checkpoint_path = download_cached_file(
                 url_or_filename, check_hash=False, progress=True
             )
-            checkpoint = torch.load(cached_file, map_location=self.device, weights_only=True)
-        elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location=self.device, weights_only=True)
+        elif os.path.exists(url_or_filename):
+            checkpoint_path = url_or_filename
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        state_dict = checkpoint["model"]
-        for key in list(state_dict.keys()):
-            start_key = "base_model.model.model."
-            if key.startswith(start_key):
-                state_dict[key[len(start_key):]] = state_dict.pop(key)
-        
-        # Load the current state_dict of the model
-        current_state_dict = self.model.state_dict()
-
-        # Update the current state_dict with the new parameters
-        for key in state_dict.keys():
-            assert key in current_state_dict, f"key {key} not in current_state_dict"
-            current_state_dict[key] = state_dict[key]
-
-        # Load the updated state_dict back into the model
-        self.model.load_state_dict(current_state_dict)
+        # copy the memory-mapped weights straight into the model, renaming keys on the way
+        msg = load_state_dict_mmap(
+            self.model,
+            checkpoint_path,
+            prefix_rules={"base_model.model.model.": ""},
+            weights_only=True,
+        )
+        assert not msg.unexpected_keys, f"keys {msg.unexpected_keys} not in current_state_dict"
         logging.info("load pretrained checkpoint from %s" % url_or_filename)
 
     def load_checkpoint(self, url_or_filename):
         if is_url(url_or_filename):
-            cached_file = download_cached_file(
+            checkpoint_path = download_cached_file(
                 url_or_filename, check_hash=False, progress=True
             )
-            checkpoint = torch.load(cached_file, map_location=self.device, weights_only=True)
-        elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location=self.device, weights_only=True)
+        elif os.path.exists(url_or_filename):
+            checkpoint_path = url_or_filename
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        state_dict = checkpoint["model"]
-        for key in list(state_dict.keys()):
-            start_key = "base_model.model.model."
-            start_key_2 = "model."
-            if key.startswith(start_key):
-                state_dict[key[len(start_key):]] = state_dict.pop(key)
-            elif key.startswith(start_key_2):
-                state_dict[key[len(start_key_2):]] = state_dict.pop(key)
-        
-        # Load the current state_dict of the model
-        current_state_dict = self.model.state_dict()
-
-        # Update the current state_dict with the new parameters
-        for key in state_dict.keys():
-            assert key in current_state_dict, f"key {key} not in current_state_dict"
-            current_state_dict[key] = state_dict[key]
-
-        # Load the updated state_dict back into the model
-        self.model.load_state_dict(current_state_dict)
+        # copy the memory-mapped weights straight into the model, renaming keys on the way
+        msg = load_state_dict_mmap(
+            self.model,
+            checkpoint_path,
+            prefix_rules={"base_model.model.model.": "", "model.": ""},
+            weights_only=True,
+        )
+        assert not msg.unexpected_keys, f"keys {msg.unexpected_keys} not in current_state_dict"
         logging.info("load checkpoint from %s" % url_or_filename)
 
 
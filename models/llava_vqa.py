@@ -8,16 +8,17 @@ import torch
 from transformers import AutoProcessor, LlavaForConditionalGeneration, LlavaConfig, BitsAndBytesConfig
 from common.registry import registry
 from models.base_model import BaseModel
+from common.checkpoint import WiSEInterpolator, load_state_dict_mmap
 from common.utils import get_abs_path, is_url, download_cached_file
 import numpy as np
 from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
 import contextlib
 import copy
-from tasks.vqa_task_utils import QAOutput
+from tasks.vqa_task_utils import QAOutput, LemmatizerMixin
 
 
 @registry.register_model("llava_vqa")
-class Llava_VQA(BaseModel):
+class Llava_VQA(LemmatizerMixin, BaseModel):
     """
     Paligemma VQA model.
     Supported model types:
@@ -36,6 +37,7 @@ class Llava_VQA(BaseModel):
         apply_lemmatizer=False,
     ):
         super().__init__()
+        self.init_lemmatizer(apply_lemmatizer)
 
         self.model_id = model_id
         print("model_id", model_id)
@@ -57,9 +59,6 @@ class Llava_VQA(BaseModel):
         self.config = self.model.config
 
         print(self.config)
-
-        self._apply_lemmatizer = apply_lemmatizer
-        self._lemmatizer = None
     
     def maybe_autocast(self, dtype=torch.float16):
         # if on cpu, don't use autocast
@@ -164,43 +163,6 @@ class Llava_VQA(BaseModel):
         else:
             return output_text
     
-    def _lemmatize(self, answers):
-        def apply(answer):
-            doc = self.lemmatizer(answer)
-
-            words = []
-            for token in doc:
-                if token.pos_ in ["NOUN", "VERB"]:
-                    words.append(token.lemma_)
-                else:
-                    words.append(token.text)
-            answer = " ".join(words)
-
-            return answer
-
-        return [apply(answer) for answer in answers]
-
-    @property
-    def lemmatizer(self):
-        if self._lemmatizer is None:
-            try:
-                import spacy
-
-                self._lemmatizer = spacy.load("en_core_web_sm")
-            except ImportError:
-                logging.error(
-                    """
-                    Please install spacy and en_core_web_sm model to apply lemmatization.
-                    python -m spacy download en_core_web_sm
-                    OR
-                    import spacy.cli
-                    spacy.cli.download("en_core_web_sm")
-                    """
-                )
-                exit(1)
-
-        return self._lemmatizer
-
     @classmethod
     def from_config(cls, cfg):
         model_id = cfg.get("model_id", "llava-hf/llava-1.5-7b-hf")
@@ -209,6 +171,7 @@ class Llava_VQA(BaseModel):
         model = cls(
             model_id=model_id,
             dtype=dtype,
+            apply_lemmatizer=cfg.get("apply_lemmatizer", False),
         )
 
         load_finetuned = cfg.get("load_finetuned", False)
@@ -274,25 +237,27 @@ class Llava_VQA(BaseModel):
         
         # WiSE
         wise = int(cfg.get("wise", 0))
+        interpolator = None
         if wise == 1:
             assert load_finetuned, "WiSE requires load_finetuned=True"
-            w0 = {key: value.to('cpu') for key, value in model.state_dict().items()}
-            w0 = copy.deepcopy(w0)
-        
-        if load_finetuned:
-            model.load_checkpoint_from_config(cfg)
+            interpolator = WiSEInterpolator()
 
-        finetune_lp_path = cfg.get("finetuned_lp", None)
-        if finetune_lp_path is not None:
-            model.load_checkpoint(finetune_lp_path)
-            logging.info("load linear probe checkpoint from %s" % finetune_lp_path)
+        # record the zero-shot value of every tensor the checkpoints overwrite
+        with interpolator.track() if interpolator is not None else contextlib.nullcontext():
+            if load_finetuned:
+                model.load_checkpoint_from_config(cfg)
+
+            finetune_lp_path = cfg.get("finetuned_lp", None)
+            if finetune_lp_path is not None:
+                model.load_checkpoint(finetune_lp_path)
+                logging.info("load linear probe checkpoint from %s" % finetune_lp_path)
         
-        if wise == 1:
-            w1 = {key: value.to('cpu') for key, value in model.state_dict().items()}
+        if interpolator is not None:
             # alpha * w0 + (1 - alpha) * w1
-            alpha = 0.5
-            wise = {key: (alpha * w0[key] + (1 - alpha) * w1[key]).to(model.device) for key in w1.keys()}
-            model.load_state_dict(wise)
+            alpha = float(cfg.get("wise_alpha", 0.5))
+            interpolator.blend(alpha)
+            model.wise = interpolator
+            model.wise_alphas = [float(a) for a in cfg.get("wise_alphas", [alpha])]
             logging.info("WiSE: load finetuned model and apply WiSE")
 
         print("Final Model before runner", model)
@@ -301,63 +266,42 @@ class Llava_VQA(BaseModel):
     
     def load_from_pretrained(self, url_or_filename):
         if is_url(url_or_filename):
-            cached_file = download_cached_file(
+            checkpoint_path = download_cached_file(
                 url_or_filename, check_hash=False, progress=True
             )
-            checkpoint = torch.load(cached_file, map_location=self.device, weights_only=True)
-        elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location=self.device, weights_only=True)
+        elif os.path.exists(url_or_filename):
+            checkpoint_path = url_or_filename
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        state_dict = checkpoint["model"]
-        for key in list(state_dict.keys()):
-            start_key = "base_model.model.model."
-            if key.startswith(start_key):
-                state_dict[key[len(start_key):]] = state_dict.pop(key)
-        
-        # Load the current state_dict of the model
-        current_state_dict = self.model.state_dict()
-
-        # Update the current state_dict with the new parameters
-        for key in state_dict.keys():
-            assert key in current_state_dict, f"key {key} not in current_state_dict"
-            current_state_dict[key] = state_dict[key]
-
-        # Load the updated state_dict back into the model
-        self.model.load_state_dict(current_state_dict)
+        # copy the memory-mapped weights straight into the model, renaming keys on the way
+        msg = load_state_dict_mmap(
+            self.model,
+            checkpoint_path,
+            prefix_rules={"base_model.model.model.": ""},
+            weights_only=True,
+        )
+        assert not msg.unexpected_keys, f"keys {msg.unexpected_keys} not in current_state_dict"
         logging.info("load pretrained checkpoint from %s" % url_or_filename)
 
     def load_checkpoint(self, url_or_filename):
         if is_url(url_or_filename):
-            cached_file = download_cached_file(
+            checkpoint_path = download_cached_file(
                 url_or_filename, check_hash=False, progress=True
             )
-            checkpoint = torch.load(cached_file, map_location=self.device, weights_only=True)
-        elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location=self.device, weights_only=True)
+        elif os.path.exists(url_or_filename):
+            checkpoint_path = url_or_filename
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        state_dict = checkpoint["model"]
-        for key in list(state_dict.keys()):
-            start_key = "base_model.model.model."
-            start_key_2 = "model."
-            if key.startswith(start_key):
-                state_dict[key[len(start_key):]] = state_dict.pop(key)
-            elif key.startswith(start_key_2):
-                state_dict[key[len(start_key_2):]] = state_dict.pop(key)
-        
-        # Load the current state_dict of the model
-        current_state_dict = self.model.state_dict()
-
-        # Update the current state_dict with the new parameters
-        for key in state_dict.keys():
-            assert key in current_state_dict, f"key {key} not in current_state_dict"
-            current_state_dict[key] = state_dict[key]
-
-        # Load the updated state_dict back into the model
-        self.model.load_state_dict(current_state_dict)
+        # copy the memory-mapped weights straight into the model, renaming keys on the way
+        msg = load_state_dict_mmap(
+            self.model,
+            checkpoint_path,
+            prefix_rules={"base_model.model.model.": "", "model.": ""},
+            weights_only=True,
+        )
+        assert not msg.unexpected_keys, f"keys {msg.unexpected_keys} not in current_state_dict"
         logging.info("load checkpoint from %s" % url_or_filename)
 
 
@@ -8,15 +8,18 @@ import torch
 from transformers import AutoProcessor, PaliGemmaForConditionalGeneration, PaliGemmaConfig, PaliGemmaProcessor, BitsAndBytesConfig
 from common.registry import registry
 from models.base_model import BaseModel
+from common.checkpoint import WiSEInterpolator, load_state_dict_mmap
 from common.utils import get_abs_path, is_url, download_cached_file
 import numpy as np
 from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
 import contextlib
 import copy
-from tasks.vqa_task_utils import QAOutput
+from tasks.vqa_task_utils import QAOutput, LemmatizerMixin
+
+IMAGE_TOKEN_ID = 257152
 
 @registry.register_model("paligemma_vqa")
-class PaliGemma_VQA(BaseModel):
+class PaliGemma_VQA(LemmatizerMixin, BaseModel):
     """
     Paligemma VQA model.
     Supported model types:
@@ -37,6 +40,7 @@ class PaliGemma_VQA(BaseModel):
         apply_lemmatizer=False,
     ):
         super().__init__()
+        self.init_lemmatizer(apply_lemmatizer)
 
         self.model_id = model_id
         print("model_id", model_id)
@@ -58,9 +62,6 @@ class PaliGemma_VQA(BaseModel):
         self.config = self.model.config
 
         print(self.config)
-
-        self._apply_lemmatizer = apply_lemmatizer
-        self._lemmatizer = None
     
     def maybe_autocast(self, dtype=torch.float16):
         # if on cpu, don't use autocast
@@ -90,32 +91,70 @@ class PaliGemma_VQA(BaseModel):
         model_inputs = self.processor(text=samples["text_input_raw"], images=samples["image_raw"], suffix=samples["multiple_choice_answer"], return_tensors="pt", padding="longest").to(self.dtype).to(self.device)
         outputs = self.model(**model_inputs, output_attentions=True)
         return model_inputs, outputs
-    
-    def attn_scores(self, samples):
-        with torch.inference_mode():
-            tokens, outputs = self.return_all_outputs(samples)
-        
-        img_ratio = []
-        txt_ratio = []
-        for i in range(len(samples['image_raw'])):
-            attn = outputs.attentions[-1][i].mean(dim=0)  #-1: lastlayer (batch_size, num_heads, seq_len, seq_len) -> (batch_size, seq_len, seq_len)
-            attn = attn.float()
-
-            img_token_idx = tokens['input_ids'][i] == 257152
-            suffix_token_idx = tokens['token_type_ids'][i] == 1
-            prefix_token_idx = (img_token_idx == False) & (suffix_token_idx == False)
-
-            img_sum = (attn[img_token_idx][:, prefix_token_idx].sum(dim=1) + attn[img_token_idx][:, img_token_idx].sum(dim=1)).cpu().numpy()
-            txt_sum = (attn[prefix_token_idx][:, prefix_token_idx].sum(dim=1) + attn[prefix_token_idx][:, img_token_idx].sum(dim=1)).cpu().numpy()
-            # img_sum and txt_sum are all one value
-            print("img_sum", img_sum)
-            print("txt_sum", txt_sum)
-            assert np.allclose(img_sum, np.ones_like(img_sum), atol=1e-2), "Elements are not within the tolerance"
-            assert np.allclose(txt_sum, np.ones_like(txt_sum), atol=1e-2), "Elements are not within the tolerance"
-
-            img_ratio.append((attn[img_token_idx][:, prefix_token_idx].sum(dim=1) / attn[img_token_idx][:, img_token_idx].sum(dim=1)).mean().item())
-            txt_ratio.append((attn[prefix_token_idx][:, prefix_token_idx].sum(dim=1) / attn[prefix_token_idx][:, img_token_idx].sum(dim=1)).mean().item())
 
+    @contextlib.contextmanager
+    def attention_probe(self, layers, reduce):
+        """
+        Call `reduce(layer, attn_weights)` with the attention weights of the given decoder layers.
+        Only the probed layers ask for their weights, so they fall back to eager attention while
+        every other layer keeps SDPA, and the weights are dropped as soon as `reduce` has run.
+        """
+        decoder_layers = self.model.language_model.model.layers
+
+        def pre_hook(module, args, kwargs):
+            kwargs["output_attentions"] = True
+            return args, kwargs
+
+        def make_hook(layer):
+            def hook(module, args, kwargs, output):
+                assert output[1] is not None, "attention weights are not returned by %s" % type(module).__name__
+                reduce(layer, output[1])
+                return (output[0], None) + tuple(output[2:])
+            return hook
+
+        handles = []
+        try:
+            for layer in layers:
+                attn = decoder_layers[layer].self_attn
+                handles.append(attn.register_forward_pre_hook(pre_hook, with_kwargs=True))
+                handles.append(attn.register_forward_hook(make_hook(layer), with_kwargs=True))
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    def attn_scores(self, samples, layers=(-1,)):
+        """
+        Image / text attention ratios of the given layers (default: the last one), averaged over heads.
+        img_ratio is the mean over image tokens of (attention to text prefix) / (attention to image),
+        txt_ratio the mean over text prefix tokens of the same quantity.
+        :return: img_ratio, txt_ratio (tensor): (batch_size, len(layers)) on cpu
+        """
+        model_inputs = self.processor(text=samples["text_input_raw"], images=samples["image_raw"], suffix=samples["multiple_choice_answer"], return_tensors="pt", padding="longest").to(self.dtype).to(self.device)
+
+        img_token_idx = model_inputs["input_ids"] == IMAGE_TOKEN_ID
+        suffix_token_idx = model_inputs["token_type_ids"] == 1
+        # padding carries token_type_ids 0 as well, keep it out of the prefix
+        prefix_token_idx = ~img_token_idx & ~suffix_token_idx & (model_inputs["attention_mask"] == 1)
+        img_mask, prefix_mask = img_token_idx.float(), prefix_token_idx.float()
+        keys = torch.stack([prefix_mask, img_mask], dim=-1)  # (batch_size, seq_len, 2)
+
+        ratios = {}
+
+        def reduce(layer, attn_weights):
+            attn = attn_weights.mean(dim=1, dtype=torch.float32)  # (batch_size, seq_len, seq_len)
+            to_prefix, to_img = torch.bmm(attn, keys).unbind(dim=-1)
+            ratio = to_prefix / to_img
+            img_ratio = torch.where(img_token_idx, ratio, 0).sum(dim=1) / img_mask.sum(dim=1)
+            txt_ratio = torch.where(prefix_token_idx, ratio, 0).sum(dim=1) / prefix_mask.sum(dim=1)
+            ratios[layer] = (img_ratio, txt_ratio)
+
+        with torch.inference_mode(), self.attention_probe(layers, reduce):
+            # labels stay in: PaliGemma only builds the prefix-LM mask when they are passed
+            self.model(**model_inputs)
+
+        img_ratio = torch.stack([ratios[layer][0] for layer in layers], dim=1).cpu()
+        txt_ratio = torch.stack([ratios[layer][1] for layer in layers], dim=1).cpu()
         return img_ratio, txt_ratio
     
     def predict_answers(
@@ -164,43 +203,6 @@ class PaliGemma_VQA(BaseModel):
         else:
             return output_text
     
-    def _lemmatize(self, answers):
-        def apply(answer):
-            doc = self.lemmatizer(answer)
-
-            words = []
-            for token in doc:
-                if token.pos_ in ["NOUN", "VERB"]:
-                    words.append(token.lemma_)
-                else:
-                    words.append(token.text)
-            answer = " ".join(words)
-
-            return answer
-
-        return [apply(answer) for answer in answers]
-
-    @property
-    def lemmatizer(self):
-        if self._lemmatizer is None:
-            try:
-                import spacy
-
-                self._lemmatizer = spacy.load("en_core_web_sm")
-            except ImportError:
-                logging.error(
-                    """
-                    Please install spacy and en_core_web_sm model to apply lemmatization.
-                    python -m spacy download en_core_web_sm
-                    OR
-                    import spacy.cli
-                    spacy.cli.download("en_core_web_sm")
-                    """
-                )
-                exit(1)
-
-        return self._lemmatizer
-
     @classmethod
     def from_config(cls, cfg):
         model_id = cfg.get("model_id", "google/paligemma-3b-pt-224")  # paligemma-3b-ft-vqav2-224  paligemma-3b-pt-448
@@ -209,6 +211,7 @@ class PaliGemma_VQA(BaseModel):
         model = cls(
             model_id=model_id,
             dtype=dtype,
+            apply_lemmatizer=cfg.get("apply_lemmatizer", False),
         )
 
         load_finetuned = cfg.get("load_finetuned", False)
@@ -252,20 +255,22 @@ class PaliGemma_VQA(BaseModel):
         # WiSE
         wise = int(cfg.get("wise", 0))
         assert wise >= 0 and wise <= 1, "WiSE should be in [0, 1]"
+        interpolator = None
         if wise > 0:
             assert load_finetuned, "WiSE requires load_finetuned=True"
-            w0 = {key: value.to('cpu') for key, value in model.state_dict().items()}
-            w0 = copy.deepcopy(w0)
-        
-        if load_finetuned:
-            model.load_checkpoint_from_config(cfg)
+            interpolator = WiSEInterpolator()
+
+        # record the zero-shot value of every tensor the checkpoint overwrites
+        with interpolator.track() if interpolator is not None else contextlib.nullcontext():
+            if load_finetuned:
+                model.load_checkpoint_from_config(cfg)
         
-        if wise > 0:
-            w1 = {key: value.to('cpu') for key, value in model.state_dict().items()}
+        if interpolator is not None:
             # alpha * w0 + (1 - alpha) * w1
-            alpha = wise
-            wise = {key: (alpha * w0[key] + (1 - alpha) * w1[key]).to(model.device) for key in w1.keys()}
-            model.load_state_dict(wise)
+            alpha = float(cfg.get("wise_alpha", wise))
+            interpolator.blend(alpha)
+            model.wise = interpolator
+            model.wise_alphas = [float(a) for a in cfg.get("wise_alphas", [alpha])]
             logging.info("WiSE: load finetuned model and apply WiSE")
 
         print("Final Model before runner", model)
@@ -274,63 +279,42 @@ class PaliGemma_VQA(BaseModel):
     
     def load_from_pretrained(self, url_or_filename):
         if is_url(url_or_filename):
-            cached_file = download_cached_file(
+            checkpoint_path = download_cached_file(
                 url_or_filename, check_hash=False, progress=True
             )
-            checkpoint = torch.load(cached_file, map_location=self.device, weights_only=True)
-        elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location=self.device, weights_only=True)
+        elif os.path.exists(url_or_filename):
+            checkpoint_path = url_or_filename
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        state_dict = checkpoint["model"]
-        for key in list(state_dict.keys()):
-            start_key = "base_model.model.model."
-            if key.startswith(start_key):
-                state_dict[key[len(start_key):]] = state_dict.pop(key)
-        
-        # Load the current state_dict of the model
-        current_state_dict = self.model.state_dict()
-
-        # Update the current state_dict with the new parameters
-        for key in state_dict.keys():
-            assert key in current_state_dict, f"key {key} not in current_state_dict"
-            current_state_dict[key] = state_dict[key]
-
-        # Load the updated state_dict back into the model
-        self.model.load_state_dict(current_state_dict)
+        # copy the memory-mapped weights straight into the model, renaming keys on the way
+        msg = load_state_dict_mmap(
+            self.model,
+            checkpoint_path,
+            prefix_rules={"base_model.model.model.": ""},
+            weights_only=True,
+        )
+        assert not msg.unexpected_keys, f"keys {msg.unexpected_keys} not in current_state_dict"
         logging.info("load pretrained checkpoint from %s" % url_or_filename)
 
     def load_checkpoint(self, url_or_filename):
         if is_url(url_or_filename):
-            cached_file = download_cached_file(
+            checkpoint_path = download_cached_file(
                 url_or_filename, check_hash=False, progress=True
             )
-            checkpoint = torch.load(cached_file, map_location=self.device, weights_only=True)
-        elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location=self.device, weights_only=True)
+        elif os.path.exists(url_or_filename):
+            checkpoint_path = url_or_filename
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        state_dict = checkpoint["model"]
-        for key in list(state_dict.keys()):
-            start_key = "base_model.model.model."
-            start_key_2 = "model."
-            if key.startswith(start_key):
-                state_dict[key[len(start_key):]] = state_dict.pop(key)
-            elif key.startswith(start_key_2):
-                state_dict[key[len(start_key_2):]] = state_dict.pop(key)
-        
-        # Load the current state_dict of the model
-        current_state_dict = self.model.state_dict()
-
-        # Update the current state_dict with the new parameters
-        for key in state_dict.keys():
-            assert key in current_state_dict, f"key {key} not in current_state_dict"
-            current_state_dict[key] = state_dict[key]
-
-        # Load the updated state_dict back into the model
-        self.model.load_state_dict(current_state_dict)
+        # copy the memory-mapped weights straight into the model, renaming keys on the way
+        msg = load_state_dict_mmap(
+            self.model,
+            checkpoint_path,
+            prefix_rules={"base_model.model.model.": "", "model.": ""},
+            weights_only=True,
+        )
+        assert not msg.unexpected_keys, f"keys {msg.unexpected_keys} not in current_state_dict"
         logging.info("load checkpoint from %s" % url_or_filename)
 
 
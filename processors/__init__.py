@@ -6,14 +6,18 @@
 """
 
 from processors.base_processor import BaseProcessor
-from processors.blip_processors import (
-    BlipImageTrainProcessor,
-    Blip2ImageTrainProcessor,
-    BlipImageEvalProcessor,
-    BlipCaptionProcessor,
-)
-
-from common.registry import registry
+
+from common.registry import registry, lazy_getattr
+
+for processor_name in ("blip_caption", "blip_question", "blip_image_train", "blip_image_eval", "blip2_image_train"):
+    registry.register_lazy("processor", processor_name, "processors.blip_processors")
+
+__getattr__ = lazy_getattr(__name__, {
+    "BlipImageTrainProcessor": "processors.blip_processors",
+    "Blip2ImageTrainProcessor": "processors.blip_processors",
+    "BlipImageEvalProcessor": "processors.blip_processors",
+    "BlipCaptionProcessor": "processors.blip_processors",
+})
 
 __all__ = [
     "BaseProcessor",
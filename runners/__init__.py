@@ -1,4 +1,11 @@
-from runners.runner_base import RunnerBase
-from runners.runner_robust_ft import RunnerRobustFT
+from common.registry import registry, lazy_getattr
+
+registry.register_lazy("runner", "runner_base", "runners.runner_base")
+registry.register_lazy("runner", "runner_robust_ft", "runners.runner_robust_ft")
+
+__getattr__ = lazy_getattr(__name__, {
+    "RunnerBase": "runners.runner_base",
+    "RunnerRobustFT": "runners.runner_robust_ft",
+})
 
 __all__ = ["RunnerBase", "RunnerRobustFT"]
\ No newline at end of file
@@ -15,9 +15,10 @@ from common.dist_utils import (
     is_main_process,
     main_process,
 )
+from common.checkpoint import CheckpointWriter, is_sharded_checkpoint, load_checkpoint, load_state_dict_mmap
 from common.registry import registry
 from common.utils import is_url
-from data.data_utils import concat_datasets, reorg_datasets_by_split
+from data.data_utils import concat_datasets, reorg_datasets_by_split, set_frame_cache_bytes
 from data.datasets.dataloader_utils import (
     IterLoader,
     MultiIterLoader,
@@ -54,6 +55,7 @@ class RunnerBase:
         self._scaler = None
         self._dataloaders = None
         self._lr_sched = None
+        self._checkpoint_writer = None
 
         self.start_epoch = 0
 
@@ -283,6 +285,30 @@ class RunnerBase:
         save_last = self.config.run_cfg.get("save_last", True)
         return int(save_last)
     
+    @property
+    def async_checkpoint(self):
+        """
+        Set to True to write sharded checkpoints from a background thread.
+        """
+        return bool(self.config.run_cfg.get("async_checkpoint", False))
+
+    @property
+    def frame_cache_bytes(self):
+        """
+        Set `frame_cache_mb` to keep decoded video frames in memory across epochs.
+        The budget applies to every dataloader worker of every rank. Defaults to 0 (off).
+        """
+        return int(self.config.run_cfg.get("frame_cache_mb", 0)) * 1024 ** 2
+
+    @property
+    def checkpoint_writer(self):
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = CheckpointWriter(
+                rank=get_rank(), world_size=get_world_size()
+            )
+
+        return self._checkpoint_writer
+
     @property
     def init_lr(self):
         return float(self.config.run_cfg.init_lr)
@@ -420,6 +446,14 @@ class RunnerBase:
         if self.save_last and not self.evaluate_only:
             self._save_checkpoint(cur_epoch, is_best=False)
 
+        # async_checkpoint is the same on every rank, the writer exists only where a save happened
+        if self.async_checkpoint:
+            if self._checkpoint_writer is not None:
+                self._checkpoint_writer.wait()
+            # rank 0 may still be publishing checkpoint_best from its writer thread
+            if self.use_distributed:
+                dist.barrier()
+
         # testing phase
         test_epoch = "best" if len(self.valid_splits) > 0 else cur_epoch
         self.evaluate(cur_epoch=test_epoch, skip_reload=self.evaluate_only)
@@ -432,10 +466,34 @@ class RunnerBase:
         test_logs = dict()
 
         if len(self.test_splits) > 0:
-            for split_name in self.test_splits:
-                test_logs[split_name] = self.eval_epoch(
-                    split_name=split_name, cur_epoch=cur_epoch, skip_reload=skip_reload
-                )
+            # WiSE sweep: re-blend the fine-tuned tensors in place for every alpha
+            model = self.unwrap_dist_model(self.model)
+            wise = getattr(model, "wise", None)
+            wise_alphas = getattr(model, "wise_alphas", [])
+            if wise is None or len(wise_alphas) <= 1:
+                wise_alphas = [None]
+            elif not skip_reload and cur_epoch == "best":
+                # reload once up front, tracked so the best checkpoint becomes the
+                # fine-tuned end of the blend; a per-split reload would undo every blend
+                with wise.track():
+                    self._reload_best_model(model)
+                skip_reload = True
+
+            for alpha in wise_alphas:
+                if alpha is not None:
+                    wise.blend(alpha)
+
+                for split_name in self.test_splits:
+                    result_name = split_name if alpha is None else "{}_wise{}".format(split_name, alpha)
+                    test_log = self.eval_epoch(
+                        split_name=split_name,
+                        cur_epoch=cur_epoch,
+                        skip_reload=skip_reload,
+                        result_name=result_name,
+                    )
+                    test_logs[result_name] = test_log
+                    if alpha is not None:
+                        self.log_stats(test_log, result_name)
 
             return test_logs
 
@@ -459,7 +517,7 @@ class RunnerBase:
         )
 
     @torch.no_grad()
-    def eval_epoch(self, split_name, cur_epoch, skip_reload=False):
+    def eval_epoch(self, split_name, cur_epoch, skip_reload=False, result_name=None):
         """
         Evaluate the model on a given split.
 
@@ -469,6 +527,7 @@ class RunnerBase:
             skip_reload_best (bool): whether to skip reloading the best checkpoint.
                 During training, we will reload the best checkpoint for validation.
                 During testing, we will use provided weights and skip reloading the best checkpoint .
+            result_name (str): prefix of the saved result files, defaults to split_name.
         """
         data_loader = self.dataloaders.get(split_name, None)
         assert data_loader, "data_loader for split {} is None.".format(split_name)
@@ -491,6 +550,7 @@ class RunnerBase:
                 val_result=results,
                 split_name=split_name,
                 epoch=cur_epoch,
+                result_name=result_name or split_name,
             )
 
 
@@ -523,40 +583,21 @@ class RunnerBase:
 
             model.eval()
 
-            results = self.task.get_xattn(model, data_loader) 
-
-            img_ratio = []
-            txt_ratio = []
-            instance_id = []
-            image_path = []
-            text = []
-            answer = []
-
-            for idx in results.keys() :
-                img_ratio.append(results[idx]['img_ratio'])
-                txt_ratio.append(results[idx]['txt_ratio'])
-                instance_id.append(int(idx))
-                image_path.append(results[idx]['image_path'])
-                text.append(results[idx]['text_input_raw'])
-                answer.append(results[idx]['multiple_choice_answer'])
-            
-            # reorder according to instance_id
-            img_ratio = [x for _, x in sorted(zip(instance_id, img_ratio))]
-            txt_ratio = [x for _, x in sorted(zip(instance_id, txt_ratio))]
-            image_path = [x for _, x in sorted(zip(instance_id, image_path))]
-            text = [x for _, x in sorted(zip(instance_id, text))]
-            answer = [x for _, x in sorted(zip(instance_id, answer))]
-            instance_id = sorted(instance_id)
-
-            df = pd.DataFrame({
-                "instance_id" : instance_id,
-                "image_path" : image_path,
-                "text" : text,
-                "answer" : answer,
-                "img_ratio" : img_ratio,
-                "txt_ratio" : txt_ratio,
-            })
+            layers = run_config.get("xattn_layers", [-1])
+            self.task.get_xattn(model, data_loader, output_dir, layers=layers)
+
+            if self.use_distributed:
+                dist.barrier()
+            if not is_main_process():
+                continue
+
+            part_files = [f"{output_dir}.rank{rank}" for rank in range(get_world_size())]
+            # the distributed sampler pads the last batch with samples already seen by another rank
+            df = pd.concat([pd.read_csv(f, keep_default_na=False) for f in part_files])
+            df = df.drop_duplicates("instance_id").sort_values("instance_id").reset_index(drop=True)
             df.to_csv(output_dir, index=True)
+            for f in part_files:
+                os.remove(f)
 
             print(f"Successfully attention scores to {output_dir}")
 
@@ -579,6 +620,8 @@ class RunnerBase:
         """
         Create dataloaders for training and validation.
         """
+        # workers inherit the frame cache budget when they start
+        set_frame_cache_bytes(self.frame_cache_bytes)
 
         def _create_loader(dataset, num_workers, bsz, is_train, collate_fn):
             # create a single dataloader for each split
@@ -621,7 +664,12 @@ class RunnerBase:
                     collate_fn=collate_fn,
                     drop_last=True if is_train else False,
                 )
-                loader = PrefetchLoader(loader)
+                loader = PrefetchLoader(
+                    loader,
+                    device=self.device,
+                    prefetch=self.config.run_cfg.get("prefetch", 2),
+                    dtype=self.config.run_cfg.get("loader_dtype", None),
+                )
 
                 if is_train:
                     loader = IterLoader(loader, use_distributed=self.use_distributed)
@@ -648,11 +696,7 @@ class RunnerBase:
 
         return loaders
 
-    @main_process
-    def _save_checkpoint(self, cur_epoch, is_best=False):
-        """
-        Save the checkpoint at the current epoch.
-        """
+    def _checkpoint_state_dict(self):
         model_no_ddp = self.unwrap_dist_model(self.model)
         param_grad_dic = {
             k: v.requires_grad for (k, v) in model_no_ddp.named_parameters()
@@ -663,8 +707,40 @@ class RunnerBase:
                 # delete parameters that do not require gradient
                 del state_dict[k]
 
+        return state_dict
+
+    def _save_checkpoint(self, cur_epoch, is_best=False):
+        """
+        Save the checkpoint at the current epoch.
+
+        With run_cfg.async_checkpoint, every rank writes its shard of the checkpoint
+        directory in the background; the best checkpoint, which only the main process
+        saves, is written by that process alone. Otherwise the main process writes a
+        single .pth file.
+        """
+        if self.async_checkpoint:
+            save_to = os.path.join(
+                self.output_dir, "checkpoint_{}".format("best" if is_best else cur_epoch)
+            )
+            logging.info("Saving checkpoint at epoch {} to {}.".format(cur_epoch, save_to))
+            self.checkpoint_writer.save(
+                save_to,
+                self._checkpoint_state_dict(),
+                self.optimizer.state_dict(),
+                meta={
+                    "config": self.config.to_dict(),
+                    "scaler": self.scaler.state_dict() if self.scaler else None,
+                    "epoch": cur_epoch,
+                },
+                sharded=not is_best,
+            )
+            return
+
+        if not is_main_process():
+            return
+
         save_obj = {
-            "model": state_dict,
+            "model": self._checkpoint_state_dict(),
             "optimizer": self.optimizer.state_dict(),
             "config": self.config.to_dict(),
             "scaler": self.scaler.state_dict() if self.scaler else None,
@@ -681,20 +757,27 @@ class RunnerBase:
         """
         Load the best checkpoint for evaluation.
         """
-        checkpoint_path = os.path.join(self.output_dir, "checkpoint_best.pth")
+        if self.async_checkpoint:
+            if self._checkpoint_writer is not None:
+                self._checkpoint_writer.wait()
+            if self.use_distributed:
+                dist.barrier()
+
+        checkpoint_path = os.path.join(self.output_dir, "checkpoint_best")
+        if not os.path.isdir(checkpoint_path):
+            checkpoint_path += ".pth"
+        elif not is_sharded_checkpoint(checkpoint_path):
+            raise RuntimeError("{} has no manifest, the checkpoint is unfinished.".format(checkpoint_path))
 
         logging.info("Loading checkpoint from {}.".format(checkpoint_path))
-        checkpoint = torch.load(checkpoint_path, map_location="cpu")
-        try:
-            model.load_state_dict(checkpoint["model"])
-        except RuntimeError as e:
+        msg = load_state_dict_mmap(model, checkpoint_path)
+        if msg.missing_keys or msg.unexpected_keys:
             logging.warning(
                 """
                 Key mismatch when loading checkpoint. This is expected if only part of the model is saved.
-                Trying to load the model with strict=False.
-                """
+                Missing keys {}, unexpected keys {}.
+                """.format(len(msg.missing_keys), msg.unexpected_keys)
             )
-            model.load_state_dict(checkpoint["model"], strict=False)
         return model
 
     def _load_checkpoint(self, url_or_filename):
@@ -707,8 +790,8 @@ class RunnerBase:
                 url_or_filename, check_hash=False, progress=True
             )
             checkpoint = torch.load(cached_file, map_location=self.device)
-        elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location=self.device)
+        elif os.path.isfile(url_or_filename) or os.path.isdir(url_or_filename):
+            checkpoint = load_checkpoint(url_or_filename, map_location=self.device)
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
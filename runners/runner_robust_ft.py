@@ -16,6 +16,7 @@ from common.dist_utils import (
     is_main_process,
     main_process,
 )
+from common.checkpoint import load_checkpoint
 from common.registry import registry
 from common.utils import is_url
 from data.data_utils import concat_datasets, reorg_datasets_by_split
@@ -193,8 +194,8 @@ class RunnerRobustFT(RunnerBase):
                 url_or_filename, check_hash=False, progress=True
             )
             checkpoint = torch.load(cached_file, map_location=self.device)
-        elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location=self.device)
+        elif os.path.isfile(url_or_filename) or os.path.isdir(url_or_filename):
+            checkpoint = load_checkpoint(url_or_filename, map_location=self.device)
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
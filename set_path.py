@@ -12,10 +12,10 @@ from omegaconf import OmegaConf
 
 from common.registry import registry
 
-from data.builders import *
-from models import *
-from processors import *
-from tasks import *
+import data.builders
+import models
+import processors
+import tasks
 
 
 root_dir = os.path.dirname(os.path.abspath(__file__))
@@ -1,5 +1,9 @@
-from common.registry import registry
-from tasks.vqa import VQATask
+from common.registry import registry, lazy_getattr
+
+registry.register_lazy("task", "vqa", "tasks.vqa")
+registry.register_lazy("task", "gqa", "tasks.vqa")
+
+__getattr__ = lazy_getattr(__name__, {"VQATask": "tasks.vqa"})
 
 
 def setup_task(cfg):
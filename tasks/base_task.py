@@ -255,7 +255,13 @@ class BaseTask:
         }
 
     @staticmethod
-    def save_result(result, result_dir, filename, remove_duplicate=""):
+    def save_result(result, result_dir, filename, remove_duplicate="", return_result=False):
+        """
+        Merge the per-rank results into one file on the main process.
+
+        With `return_result`, also return the merged list (None on other ranks) so callers
+        can score it without reading the file back.
+        """
         import json
 
         result_file = os.path.join(
@@ -282,14 +288,18 @@ class BaseTask:
 
             if remove_duplicate:
                 result_new = []
-                id_list = []
+                id_set = set()
                 for res in result:
-                    if res[remove_duplicate] not in id_list:
-                        id_list.append(res[remove_duplicate])
+                    if res[remove_duplicate] not in id_set:
+                        id_set.add(res[remove_duplicate])
                         result_new.append(res)
                 result = result_new
 
             json.dump(result, open(final_result_file, "w"))
             print("result file saved to %s" % final_result_file)
+        else:
+            result = None
 
+        if return_result:
+            return final_result_file, result
         return final_result_file
\ No newline at end of file
@@ -1,4 +1,6 @@
+import csv
 import logging
+import hashlib
 import json
 import os
 import torch
@@ -8,6 +10,7 @@ from common.utils import is_convertible_to_int
 import common.dist_utils as dist_utils
 from common.registry import registry
 from common.vqa_tools.vqa import VQA
+from common.vqa_tools.vqa_index import load_vqa_index
 from common.vqa_tools.vqa_eval import VQAEval
 from tasks.base_task import BaseTask
 
@@ -15,6 +18,7 @@ from common.logger import MetricLogger, SmoothedValue
 import torch.distributed as dist
 from common.dist_utils import get_rank, get_world_size, is_main_process, is_dist_avail_and_initialized
 from data.data_utils import prepare_sample
+from data.datasets.vqa_datasets import answer_weights
 
 
 @registry.register_task("vqa")
@@ -106,14 +110,9 @@ class VQATask(BaseTask):
                     self.anno_files[split] = dataset[split].coco_fmt_anno_file
                 else:
                     if split not in self.ques_files: # precomputed and passed in task builder
-                        self.ques_files[split] = os.path.join(registry.get_path("cache_root"),f'{ds_name}_gt', f'{ds_name}_{split}_questions.json')
-                        self.anno_files[split] = os.path.join(registry.get_path("cache_root"), f'{ds_name}_gt', f'{ds_name}_{split}_annotations.json')
-                        if dist_utils.get_rank() == 0:
-                            os.makedirs(os.path.join(registry.get_path("cache_root"),f'{ds_name}_gt'), exist_ok=True)
-                            try:
-                                convert_to_coco_gt(dataset, self.ques_files[split], self.anno_files[split], split, self.sample_id_key)
-                            except:
-                                pass # tasks like vizwiz with no gt answer
+                        self.ques_files[split], self.anno_files[split] = build_coco_gt(
+                            dataset, ds_name, split, self.sample_id_key
+                        )
                 try:
                     self.answer_list = dataset[split].answer_list
                 except AttributeError:
@@ -150,29 +149,41 @@ class VQATask(BaseTask):
 
         return pred_qa_pairs
 
-    def after_evaluation(self, val_result, split_name, **kwargs):
-        result_file = self.save_result(
+    def after_evaluation(self, val_result, split_name, result_name=None, **kwargs):
+        result_file, result = self.save_result(
             val_result,
             result_dir=registry.get_path("result_dir"),
-            filename=f"{split_name}_vqa_result",
+            filename=f"{result_name or split_name}_vqa_result",
             remove_duplicate="question_id",
+            return_result=True,
         )
 
-        metrics = self._report_metrics(result_file=result_file, split=split_name)
+        metrics = self._report_metrics(result_file=result_file, split=split_name, result=result)
 
         return metrics
 
     @dist_utils.main_process
-    def _report_metrics(self, result_file, split):
+    def _report_metrics(self, result_file, split, result=None):
         """
         Use official VQA evaluation script to report metrics.
         """
         metrics = {}
 
         if split in self.ques_files and split in self.anno_files:
-            vqa = VQA(self.anno_files[split], self.ques_files[split])
+            # the binary ground-truth index is built once and shared by all evaluations of the run
+            try:
+                index = load_vqa_index(
+                    self.anno_files[split],
+                    self.ques_files[split],
+                    os.path.join(registry.get_path("cache_root"), "vqa_index"),
+                )
+                vqa = VQA.from_index(index)
+            except OSError as e:
+                logging.warning(f"Cannot use the ground-truth index ({e}), loading the json files instead.")
+                vqa = VQA(self.anno_files[split], self.ques_files[split])
             vqa_result = vqa.loadRes(
-                resFile=result_file, quesFile=self.ques_files[split]
+                resFile=result if result is not None else result_file,
+                quesFile=self.ques_files[split],
             )
             # create vqaEval object by taking vqa and vqaRes
             # n is precision of accuracy (number of places after decimal), default is 2
@@ -204,50 +215,172 @@ class VQATask(BaseTask):
     Adding get cross attention
     """
 
-    def get_xattn(self, model, data_loader, cuda_enabled=True):
-        metric_logger = MetricLogger(delimiter="  ")
-        header = "Evaluation"
-        # TODO make it configurable
-        print_freq = 10
-
-        results = {} 
-        # for samples in metric_logger.log_every(data_loader, print_freq, header):
-        for samples in tqdm(data_loader):
-            samples = prepare_sample(samples, cuda_enabled=cuda_enabled)
-            # print("model device :", model.device)
-            # print("samples  device: ", samples.device)
-            
-            # print(samples)
-            instance_ids = samples["instance_id"] #(1, batch size)
-            img_ratio_batch, txt_ratio_batch = model.attn_scores(samples)
-            
-            for idx, instance_id in enumerate(instance_ids) : 
-                if instance_id in results : 
-                    raise Exception("duplicate instance id")
-                
-                results[instance_id] = {}
-                results[instance_id]['img_ratio'] = img_ratio_batch[idx]
-                results[instance_id]['txt_ratio'] = txt_ratio_batch[idx]
-                results[instance_id]['image_path'] = samples['image_path'][idx]
-                results[instance_id]['text_input_raw'] = samples['text_input_raw'][idx]
-                results[instance_id]['multiple_choice_answer'] = samples['multiple_choice_answer'][idx]
-
-        if is_dist_avail_and_initialized():
-            dist.barrier()
-            print("merging results across the gpus")
-
-            all_results = [{} for _ in range(dist.get_world_size())]
-            print("size ", dist.get_world_size())
-            dist.all_gather_object(all_results, results)
-
-            # Combine results into a single dictionary
-            merged_results = {}
-            for gpu_results in all_results:
-                merged_results.update(gpu_results)
-
-        #stack the results
-    
-        return merged_results 
+    def get_xattn(self, model, data_loader, output_file, layers=(-1,), cuda_enabled=True):
+        """
+        Write the attention ratios of every sample of this rank to `output_file.rank<rank>`,
+        one CSV row per sample as batches complete, and return that file.
+        """
+        layers = list(layers)
+        if len(layers) == 1:
+            ratio_columns = ["img_ratio", "txt_ratio"]
+        else:
+            ratio_columns = ["img_ratio_{}".format(l) for l in layers] + ["txt_ratio_{}".format(l) for l in layers]
+
+        part_file = "{}.rank{}".format(output_file, get_rank())
+        seen = set()
+        with open(part_file, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["instance_id", "image_path", "text", "answer"] + ratio_columns)
+            for samples in tqdm(data_loader):
+                samples = prepare_sample(samples, cuda_enabled=cuda_enabled)
+                img_ratio_batch, txt_ratio_batch = model.attn_scores(samples, layers=layers)
+
+                rows = torch.cat([img_ratio_batch, txt_ratio_batch], dim=1).tolist()
+                for idx, instance_id in enumerate(samples["instance_id"]):
+                    if instance_id in seen:
+                        raise Exception("duplicate instance id")
+                    seen.add(instance_id)
+                    writer.writerow(
+                        [
+                            int(instance_id),
+                            samples["image_path"][idx],
+                            samples["text_input_raw"][idx],
+                            samples["multiple_choice_answer"][idx],
+                        ]
+                        + rows[idx]
+                    )
+                f.flush()
+
+        return part_file
+
+
+# bump when the content of the generated files changes
+COCO_GT_VERSION = 2
+
+
+def _normalize_question_id(ques_id):
+    ques_id = int(ques_id.item()) if isinstance(ques_id, torch.Tensor) else ques_id
+    if ques_id != int and is_convertible_to_int(ques_id):
+        ques_id = int(ques_id)
+    return ques_id
+
+
+def _annotation_gt_records(dataset, sample_id_key):
+    """
+    (question, answers, extra annotation fields) read straight from the annotation records,
+    or None when the records do not carry them and samples have to be loaded.
+    """
+    annotation = getattr(dataset, "annotation", None)
+    if not isinstance(annotation, list) or len(annotation) == 0:
+        return None
+    for ann in annotation:
+        if not isinstance(ann, dict) or not {"question_id", "question", sample_id_key} <= ann.keys():
+            return None
+        if "answers" not in ann and "answer" not in ann:
+            return None
+
+    # same question processing and answer dedup as the datasets' __getitem__
+    text_processor = getattr(dataset, "text_processor", None)
+    records = []
+    for ann in annotation:
+        answers = ann["answers"] if "answers" in ann else ann["answer"]
+        if isinstance(answers, list):
+            answers, _ = answer_weights(answers)
+        records.append(
+            {
+                "question_id": ann["question_id"],
+                "text_input": text_processor(ann["question"]) if text_processor is not None else ann["question"],
+                "answers": answers,
+                sample_id_key: ann[sample_id_key],
+                "question_type": ann.get("question_type", ""),
+                "answer_type": ann.get("answer_type", ""),
+            }
+        )
+    return records
+
+
+def gt_fingerprint(dataset, sample_id_key, stamp_file=None, save_stamp=False):
+    """
+    Hash of the annotation files behind `dataset`, None when they are unknown.
+
+    The files are only read again when their (path, size, mtime) differ from the ones recorded
+    in `stamp_file` next to the hash; `save_stamp` records the current ones.
+    """
+    ann_paths = getattr(dataset, "ann_paths", None)
+    if not ann_paths:
+        return None
+    prefix = f"{COCO_GT_VERSION}:{type(dataset).__name__}:{sample_id_key}"
+    stamp = [prefix]
+    for path in ann_paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            stamp.append([str(path), stat.st_size, stat.st_mtime_ns])
+        else:
+            stamp.append([str(path), None, None])
+
+    if stamp_file is not None and os.path.isfile(stamp_file):
+        try:
+            with open(stamp_file, "r") as f:
+                saved = json.load(f)
+            if saved["stamp"] == stamp:
+                return saved["fingerprint"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    digest = hashlib.sha1(prefix.encode())
+    for path in ann_paths:
+        digest.update(str(path).encode())
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+    fingerprint = digest.hexdigest()[:16]
+
+    if stamp_file is not None and save_stamp:
+        try:
+            _dump_json_atomic({"stamp": stamp, "fingerprint": fingerprint}, stamp_file)
+        except OSError as e:
+            logging.info(f"Could not record the annotation stamp in {stamp_file}: {e}")
+    return fingerprint
+
+
+def build_coco_gt(data, ds_name, split, sample_id_key):
+    """
+    Paths of the COCO-format question / annotation files for `data[split]`.
+
+    The files live next to the other ground-truth caches and are named after the hash of the
+    annotation files, so they are built once per annotation version instead of on every launch.
+    """
+    gt_dir = os.path.join(registry.get_path("cache_root"), f"{ds_name}_gt")
+    is_main = dist_utils.get_rank() == 0
+    if is_main:
+        os.makedirs(gt_dir, exist_ok=True)
+    stamp_file = os.path.join(gt_dir, f"{ds_name}_{split}_stamp.json")
+    fingerprint = (
+        gt_fingerprint(data[split], sample_id_key, stamp_file=stamp_file, save_stamp=is_main)
+        if split in data
+        else None
+    )
+    tag = f"{split}_{fingerprint}" if fingerprint is not None else split
+    ques_file = os.path.join(gt_dir, f"{ds_name}_{tag}_questions.json")
+    anno_file = os.path.join(gt_dir, f"{ds_name}_{tag}_annotations.json")
+
+    cached = fingerprint is not None and os.path.exists(ques_file) and os.path.exists(anno_file)
+    if is_main and not cached:
+        try:
+            convert_to_coco_gt(data, ques_file, anno_file, split, sample_id_key)
+        except Exception as e:
+            # tasks like vizwiz with no gt answer
+            logging.info(f"No ground truth for {ds_name} {split}: {e}")
+    return ques_file, anno_file
+
+
+def _dump_json_atomic(obj, path):
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
 
 def convert_to_coco_gt(data, outpath_questions, outpath_annotations, split, sample_id_key):
     if split not in data:
@@ -255,15 +388,16 @@ def convert_to_coco_gt(data, outpath_questions, outpath_annotations, split, samp
     questions_data = {'info':"", 'task_type':"", 'data_type':"", 'license':"", 'data_subtype':"", 'questions':[]}
     annotations_data = {'info':"", 'task_type':"", 'data_type':"", 'license':"", 'data_subtype':"", 'annotations':[]}
     print("Generating ground truth annotations...")
-    for ann in tqdm(data[split]):
+    records = _annotation_gt_records(data[split], sample_id_key)
+    if records is None:
+        # no usable annotation records, fall back to loading every sample
+        records = data[split]
+    for ann in tqdm(records):
         if ann == None:
             continue
         # if ann[sample_id_key] not in img_ids:
         #     continue
-        ques_id = ann["question_id"]
-        ques_id = int(ques_id.item()) if isinstance(ques_id, torch.Tensor) else ques_id
-        if ques_id != int and is_convertible_to_int(ques_id):
-            ques_id = int(ques_id)
+        ques_id = _normalize_question_id(ann["question_id"])
         questions_data["questions"].append({"question": ann["text_input"], "image_id": ann[sample_id_key], "question_id": ques_id})
         annotations_data["annotations"].append({
             "question_type": "" if "question_type" not in ann else ann["question_type"],
@@ -273,10 +407,10 @@ def convert_to_coco_gt(data, outpath_questions, outpath_annotations, split, samp
             "question_id": ques_id,
             "answer_type": "" if "answer_type" not in ann else ann["answer_type"],
         })
-       
-    json.dump(questions_data, open(outpath_questions, 'w'))
+
+    _dump_json_atomic(questions_data, outpath_questions)
     print(f"Saved questions data at {outpath_questions}")
-    json.dump(annotations_data, open(outpath_annotations, 'w'))
+    _dump_json_atomic(annotations_data, outpath_annotations)
     print(f"Saved annotation data at {outpath_annotations}")
 
 
@@ -325,12 +459,12 @@ class GQATask(VQATask):
         return datasets
         
     @dist_utils.main_process
-    def _report_metrics(self, result_file, split):
+    def _report_metrics(self, result_file, split, result=None):
         """
         TODO: add other evaluation metrics for GQA
         """
 
-        results = json.load(open(result_file, "r"))
+        results = result if result is not None else json.load(open(result_file, "r"))
         acc = []
         vqa_tool = VQAEval()
 
@@ -1,4 +1,6 @@
-from collections import defaultdict
+import logging
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from typing import Any, Dict, List, Tuple, Optional
 from common.registry import registry
@@ -22,6 +24,97 @@ class QAOutput(ModelOutput):
     top10_answers_and_probs: List[Optional[Tuple[List[str], List[float]]]] = None
 
 
+class AnswerLemmatizer:
+    """
+    Lemmatize predicted VQA answers with spaCy.
+
+    Nouns and verbs are replaced by their lemma, other tokens are kept as is. The
+    pipeline is loaded without parser/ner in a background worker, which also runs
+    `nlp.pipe` over the answers that are not in the LRU cache yet. VQA answers
+    repeat a lot ("yes", "no", "2"), so most batches are pure cache lookups.
+
+    Args:
+        model_name: spaCy pipeline to load.
+        cache_size: maximum number of memoized answers.
+        batch_size: batch size passed to `nlp.pipe`.
+    """
+
+    LEMMATIZED_POS = ("NOUN", "VERB")
+
+    def __init__(self, model_name="en_core_web_sm", cache_size=65536, batch_size=256):
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self._cache = OrderedDict()
+        # one worker: the cache is only touched from this thread
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lemmatizer")
+        self._nlp = self._worker.submit(self._load, model_name)
+
+    @staticmethod
+    def _load(model_name):
+        try:
+            import spacy
+
+            return spacy.load(model_name, exclude=["parser", "ner"])
+        except ImportError:
+            logging.error(
+                """
+                Please install spacy and en_core_web_sm model to apply lemmatization.
+                python -m spacy download en_core_web_sm
+                OR
+                import spacy.cli
+                spacy.cli.download("en_core_web_sm")
+                """
+            )
+            exit(1)
+
+    def _apply(self, answers):
+        lemmas = {}
+        for answer in answers:
+            if answer in self._cache:
+                self._cache.move_to_end(answer)
+                lemmas[answer] = self._cache[answer]
+
+        misses = [answer for answer in dict.fromkeys(answers) if answer not in lemmas]
+        if misses:
+            nlp = self._nlp.result()
+            for answer, doc in zip(misses, nlp.pipe(misses, batch_size=self.batch_size)):
+                lemma = " ".join(
+                    token.lemma_ if token.pos_ in self.LEMMATIZED_POS else token.text for token in doc
+                )
+                lemmas[answer] = lemma
+                self._cache[answer] = lemma
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return [lemmas[answer] for answer in answers]
+
+    def __call__(self, answers):
+        return self._worker.submit(self._apply, list(answers)).result()
+
+
+class LemmatizerMixin:
+    """
+    `_lemmatize` / `lemmatizer` shared by the VQA model wrappers.
+
+    Call `init_lemmatizer` at the start of `__init__`: when lemmatization is on, the
+    spaCy pipeline then loads in the background while the model weights are loaded.
+    """
+
+    def init_lemmatizer(self, apply_lemmatizer):
+        self._apply_lemmatizer = apply_lemmatizer
+        self._lemmatizer = AnswerLemmatizer() if apply_lemmatizer else None
+
+    def _lemmatize(self, answers):
+        return self.lemmatizer(answers)
+
+    @property
+    def lemmatizer(self):
+        if self._lemmatizer is None:
+            self._lemmatizer = AnswerLemmatizer()
+
+        return self._lemmatizer
+
+
 def after_predict_answers_valid_step(samples: Dict[str, Any], qa_output: QAOutput):
     pred_batch = []
     question_ids = samples["question_id"]
@@ -49,13 +49,12 @@ from common.optims import (
 from common.registry import registry
 from common.utils import now
 
-# imports modules for registration
-from data.builders import *
-from models import *
+# packages list their registry entries; the modules behind them are imported when the config resolves them
+import data.builders
+import models
 from optimizer import *
-from processors import *
-from runners import *
-from tasks import *
+import processors
+import runners
 import tasks
 
 
@@ -70,6 +69,11 @@ def parse_args():
         "in xxx=yyy format will be merged into config file (deprecate), "
         "change to --cfg-options instead.",
     )
+    parser.add_argument(
+        "--check-registry",
+        action="store_true",
+        help="import every registered module and check that the lazy registry listings are complete.",
+    )
 
     args = parser.parse_args()
     # if 'LOCAL_RANK' not in os.environ:
@@ -106,6 +110,13 @@ def main():
 
     cfg.pretty_print()
 
+    if args.check_registry:
+        problems = registry.check_lazy_listings()
+        for problem in problems:
+            logging.error(problem)
+        if problems:
+            raise RuntimeError("Lazy registry listings are out of date, see the errors above.")
+
     task = tasks.setup_task(cfg)
     datasets = task.build_datasets(cfg)
     model = task.build_model(cfg)